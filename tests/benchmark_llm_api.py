@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark for tools/llm_api.py.
+
+Starts a local stand-in for the OpenAI chat completions and Anthropic messages
+APIs with configurable latency and streaming speed, points the ``local`` and
+``anthropic`` providers at it, and reports requests/sec, client overhead per
+call and latency percentiles for the sync, async, batch and streaming modes.
+No API keys or network access are needed.
+
+Usage:
+    PYTHONPATH=. python tests/benchmark_llm_api.py --requests 200 --concurrency 8 --latency 50
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+
+from tools.llm_api import (
+    create_llm_client, aclose_shared_clients, clear_shared_clients, query_llm, aquery_llm,
+    query_llm_batch, stream_llm, add_call_hook, remove_call_hook, _percentile
+)
+
+MODES = ["sync", "async", "batch", "stream"]
+PROVIDERS = ["local", "anthropic"]
+
+class FakeLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Bursts of concurrent connections from the async and batch modes overflow the default backlog of 5
+    request_queue_size = 256
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    """Answers OpenAI /chat/completions and Anthropic /messages requests with canned text."""
+
+    # Keep-alive, so connection reuse in the clients is part of what is measured
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are separate writes; without TCP_NODELAY delayed ACKs add ~40ms per response
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        start = time.perf_counter()
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        server = self.server
+        time.sleep(max(0.0, server.latency + random.uniform(-server.jitter, server.jitter)))
+        words = [f"token{i} " for i in range(server.response_tokens)]
+        if self.path.endswith('/chat/completions'):
+            if body.get("stream"):
+                self._stream_openai(body, words)
+            else:
+                self._send_json(self._openai_completion(body, "".join(words)))
+        elif self.path.endswith('/messages'):
+            if body.get("stream"):
+                self._stream_anthropic(body, words)
+            else:
+                self._send_json(self._anthropic_message(body, "".join(words)))
+        else:
+            self._send_json({"error": {"message": f"unknown path {self.path}"}}, status=404)
+        with server.lock:
+            server.handling_times.append(time.perf_counter() - start)
+
+    def _usage(self, body: dict) -> tuple:
+        prompt_tokens = len(json.dumps(body.get("messages", []))) // 4
+        return prompt_tokens, self.server.response_tokens
+
+    def _openai_completion(self, body: dict, text: str) -> dict:
+        prompt_tokens, completion_tokens = self._usage(body)
+        return {
+            "id": "chatcmpl-bench", "object": "chat.completion", "created": int(time.time()),
+            "model": body.get("model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        }
+
+    def _anthropic_message(self, body: dict, text: str) -> dict:
+        prompt_tokens, completion_tokens = self._usage(body)
+        return {
+            "id": "msg_bench", "type": "message", "role": "assistant", "model": body.get("model"),
+            "content": [{"type": "text", "text": text}], "stop_reason": "end_turn", "stop_sequence": None,
+            "usage": {"input_tokens": prompt_tokens, "output_tokens": completion_tokens},
+        }
+
+    def _send_json(self, payload: dict, status: int = 200):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _start_stream(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+    def _send_event(self, data: str, event: Optional[str] = None):
+        payload = (f"event: {event}\n" if event else "") + f"data: {data}\n\n"
+        encoded = payload.encode('utf-8')
+        self.wfile.write(f"{len(encoded):x}\r\n".encode('ascii') + encoded + b"\r\n")
+        self.wfile.flush()
+
+    def _end_stream(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def _stream_openai(self, body: dict, words: List[str]):
+        prompt_tokens, completion_tokens = self._usage(body)
+        base = {"id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": int(time.time()),
+                "model": body.get("model")}
+        self._start_stream()
+        for word in words:
+            self._send_event(json.dumps({**base, "choices": [
+                {"index": 0, "delta": {"content": word}, "finish_reason": None}]}))
+            time.sleep(self.server.token_delay)
+        self._send_event(json.dumps({**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}))
+        if body.get("stream_options", {}).get("include_usage"):
+            self._send_event(json.dumps({**base, "choices": [], "usage": {
+                "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens}}))
+        self._send_event("[DONE]")
+        self._end_stream()
+
+    def _stream_anthropic(self, body: dict, words: List[str]):
+        prompt_tokens, completion_tokens = self._usage(body)
+        self._start_stream()
+        self._send_event(json.dumps({"type": "message_start", "message": {
+            "id": "msg_bench", "type": "message", "role": "assistant", "model": body.get("model"), "content": [],
+            "stop_reason": None, "stop_sequence": None,
+            "usage": {"input_tokens": prompt_tokens, "output_tokens": 1}}}), "message_start")
+        self._send_event(json.dumps({"type": "content_block_start", "index": 0,
+                                     "content_block": {"type": "text", "text": ""}}), "content_block_start")
+        for word in words:
+            self._send_event(json.dumps({"type": "content_block_delta", "index": 0,
+                                         "delta": {"type": "text_delta", "text": word}}), "content_block_delta")
+            time.sleep(self.server.token_delay)
+        self._send_event(json.dumps({"type": "content_block_stop", "index": 0}), "content_block_stop")
+        self._send_event(json.dumps({"type": "message_delta", "delta": {"stop_reason": "end_turn",
+                                                                        "stop_sequence": None},
+                                     "usage": {"output_tokens": completion_tokens}}), "message_delta")
+        self._send_event(json.dumps({"type": "message_stop"}), "message_stop")
+        self._end_stream()
+
+    def log_message(self, format, *args):
+        pass
+
+def start_fake_server(latency: float = 0.0, jitter: float = 0.0, response_tokens: int = 20,
+                      token_delay: float = 0.0) -> FakeLLMServer:
+    """Start the stand-in API server on a free localhost port in a background thread."""
+    server = FakeLLMServer(('127.0.0.1', 0), FakeLLMHandler)
+    server.latency = latency
+    server.jitter = jitter
+    server.response_tokens = response_tokens
+    server.token_delay = token_delay
+    server.lock = threading.Lock()
+    server.handling_times = []
+    threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+    return server
+
+def _point_providers_at(server: FakeLLMServer):
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    os.environ['LOCAL_LLM_URL'] = f"{base_url}/v1"
+    os.environ['ANTHROPIC_BASE_URL'] = base_url
+    os.environ.setdefault('ANTHROPIC_API_KEY', 'benchmark')
+    # Per-call records would otherwise be appended to the user's stats file
+    os.environ.pop('LLM_STATS_FILE', None)
+    clear_shared_clients()
+
+def _run_mode(mode: str, provider: str, requests: int, concurrency: int) -> None:
+    prompts = [f"Benchmark {mode} prompt {i}" for i in range(requests)]
+    if mode == "sync":
+        client = create_llm_client(provider, shared=True)
+        for prompt in prompts:
+            query_llm(prompt, client, provider=provider)
+    elif mode == "async":
+        async def run_all():
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def run(prompt):
+                async with semaphore:
+                    return await aquery_llm(prompt, provider=provider)
+            try:
+                await asyncio.gather(*[run(prompt) for prompt in prompts])
+            finally:
+                await aclose_shared_clients()
+        asyncio.run(run_all())
+    elif mode == "batch":
+        query_llm_batch(prompts, create_llm_client(provider, shared=True), provider=provider,
+                        max_concurrent=concurrency)
+    elif mode == "stream":
+        client = create_llm_client(provider, shared=True)
+        for prompt in prompts:
+            for _ in stream_llm(prompt, client, provider=provider):
+                pass
+
+def run_benchmark(modes: List[str] = MODES, providers: List[str] = PROVIDERS, requests: int = 100,
+                  concurrency: int = 8, latency: float = 0.0, jitter: float = 0.0, response_tokens: int = 20,
+                  token_delay: float = 0.0) -> List[dict]:
+    """
+    Run every mode against every provider and return one result row per pair.
+
+    Overhead is the mean client-side wall time per call minus the mean time the
+    stand-in server spent handling a request (its latency and streaming delays).
+    """
+    server = start_fake_server(latency, jitter, response_tokens, token_delay)
+    records = []
+    add_call_hook(records.append)
+    try:
+        _point_providers_at(server)
+        results = []
+        for provider in providers:
+            _run_mode("sync", provider, 2, 1)  # Warm up imports and connections
+            for mode in modes:
+                records.clear()
+                server.handling_times.clear()
+                start = time.perf_counter()
+                _run_mode(mode, provider, requests, concurrency)
+                elapsed = time.perf_counter() - start
+                served = [r for r in records if not r["error"]]
+                latencies = sorted(r["wall_time"] for r in served)
+                first_bytes = sorted(r["time_to_first_byte"] for r in served if r["time_to_first_byte"] is not None)
+                handling = server.handling_times
+                results.append({
+                    "mode": mode,
+                    "provider": provider,
+                    "requests": requests,
+                    "errors": len(records) - len(served) + max(0, requests - len(records)),
+                    "requests_per_second": len(served) / elapsed if elapsed else None,
+                    "p50": _percentile(latencies, 0.50) if latencies else None,
+                    "p99": _percentile(latencies, 0.99) if latencies else None,
+                    "ttfb_p50": _percentile(first_bytes, 0.50) if first_bytes else None,
+                    "overhead": (sum(latencies) / len(latencies) - sum(handling) / len(handling))
+                                if latencies and handling else None,
+                })
+        return results
+    finally:
+        remove_call_hook(records.append)
+        clear_shared_clients()
+        server.shutdown()
+        server.server_close()
+
+def print_results(results: List[dict]):
+    def ms(value):
+        return f"{value * 1000:.2f}ms" if value is not None else "-"
+
+    print(f"{'mode':<8} {'provider':<10} {'requests':>8} {'errors':>6} {'req/s':>9} "
+          f"{'p50':>10} {'p99':>10} {'ttfb p50':>10} {'overhead':>10}")
+    for row in results:
+        rate = f"{row['requests_per_second']:.1f}" if row['requests_per_second'] else "-"
+        print(f"{row['mode']:<8} {row['provider']:<10} {row['requests']:>8} {row['errors']:>6} {rate:>9} "
+              f"{ms(row['p50']):>10} {ms(row['p99']):>10} {ms(row['ttfb_p50']):>10} {ms(row['overhead']):>10}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark llm_api against a local stand-in API server')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=MODES, help='Modes to benchmark')
+    parser.add_argument('--providers', nargs='+', choices=PROVIDERS, default=PROVIDERS,
+                        help='Wire formats to benchmark')
+    parser.add_argument('--requests', type=int, default=100, help='Requests per mode and provider (default: 100)')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='Requests in flight for the async and batch modes (default: 8)')
+    parser.add_argument('--latency', type=float, default=0.0, help='Server latency per request in ms (default: 0)')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Uniform +/- latency jitter in ms (default: 0)')
+    parser.add_argument('--response-tokens', type=int, default=20, help='Tokens per response (default: 20)')
+    parser.add_argument('--token-delay', type=float, default=0.0,
+                        help='Delay between streamed tokens in ms (default: 0)')
+    parser.add_argument('--json', type=str, help='Also write the results to this JSON file')
+    args = parser.parse_args()
+
+    results = run_benchmark(args.modes, args.providers, args.requests, args.concurrency, args.latency / 1000,
+                            args.jitter / 1000, args.response_tokens, args.token_delay / 1000)
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    if any(row["errors"] for row in results):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
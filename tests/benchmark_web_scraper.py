@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+"""
+Benchmark for the HTML text extraction in tools/web_scraper.py.
+
+Times the original recursive parse_html (kept below as the reference) against
+the single-pass engine with the html5lib and lxml backends and the auto
+mode that picks between them, and checks that each produces exactly the
+reference output; html5lib and auto must, lxml may differ on broken markup.
+With --execution it also compares parsing batches of each page inline, in a
+thread pool, in a process pool with pickled arguments and through
+parse_html_async's shared-memory process pool. Pages come from local files or
+URLs given on the command line; without any, synthetic documentation pages
+and a deeply nested page are generated so the benchmark runs offline.
+
+Usage:
+    PYTHONPATH=. python tests/benchmark_web_scraper.py page.html https://docs.python.org/3/library/asyncio.html
+    PYTHONPATH=. python tests/benchmark_web_scraper.py --repeat 5 --execution --batch-sizes 1 4 16
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import List, Optional, Tuple
+from unittest.mock import patch
+
+import html5lib
+import httpx
+
+import tools.web_scraper as web_scraper
+from tools.web_scraper import parse_html, parse_html_async, close_parse_pool, lxml, logger
+
+BACKENDS = ["html5lib", "lxml", "auto"]
+EXECUTIONS = ["inline", "thread", "process", "shared"]
+
+def legacy_parse_html(html_content: Optional[str]) -> str:
+    """The recursive parse_html this engine replaced, kept verbatim as the reference output."""
+    if not html_content:
+        return ""
+    
+    try:
+        document = html5lib.parse(html_content)
+        result = []
+        seen_texts = set()  # To avoid duplicates
+        
+        def should_skip_element(elem) -> bool:
+            """Check if the element should be skipped."""
+            # Skip script and style tags
+            if elem.tag in ['{http://www.w3.org/1999/xhtml}script', 
+                          '{http://www.w3.org/1999/xhtml}style']:
+                return True
+            # Skip empty elements or elements with only whitespace
+            if not any(text.strip() for text in elem.itertext()):
+                return True
+            return False
+        
+        def process_element(elem, depth=0):
+            """Process an element and its children recursively."""
+            if should_skip_element(elem):
+                return
+            
+            # Handle text content
+            if hasattr(elem, 'text') and elem.text:
+                text = elem.text.strip()
+                if text and text not in seen_texts:
+                    # Check if this is an anchor tag
+                    if elem.tag == '{http://www.w3.org/1999/xhtml}a':
+                        href = None
+                        for attr, value in elem.items():
+                            if attr.endswith('href'):
+                                href = value
+                                break
+                        if href and not href.startswith(('#', 'javascript:')):
+                            # Format as markdown link
+                            link_text = f"[{text}]({href})"
+                            result.append("  " * depth + link_text)
+                            seen_texts.add(text)
+                    else:
+                        result.append("  " * depth + text)
+                        seen_texts.add(text)
+            
+            # Process children
+            for child in elem:
+                process_element(child, depth + 1)
+            
+            # Handle tail text
+            if hasattr(elem, 'tail') and elem.tail:
+                tail = elem.tail.strip()
+                if tail and tail not in seen_texts:
+                    result.append("  " * depth + tail)
+                    seen_texts.add(tail)
+        
+        # Start processing from the body tag
+        body = document.find('.//{http://www.w3.org/1999/xhtml}body')
+        if body is not None:
+            process_element(body)
+        else:
+            # Fallback to processing the entire document
+            process_element(document)
+        
+        # Filter out common unwanted patterns
+        filtered_result = []
+        for line in result:
+            # Skip lines that are likely to be noise
+            if any(pattern in line.lower() for pattern in [
+                'var ', 
+                'function()', 
+                '.js',
+                '.css',
+                'google-analytics',
+                'disqus',
+                '{',
+                '}'
+            ]):
+                continue
+            filtered_result.append(line)
+        
+        return '\n'.join(filtered_result)
+    except Exception as e:
+        logger.error(f"Error parsing HTML: {str(e)}")
+        return ""
+
+
+def synthetic_pages() -> List[Tuple[str, str]]:
+    """Return (name, html) pairs shaped like large documentation and app pages."""
+    sections = []
+    for i in range(300):
+        items = "".join(f'<li><a href="/api/{i}/{j}">item {i}.{j}</a> detail {j}</li>' for j in range(8))
+        sections.append(
+            f"<section id='s{i}'><h2>Section {i}</h2>"
+            f"<p>Paragraph {i} explains <code>option_{i}</code> and links to "
+            f"<a href='/docs/{i}'>reference {i}</a> and <a href='#s{i}'>itself</a>.</p>"
+            f"<ul>{items}</ul>"
+            f"<pre><code>def handler_{i}(x):\n    return x * {i}</code></pre>"
+            f"<table><tr><th>Key</th><th>Value</th></tr><tr><td>k{i}</td><td>v{i}</td></tr></table>"
+            "</section>"
+        )
+    nav = "".join(f"<li><a href='/nav/{i}'>Nav {i}</a></li>" for i in range(200))
+    docs = (
+        "<!DOCTYPE html><html><head><title>Docs</title><style>body { color: black; }</style>"
+        "<script>var config = {debug: false};</script></head><body>"
+        f"<nav><ul>{nav}</ul></nav><main>{''.join(sections)}</main>"
+        "<footer><p>Footer text</p><script src='/static/app.js'></script></footer></body></html>"
+    )
+    # Deep wrappers full of empty icons with the text at the bottom, where the original
+    # per-element subtree scan is quadratic
+    depth = 400
+    icon = "<i class='icon'></i><svg><path d='M0 0h24v24H0z'></path></svg>"
+    nested = ("<!DOCTYPE html><html><body>" + f"<div class='wrapper'>{icon}" * depth + "<p>deepest text</p>"
+              + "</div>" * depth + "</body></html>")
+    return [("synthetic-docs", docs), ("synthetic-nested", nested)]
+
+def load_pages(sources: List[str]) -> List[Tuple[str, str]]:
+    pages = []
+    for source in sources:
+        if source.startswith(("http://", "https://")):
+            response = httpx.get(source, follow_redirects=True, timeout=30)
+            response.raise_for_status()
+            pages.append((source, response.text))
+        else:
+            with open(source, encoding="utf-8", errors="replace") as f:
+                pages.append((os.path.basename(source), f.read()))
+    return pages
+
+def _time(fn, html: str, repeat: int) -> Tuple[float, str]:
+    best = float("inf")
+    output = ""
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = fn(html)
+        best = min(best, time.perf_counter() - start)
+    return best, output
+
+def run_benchmark(pages: List[Tuple[str, str]], repeat: int = 3) -> List[dict]:
+    results = []
+    for name, html in pages:
+        legacy_time, reference = _time(legacy_parse_html, html, repeat)
+        row = {"page": name, "kb": round(len(html.encode("utf-8")) / 1024), "legacy_ms": legacy_time * 1000}
+        for backend in BACKENDS:
+            if backend != "html5lib" and lxml is None:
+                continue
+            elapsed, output = _time(lambda h: parse_html(h, backend), html, repeat)
+            row[f"{backend}_ms"] = elapsed * 1000
+            row[f"{backend}_speedup"] = legacy_time / elapsed if elapsed else float("inf")
+            row[f"{backend}_identical"] = output == reference
+        results.append(row)
+    return results
+
+def _run_execution(execution: str, htmls: List[str], executor) -> List[str]:
+    if execution == "inline":
+        return [parse_html(html) for html in htmls]
+    if execution in ("thread", "process"):
+        return list(executor.map(parse_html, htmls))
+
+    async def parse_all():
+        return await asyncio.gather(*(parse_html_async(html) for html in htmls))
+
+    # Force every page through the shared-memory pool, whatever its size
+    with patch.object(web_scraper, 'PARSE_INLINE_MAX_CHARS', 0):
+        return asyncio.run(parse_all())
+
+def run_execution_benchmark(pages: List[Tuple[str, str]], batch_sizes: List[int], repeat: int = 3) -> List[dict]:
+    """Time parsing batches of copies of each page with each execution strategy."""
+    workers = os.cpu_count() or 1
+    results = []
+    # Pool start-up is paid once per process; measure it separately from the warm runs
+    start = time.perf_counter()
+    close_parse_pool()
+    asyncio.run(_warm_shared_pool())
+    shared_startup = time.perf_counter() - start
+    with ThreadPoolExecutor(workers) as threads:
+        start = time.perf_counter()
+        with ProcessPoolExecutor(workers) as processes:
+            list(processes.map(abs, range(workers)))
+            process_startup = time.perf_counter() - start
+            executors = {"thread": threads, "process": processes}
+            for name, html in pages:
+                for batch in batch_sizes:
+                    htmls = [html] * batch
+                    row = {"page": name, "kb": round(len(html.encode("utf-8")) / 1024), "batch": batch}
+                    for execution in EXECUTIONS:
+                        best = float("inf")
+                        for _ in range(repeat):
+                            start = time.perf_counter()
+                            _run_execution(execution, htmls, executors.get(execution))
+                            best = min(best, time.perf_counter() - start)
+                        row[f"{execution}_ms"] = best * 1000
+                    results.append(row)
+    close_parse_pool()
+    print(f"Pool start-up: process {process_startup * 1000:.0f} ms, shared {shared_startup * 1000:.0f} ms "
+          f"({workers} workers)")
+    return results
+
+async def _warm_shared_pool():
+    with patch.object(web_scraper, 'PARSE_INLINE_MAX_CHARS', 0):
+        await asyncio.gather(*(parse_html_async("<p>warm</p>") for _ in range(os.cpu_count() or 1)))
+
+def print_execution_results(results: List[dict]):
+    header = f"{'page':<40} {'KB':>6} {'batch':>6}" + "".join(f" {e + ' ms':>12}" for e in EXECUTIONS)
+    print(header)
+    for row in results:
+        print(f"{row['page'][-40:]:<40} {row['kb']:>6} {row['batch']:>6}"
+              + "".join(f" {row[f'{e}_ms']:>12.1f}" for e in EXECUTIONS))
+
+def print_results(results: List[dict]):
+    header = f"{'page':<40} {'KB':>6} {'legacy ms':>10}"
+    for backend in BACKENDS:
+        header += f" {backend + ' ms':>12} {'speedup':>8} {'same':>5}"
+    print(header)
+    for row in results:
+        line = f"{row['page'][-40:]:<40} {row['kb']:>6} {row['legacy_ms']:>10.1f}"
+        for backend in BACKENDS:
+            if f"{backend}_ms" in row:
+                line += (f" {row[f'{backend}_ms']:>12.1f} {row[f'{backend}_speedup']:>7.1f}x"
+                         f" {'yes' if row[f'{backend}_identical'] else 'NO':>5}")
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark parse_html against the original recursive implementation')
+    parser.add_argument('sources', nargs='*', help='HTML files or URLs (default: synthetic pages)')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per page and parser; the best is kept (default: 3)')
+    parser.add_argument('--execution', action='store_true',
+                        help='Also compare inline, thread, process and shared-memory execution')
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=[1, 4, 16],
+                        help='Pages per batch for --execution (default: 1 4 16)')
+    parser.add_argument('--json', type=str, help='Also write the results to this JSON file')
+    args = parser.parse_args()
+
+    # The reference implementation logs and returns "" when it overflows the recursion limit
+    logger.disabled = True
+    pages = load_pages(args.sources) if args.sources else synthetic_pages()
+    results = run_benchmark(pages, args.repeat)
+    print_results(results)
+    execution_results = []
+    if args.execution:
+        print()
+        execution_results = run_execution_benchmark(pages, args.batch_sizes, args.repeat)
+        print_execution_results(execution_results)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({"parsers": results, "execution": execution_results}, f, indent=2)
+    if not all(row["html5lib_identical"] and row.get("auto_identical", True) for row in results):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
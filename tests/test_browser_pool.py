@@ -0,0 +1,358 @@
+import asyncio
+import os
+import subprocess
+import sys
+import time
+import unittest
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from tools.browser_pool import (BrowserPool, get_browser_pool, close_browser_pool, browser_pool_scope,
+                                browser_memory_mb)
+
+
+def make_playwright(fail_connect=False):
+    """Build a fake async_playwright() whose chromium launches fresh mock browsers."""
+    browsers = []
+
+    def new_browser(*args, **kwargs):
+        browser = AsyncMock()
+        browser.new_page = AsyncMock(side_effect=lambda **options: AsyncMock())
+        browser.new_context = AsyncMock(side_effect=lambda: MagicMock(
+            new_page=AsyncMock(side_effect=lambda: AsyncMock()), close=AsyncMock()))
+        browsers.append(browser)
+        return browser
+
+    playwright = MagicMock()
+    playwright.chromium.launch = AsyncMock(side_effect=new_browser)
+    if fail_connect:
+        playwright.chromium.connect_over_cdp = AsyncMock(side_effect=ConnectionError("ECONNREFUSED"))
+    else:
+        playwright.chromium.connect_over_cdp = AsyncMock(side_effect=new_browser)
+    manager = MagicMock(__aenter__=AsyncMock(return_value=playwright), __aexit__=AsyncMock())
+    return MagicMock(return_value=manager), playwright, browsers
+
+
+class TestBrowserPool(unittest.IsolatedAsyncioTestCase):
+    async def test_reuses_warm_browser_and_contexts(self):
+        factory, playwright, browsers = make_playwright()
+        pool = BrowserPool(contexts=2, cdp_url='', playwright_factory=factory)
+        for _ in range(5):
+            async with pool.page() as page:
+                await page.goto('http://example.com')
+        await pool.close()
+
+        playwright.chromium.launch.assert_called_once_with(headless=True)
+        self.assertEqual(browsers[0].new_context.call_count, 2)
+        self.assertEqual(pool.stats()['pages'], 5)
+        browsers[0].close.assert_called_once()
+        factory.return_value.__aexit__.assert_called_once()
+
+    async def test_page_options_use_isolated_context(self):
+        factory, playwright, browsers = make_playwright()
+        pool = BrowserPool(cdp_url='', playwright_factory=factory)
+        async with pool.page(viewport={'width': 800, 'height': 600}) as page:
+            pass
+        await pool.close()
+
+        browsers[0].new_page.assert_called_once_with(viewport={'width': 800, 'height': 600})
+        browsers[0].new_context.assert_not_called()
+        page.close.assert_called_once()
+
+    async def test_recycles_after_max_pages(self):
+        factory, playwright, browsers = make_playwright()
+        pool = BrowserPool(max_pages=2, cdp_url='', playwright_factory=factory)
+        for _ in range(5):
+            async with pool.page():
+                pass
+
+        self.assertEqual(len(browsers), 3)
+        browsers[0].close.assert_called_once()
+        browsers[1].close.assert_called_once()
+        browsers[2].close.assert_not_called()
+        self.assertEqual(pool.stats()['recycles'], 2)
+        await pool.close()
+        browsers[2].close.assert_called_once()
+
+    async def test_retired_browser_waits_for_open_pages(self):
+        factory, playwright, browsers = make_playwright()
+        pool = BrowserPool(max_pages=1, cdp_url='', playwright_factory=factory)
+        async with pool.page():
+            async with pool.page():
+                self.assertEqual(len(browsers), 2)
+                browsers[0].close.assert_not_called()
+            browsers[0].close.assert_not_called()
+        browsers[0].close.assert_called_once()
+        await pool.close()
+
+    async def test_replaces_crashed_browser(self):
+        factory, playwright, browsers = make_playwright()
+        pool = BrowserPool(cdp_url='', playwright_factory=factory)
+        with self.assertRaises(RuntimeError):
+            async with pool.page(viewport={'width': 1, 'height': 1}):
+                raise RuntimeError("Target crashed")
+        async with pool.page(viewport={'width': 1, 'height': 1}):
+            pass
+        await pool.close()
+
+        self.assertEqual(len(browsers), 2)
+        browsers[0].close.assert_called_once()
+        self.assertEqual(pool.stats()['crashes'], 1)
+
+    async def test_retries_page_open_after_crash(self):
+        factory, playwright, browsers = make_playwright()
+        pool = BrowserPool(cdp_url='', playwright_factory=factory)
+        async with pool.page(viewport={'width': 1, 'height': 1}):
+            pass
+        browsers[0].new_page.side_effect = Exception("Browser has been closed")
+        async with pool.page(viewport={'width': 1, 'height': 1}):
+            pass
+        await pool.close()
+
+        self.assertEqual(len(browsers), 2)
+        self.assertEqual(pool.stats()['crashes'], 1)
+
+    async def test_ordinary_errors_keep_browser(self):
+        factory, playwright, browsers = make_playwright()
+        pool = BrowserPool(cdp_url='', playwright_factory=factory)
+        with self.assertRaises(ValueError):
+            async with pool.page():
+                raise ValueError("bad selector")
+        async with pool.page():
+            pass
+        await pool.close()
+
+        self.assertEqual(len(browsers), 1)
+
+    async def test_connects_over_cdp(self):
+        factory, playwright, browsers = make_playwright()
+        pool = BrowserPool(cdp_url='http://127.0.0.1:9222', playwright_factory=factory)
+        async with pool.page():
+            pass
+        await pool.close()
+
+        playwright.chromium.connect_over_cdp.assert_called_once_with('http://127.0.0.1:9222')
+        playwright.chromium.launch.assert_not_called()
+        self.assertEqual(pool.stats()['connects'], 1)
+
+    async def test_falls_back_to_launch_when_server_unreachable(self):
+        factory, playwright, browsers = make_playwright(fail_connect=True)
+        pool = BrowserPool(cdp_url='http://127.0.0.1:9222', playwright_factory=factory)
+        with self.assertLogs('tools.browser_pool', level='WARNING'):
+            async with pool.page():
+                pass
+        async with pool.page():
+            pass
+        await pool.close()
+
+        playwright.chromium.connect_over_cdp.assert_called_once()
+        playwright.chromium.launch.assert_called_once_with(headless=True)
+
+    async def test_closed_pool_rejects_pages(self):
+        factory, playwright, browsers = make_playwright()
+        pool = BrowserPool(cdp_url='', playwright_factory=factory)
+        await pool.close()
+        with self.assertRaises(RuntimeError):
+            async with pool.page():
+                pass
+
+
+class TestBrowserPoolRegistry(unittest.TestCase):
+    def test_one_pool_per_event_loop(self):
+        factory, playwright, browsers = make_playwright()
+
+        async def run():
+            first = get_browser_pool(cdp_url='', playwright_factory=factory)
+            self.assertIs(get_browser_pool(), first)
+            async with first.page():
+                pass
+            await close_browser_pool()
+            self.assertTrue(first.closed)
+            self.assertIsNot(get_browser_pool(cdp_url='', playwright_factory=factory), first)
+            await close_browser_pool()
+            return first
+
+        first = asyncio.run(run())
+        second = asyncio.run(run())
+        self.assertIsNot(first, second)
+        self.assertEqual(len(browsers), 2)
+
+    def test_scope_closes_only_pools_it_opened(self):
+        factory, playwright, browsers = make_playwright()
+
+        async def run():
+            async with browser_pool_scope(cdp_url='', playwright_factory=factory) as pool:
+                async with pool.page():
+                    pass
+            self.assertTrue(pool.closed)
+            warm = get_browser_pool(cdp_url='', playwright_factory=factory)
+            async with browser_pool_scope() as pool:
+                self.assertIs(pool, warm)
+            self.assertFalse(warm.closed)
+            await close_browser_pool()
+
+        asyncio.run(run())
+        self.assertEqual(len(browsers), 1)
+        browsers[0].close.assert_awaited_once()
+
+
+class TestPageReuse(unittest.IsolatedAsyncioTestCase):
+    async def test_reuses_finished_pages(self):
+        factory, playwright, browsers = make_playwright()
+        pool = BrowserPool(contexts=1, cdp_url='', playwright_factory=factory)
+        async with pool.page(reuse=True) as first:
+            pass
+        async with pool.page(reuse=True) as second:
+            pass
+        await pool.close()
+
+        self.assertIs(first, second)
+        first.goto.assert_called_with('about:blank')
+        first.close.assert_not_called()
+        self.assertEqual(pool.stats()['reused'], 1)
+        self.assertEqual(pool.stats()['pages'], 2)
+
+    async def test_concurrent_users_get_distinct_pages(self):
+        factory, playwright, browsers = make_playwright()
+        pool = BrowserPool(cdp_url='', playwright_factory=factory)
+        async with pool.page(reuse=True) as first:
+            async with pool.page(reuse=True) as second:
+                self.assertIsNot(first, second)
+        async with pool.page(reuse=True) as third:
+            self.assertIn(third, (first, second))
+        await pool.close()
+
+    async def test_failed_pages_are_closed(self):
+        factory, playwright, browsers = make_playwright()
+        pool = BrowserPool(cdp_url='', playwright_factory=factory)
+        with self.assertRaises(ValueError):
+            async with pool.page(reuse=True) as first:
+                raise ValueError("navigation failed")
+        first.close.assert_called_once()
+        async with pool.page(reuse=True) as second:
+            pass
+        self.assertIsNot(first, second)
+        await pool.close()
+
+    async def test_unresettable_pages_are_closed(self):
+        factory, playwright, browsers = make_playwright()
+        pool = BrowserPool(cdp_url='', playwright_factory=factory)
+        async with pool.page(reuse=True) as first:
+            first.goto.side_effect = Exception("Target crashed")
+        first.close.assert_called_once()
+        self.assertEqual(pool.stats()['crashes'], 1)
+        await pool.close()
+
+    async def test_pages_are_not_reused_across_browsers(self):
+        factory, playwright, browsers = make_playwright()
+        pool = BrowserPool(max_pages=1, cdp_url='', playwright_factory=factory)
+        async with pool.page(reuse=True) as first:
+            pass
+        async with pool.page(reuse=True) as second:
+            pass
+        await pool.close()
+        self.assertIsNot(first, second)
+        self.assertEqual(len(browsers), 2)
+
+    async def test_options_disable_reuse(self):
+        factory, playwright, browsers = make_playwright()
+        pool = BrowserPool(cdp_url='', playwright_factory=factory)
+        async with pool.page(reuse=True, viewport={'width': 1, 'height': 1}) as page:
+            pass
+        page.close.assert_called_once()
+        await pool.close()
+
+
+class TestMemoryCeiling(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        patcher = patch('tools.browser_pool.MEMORY_SAMPLE_INTERVAL', 0.01)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_new_pages_wait_for_open_pages(self):
+        factory, playwright, browsers = make_playwright()
+        pool = BrowserPool(cdp_url='', playwright_factory=factory, max_memory_mb=500)
+        memory = {'mb': 100}
+        with patch('tools.browser_pool.browser_memory_mb', side_effect=lambda: memory['mb']):
+            events = []
+
+            async def hold():
+                async with pool.page():
+                    events.append('first open')
+                    memory['mb'] = 900
+                    await asyncio.sleep(0.1)
+                    memory['mb'] = 300
+                    events.append('first done')
+
+            async def follow():
+                await asyncio.sleep(0.02)
+                async with pool.page():
+                    events.append('second open')
+
+            await asyncio.gather(hold(), follow())
+        await pool.close()
+
+        self.assertEqual(events, ['first open', 'first done', 'second open'])
+        self.assertEqual(pool.stats()['throttled'], 1)
+        self.assertEqual(len(browsers), 1)
+
+    async def test_idle_browser_over_limit_is_restarted(self):
+        factory, playwright, browsers = make_playwright()
+        pool = BrowserPool(cdp_url='', playwright_factory=factory, max_memory_mb=500)
+        with patch('tools.browser_pool.browser_memory_mb', return_value=100):
+            for _ in range(2):
+                async with pool.page(reuse=True):
+                    pass
+        # Let the cached reading expire
+        await asyncio.sleep(0.02)
+        with patch('tools.browser_pool.browser_memory_mb', return_value=900):
+            with self.assertLogs('tools.browser_pool', level='INFO'):
+                async with pool.page(reuse=True):
+                    pass
+            # A fresh browser over the limit is not restarted again
+            async with pool.page(reuse=True):
+                pass
+        await pool.close()
+
+        self.assertEqual(len(browsers), 2)
+        browsers[0].close.assert_called_once()
+        self.assertEqual(pool.stats()['recycles'], 1)
+
+    async def test_no_limit_by_default(self):
+        factory, playwright, browsers = make_playwright()
+        with patch.dict('os.environ'):
+            os.environ.pop('BROWSER_POOL_MAX_MEMORY_MB', None)
+            pool = BrowserPool(cdp_url='', playwright_factory=factory)
+        with patch('tools.browser_pool.browser_memory_mb') as memory:
+            async with pool.page():
+                pass
+        memory.assert_not_called()
+        await pool.close()
+
+    def test_limit_from_environment(self):
+        with patch.dict('os.environ', {'BROWSER_POOL_MAX_MEMORY_MB': '1500'}):
+            self.assertEqual(BrowserPool(cdp_url='').max_memory_mb, 1500)
+
+
+class TestBrowserMemory(unittest.TestCase):
+    def test_counts_child_processes_except_python(self):
+        baseline = browser_memory_mb()
+        if baseline is None:
+            self.skipTest("No psutil or /proc on this platform")
+        python_child = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(5)'])
+        try:
+            time.sleep(0.3)
+            self.assertAlmostEqual(browser_memory_mb(), baseline, delta=1)
+            other_child = subprocess.Popen(['sleep', '5'])
+            try:
+                time.sleep(0.1)
+                self.assertGreater(browser_memory_mb(), baseline)
+            finally:
+                other_child.kill()
+                other_child.wait()
+        finally:
+            python_child.kill()
+            python_child.wait()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,36 @@
 import unittest
-from unittest.mock import patch, MagicMock, mock_open
-from tools.llm_api import create_llm_client, query_llm, load_environment
+from unittest.mock import patch, MagicMock, mock_open, AsyncMock
+from tools.llm_api import (
+    create_llm_client, query_llm, load_environment, ResponseCache, clear_shared_clients,
+    create_async_llm_client, aclose_shared_clients, aquery_llm, query_llm_batch, stream_llm, astream_llm,
+    RateLimiter, configure_rate_limit, get_rate_limiter, prepare_image, encode_image_file, RETRY_MAX_DELAY,
+    LatencyTracker, query_llm_with_failover, aquery_llm_with_failover,
+    add_call_hook, remove_call_hook, summarize_call_records, load_call_records,
+    create_daemon_server, query_daemon, write_daemon_token, SingleFlight, split_text, query_llm_chunked,
+    normalize_prompt, simhash, simhash_similarity, CachedResponse, embed
+)
+import socket
+import httpx
+import openai
+import urllib.request
+import base64
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
 import os
+import tempfile
 import google.generativeai as genai
 import io
 import sys
+import asyncio
+import json
+import threading
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
 def is_llm_configured():
     """Check if LLM is configured by trying to connect to the server"""
@@ -141,7 +167,7 @@ class TestLLMAPI(unittest.TestCase):
     def test_create_openai_client(self, mock_openai):
         mock_openai.return_value = self.mock_openai_client
         client = create_llm_client("openai")
-        mock_openai.assert_called_once_with(api_key='test-openai-key')
+        mock_openai.assert_called_once_with(api_key='test-openai-key', max_retries=0)
         self.assertEqual(client, self.mock_openai_client)
 
     @unittest.skipIf(skip_llm_tests, skip_message)
@@ -152,7 +178,8 @@ class TestLLMAPI(unittest.TestCase):
         mock_azure.assert_called_once_with(
             api_key='test-azure-key',
             api_version="2024-08-01-preview",
-            azure_endpoint="https://msopenai.openai.azure.com"
+            azure_endpoint="https://msopenai.openai.azure.com",
+            max_retries=0
         )
         self.assertEqual(client, self.mock_azure_client)
 
@@ -163,7 +190,8 @@ class TestLLMAPI(unittest.TestCase):
         client = create_llm_client("deepseek")
         mock_openai.assert_called_once_with(
             api_key='test-deepseek-key',
-            base_url="https://api.deepseek.com/v1"
+            base_url="https://api.deepseek.com/v1",
+            max_retries=0
         )
         self.assertEqual(client, self.mock_openai_client)
 
@@ -172,7 +200,7 @@ class TestLLMAPI(unittest.TestCase):
     def test_create_anthropic_client(self, mock_anthropic):
         mock_anthropic.return_value = self.mock_anthropic_client
         client = create_llm_client("anthropic")
-        mock_anthropic.assert_called_once_with(api_key='test-anthropic-key')
+        mock_anthropic.assert_called_once_with(api_key='test-anthropic-key', max_retries=0)
         self.assertEqual(client, self.mock_anthropic_client)
 
     @unittest.skipIf(skip_llm_tests, skip_message)
@@ -189,7 +217,8 @@ class TestLLMAPI(unittest.TestCase):
         client = create_llm_client("local")
         mock_openai.assert_called_once_with(
             base_url="http://192.168.180.137:8006/v1",
-            api_key="not-needed"
+            api_key="not-needed",
+            max_retries=0
         )
         self.assertEqual(client, self.mock_openai_client)
 
@@ -307,5 +336,1246 @@ class TestLLMAPI(unittest.TestCase):
         response = query_llm("Test prompt")
         self.assertIsNone(response)
 
+class TestAsyncLLMAPI(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.mock_openai_client = MagicMock()
+        self.mock_openai_client.chat.completions.create = AsyncMock()
+        self.mock_openai_client.chat.completions.create.return_value.choices[0].message.content = "Async OpenAI response"
+
+        self.mock_anthropic_client = MagicMock()
+        self.mock_anthropic_client.messages.create = AsyncMock()
+        self.mock_anthropic_client.messages.create.return_value.content[0].text = "Async Anthropic response"
+
+    @patch('tools.llm_api.AsyncOpenAI')
+    def test_create_async_openai_client(self, mock_async_openai):
+        with patch.dict('os.environ', {'OPENAI_API_KEY': 'test-openai-key'}):
+            client = create_async_llm_client("openai")
+        mock_async_openai.assert_called_once_with(api_key='test-openai-key', max_retries=0)
+        self.assertEqual(client, mock_async_openai.return_value)
+
+    @patch('tools.llm_api.AsyncAnthropic')
+    def test_create_async_anthropic_client(self, mock_async_anthropic):
+        with patch.dict('os.environ', {'ANTHROPIC_API_KEY': 'test-anthropic-key'}):
+            create_async_llm_client("anthropic")
+        mock_async_anthropic.assert_called_once_with(api_key='test-anthropic-key', max_retries=0)
+
+    @patch('tools.llm_api.AsyncOpenAI')
+    async def test_shared_async_client_per_loop(self, mock_async_openai):
+        with patch.dict('os.environ', {'OPENAI_API_KEY': 'test-openai-key'}):
+            client = create_async_llm_client("openai", shared=True)
+            self.assertIs(create_async_llm_client("openai", shared=True), client)
+        self.assertEqual(mock_async_openai.call_args[1]["max_retries"], 0)
+        mock_async_openai.return_value.close = AsyncMock()
+        await aclose_shared_clients()
+        mock_async_openai.return_value.close.assert_awaited_once()
+
+    @patch('tools.llm_api.AsyncOpenAI')
+    async def test_aquery_defaults_to_shared_client(self, mock_async_openai):
+        started = asyncio.Event()
+
+        async def create(**kwargs):
+            started.set()
+            await asyncio.sleep(0.01)
+            response = MagicMock()
+            response.choices[0].message.content = "Shared response"
+            return response
+
+        mock_async_openai.return_value.chat.completions.create = AsyncMock(side_effect=create)
+        with patch.dict('os.environ', {'OPENAI_API_KEY': 'test-openai-key'}):
+            responses = await asyncio.gather(aquery_llm("Test prompt"), aquery_llm("Test prompt"))
+            await aquery_llm("Other prompt")
+        self.assertEqual(responses, ["Shared response"] * 2)
+        mock_async_openai.assert_called_once()
+        # Identical concurrent prompts on the shared client are coalesced
+        self.assertEqual(mock_async_openai.return_value.chat.completions.create.await_count, 2)
+        await aclose_shared_clients()
+
+    async def test_aquery_openai(self):
+        response = await aquery_llm("Test prompt", client=self.mock_openai_client)
+        self.assertEqual(response, "Async OpenAI response")
+        self.mock_openai_client.chat.completions.create.assert_awaited_once_with(
+            model="gpt-4o",
+            messages=[{"role": "user", "content": [{"type": "text", "text": "Test prompt"}]}],
+            temperature=0.7
+        )
+
+    async def test_aquery_anthropic(self):
+        response = await aquery_llm("Test prompt", client=self.mock_anthropic_client, provider="anthropic")
+        self.assertEqual(response, "Async Anthropic response")
+        self.mock_anthropic_client.messages.create.assert_awaited_once_with(
+            model="claude-3-sonnet-20240229",
+            max_tokens=1000,
+            messages=[{"role": "user", "content": [{"type": "text", "text": "Test prompt"}]}]
+        )
+
+    async def test_aquery_gemini(self):
+        mock_genai = MagicMock()
+        mock_genai.GenerativeModel.return_value.generate_content_async = AsyncMock()
+        mock_genai.GenerativeModel.return_value.generate_content_async.return_value.text = "Async Gemini response"
+        response = await aquery_llm("Test prompt", client=mock_genai, provider="gemini")
+        self.assertEqual(response, "Async Gemini response")
+        mock_genai.GenerativeModel.assert_called_once_with("gemini-pro")
+
+    async def test_aquery_concurrent(self):
+        responses = await asyncio.gather(*[
+            aquery_llm(f"Prompt {i}", client=self.mock_openai_client) for i in range(10)
+        ])
+        self.assertEqual(responses, ["Async OpenAI response"] * 10)
+        self.assertEqual(self.mock_openai_client.chat.completions.create.await_count, 10)
+
+    async def test_aquery_error(self):
+        self.mock_openai_client.chat.completions.create.side_effect = Exception("Test error")
+        self.assertIsNone(await aquery_llm("Test prompt", client=self.mock_openai_client))
+
+class TestBatchQuery(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.output_path = os.path.join(self.temp_dir.name, 'results.jsonl')
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.prompts_sent = []
+
+        def create(**kwargs):
+            prompt = kwargs["messages"][0]["content"][0]["text"]
+            with self.lock:
+                self.in_flight += 1
+                self.max_in_flight = max(self.max_in_flight, self.in_flight)
+                self.prompts_sent.append(prompt)
+            # Later prompts finish first to exercise output ordering
+            time.sleep(0.002 * (10 - int(prompt.split()[-1])))
+            with self.lock:
+                self.in_flight -= 1
+            response = MagicMock()
+            response.choices[0].message.content = prompt.upper()
+            return response
+
+        self.mock_client = MagicMock()
+        self.mock_client.chat.completions.create.side_effect = create
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def read_output(self):
+        with open(self.output_path, encoding='utf-8') as f:
+            return [json.loads(line) for line in f]
+
+    def test_results_in_input_order(self):
+        prompts = [f"prompt {i}" for i in range(10)]
+        results = query_llm_batch(prompts, self.mock_client, max_concurrent=3, output_path=self.output_path)
+        self.assertEqual(results, [f"PROMPT {i}" for i in range(10)])
+        self.assertEqual([record["index"] for record in self.read_output()], list(range(10)))
+        self.assertLessEqual(self.max_in_flight, 3)
+
+    def test_dict_items_keep_ids(self):
+        prompts = [{"prompt": "prompt 1", "id": "a"}, {"prompt": "prompt 2", "id": "b"}]
+        query_llm_batch(prompts, self.mock_client, output_path=self.output_path)
+        self.assertEqual([record["id"] for record in self.read_output()], ["a", "b"])
+
+    def test_resume_skips_finished_prompts(self):
+        with open(self.output_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({"index": 0, "id": None, "response": "EARLIER 0"}) + "\n")
+            f.write('{"index": 1, "id": nu')  # partial line from an interrupted run
+        prompts = [f"prompt {i}" for i in range(4)]
+        results = query_llm_batch(prompts, self.mock_client, output_path=self.output_path)
+        self.assertEqual(results, ["EARLIER 0", "PROMPT 1", "PROMPT 2", "PROMPT 3"])
+        self.assertNotIn("prompt 0", self.prompts_sent)
+        self.assertEqual([record["index"] for record in self.read_output()], [0, 1, 2, 3])
+
+    def test_failed_prompts_recorded_as_none(self):
+        self.mock_client.chat.completions.create.side_effect = Exception("Test error")
+        results = query_llm_batch(["prompt 1"], self.mock_client, output_path=self.output_path)
+        self.assertEqual(results, [None])
+        self.assertIsNone(self.read_output()[0]["response"])
+
+    def test_resume_retries_failed_prompts(self):
+        with open(self.output_path, 'w', encoding='utf-8') as f:
+            for index, response in enumerate(["EARLIER 0", None, "EARLIER 2", None]):
+                f.write(json.dumps({"index": index, "id": None, "response": response}) + "\n")
+        prompts = [f"prompt {i}" for i in range(4)]
+        results = query_llm_batch(prompts, self.mock_client, output_path=self.output_path)
+        self.assertEqual(results, ["EARLIER 0", "PROMPT 1", "EARLIER 2", "PROMPT 3"])
+        self.assertEqual(sorted(self.prompts_sent), ["prompt 1", "prompt 3"])
+        # Retried records are appended and win when the file is read back
+        self.assertEqual([record["index"] for record in self.read_output()], [0, 1, 2, 3, 1, 3])
+        self.mock_client.chat.completions.create.reset_mock()
+        self.assertEqual(query_llm_batch(prompts, self.mock_client, output_path=self.output_path), results)
+        self.mock_client.chat.completions.create.assert_not_called()
+
+    def test_resume_can_keep_failures(self):
+        with open(self.output_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({"index": 0, "id": None, "response": None}) + "\n")
+        results = query_llm_batch(["prompt 0", "prompt 1"], self.mock_client, output_path=self.output_path,
+                                  retry_failed=False)
+        self.assertEqual(results, [None, "PROMPT 1"])
+        self.assertEqual(self.prompts_sent, ["prompt 1"])
+
+    def test_interrupt_stops_queued_prompts(self):
+        class InterruptingStream:
+            def write(self, line):
+                raise KeyboardInterrupt
+
+            def flush(self):
+                pass
+
+        prompts = [f"prompt {i % 10}" for i in range(40)]
+        with self.assertRaises(KeyboardInterrupt):
+            query_llm_batch(prompts, self.mock_client, max_concurrent=2, output_stream=InterruptingStream())
+        time.sleep(0.05)
+        self.assertLessEqual(len(self.prompts_sent), 4)
+
+def make_openai_chunk(content, usage=None):
+    chunk = MagicMock()
+    chunk.choices[0].delta.content = content
+    chunk.usage = usage
+    return chunk
+
+class TestStreaming(unittest.TestCase):
+    def test_stream_openai(self):
+        usage = MagicMock(completion_tokens=3)
+        mock_client = MagicMock()
+        mock_client.chat.completions.create.return_value = iter([
+            make_openai_chunk("Hel"), make_openai_chunk("lo"), make_openai_chunk(None, usage=usage)
+        ])
+        stats = {}
+        deltas = list(stream_llm("Test prompt", client=mock_client, stats=stats))
+        self.assertEqual(deltas, ["Hel", "lo"])
+        mock_client.chat.completions.create.assert_called_once_with(
+            model="gpt-4o",
+            messages=[{"role": "user", "content": [{"type": "text", "text": "Test prompt"}]}],
+            temperature=0.7,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        self.assertEqual(stats["completion_tokens"], 3)
+        self.assertIsNotNone(stats["time_to_first_token"])
+        self.assertGreaterEqual(stats["total_time"], stats["time_to_first_token"])
+
+    def test_stream_anthropic(self):
+        mock_stream = MagicMock()
+        mock_stream.text_stream = iter(["Hi", " there"])
+        mock_stream.get_final_message.return_value.usage.output_tokens = 2
+        mock_client = MagicMock()
+        mock_client.messages.stream.return_value.__enter__.return_value = mock_stream
+        stats = {}
+        deltas = list(stream_llm("Test prompt", client=mock_client, provider="anthropic", stats=stats))
+        self.assertEqual(deltas, ["Hi", " there"])
+        self.assertEqual(stats["completion_tokens"], 2)
+
+    def test_stream_gemini(self):
+        chunks = [MagicMock(text="Gem"), MagicMock(text="ini")]
+        mock_genai = MagicMock()
+        mock_genai.GenerativeModel.return_value.generate_content.return_value = iter(chunks)
+        deltas = list(stream_llm("Test prompt", client=mock_genai, provider="gemini"))
+        self.assertEqual(deltas, ["Gem", "ini"])
+        mock_genai.GenerativeModel.return_value.generate_content.assert_called_once_with("Test prompt", stream=True)
+
+    def test_stream_uses_cache(self):
+        mock_client = MagicMock()
+        mock_client.chat.completions.create.return_value = iter([make_openai_chunk("Cached")])
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cache = ResponseCache(temp_dir)
+            self.assertEqual(list(stream_llm("Test prompt", client=mock_client, cache=cache)), ["Cached"])
+            self.assertEqual(list(stream_llm("Test prompt", client=mock_client, cache=cache)), ["Cached"])
+        mock_client.chat.completions.create.assert_called_once()
+
+    def test_stream_error(self):
+        mock_client = MagicMock()
+        mock_client.chat.completions.create.side_effect = Exception("Test error")
+        stats = {}
+        self.assertEqual(list(stream_llm("Test prompt", client=mock_client, stats=stats)), [])
+        self.assertEqual(stats["error"], "Test error")
+
+class TestAsyncStreaming(unittest.IsolatedAsyncioTestCase):
+    async def test_astream_openai(self):
+        async def chunks():
+            for content in ["As", "ync"]:
+                yield make_openai_chunk(content)
+
+        mock_client = MagicMock()
+        mock_client.chat.completions.create = AsyncMock(return_value=chunks())
+        stats = {}
+        deltas = [delta async for delta in astream_llm("Test prompt", client=mock_client, stats=stats)]
+        self.assertEqual(deltas, ["As", "ync"])
+        self.assertIn("tokens_per_second", stats)
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+class ProviderError(Exception):
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+        self.response = MagicMock(headers=headers or {})
+
+class TestRateLimiting(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.patchers = [
+            patch('tools.llm_api.time.monotonic', side_effect=self.clock.monotonic),
+            patch('tools.llm_api.time.sleep', side_effect=self.clock.sleep),
+        ]
+        for patcher in self.patchers:
+            patcher.start()
+        configure_rate_limit("openai")
+
+        self.mock_client = MagicMock()
+        self.mock_response = MagicMock()
+        self.mock_response.choices[0].message.content = "Test response"
+
+    def tearDown(self):
+        for patcher in self.patchers:
+            patcher.stop()
+        configure_rate_limit("openai")
+
+    def test_requests_per_minute(self):
+        limiter = RateLimiter(requests_per_minute=60)
+        for _ in range(60):
+            limiter.acquire()
+        self.assertEqual(self.clock.sleeps, [])
+        limiter.acquire()
+        self.assertAlmostEqual(sum(self.clock.sleeps), 1.0)
+        self.assertAlmostEqual(limiter.stats()["throttled_seconds"], 1.0)
+        self.assertEqual(limiter.stats()["throttled_calls"], 1)
+
+    def test_tokens_per_minute(self):
+        limiter = RateLimiter(tokens_per_minute=600)
+        limiter.acquire(tokens=600)
+        limiter.acquire(tokens=100)
+        self.assertAlmostEqual(sum(self.clock.sleeps), 10.0)
+
+    def test_retry_honours_retry_after(self):
+        self.mock_client.chat.completions.create.side_effect = [
+            ProviderError(429, {'retry-after': '2'}), self.mock_response
+        ]
+        self.assertEqual(query_llm("Test prompt", client=self.mock_client), "Test response")
+        self.assertEqual(self.clock.sleeps, [2.0])
+        self.assertEqual(get_rate_limiter("openai").stats()["retries"], 1)
+
+    def test_retry_uses_exponential_backoff(self):
+        self.mock_client.chat.completions.create.side_effect = [
+            ProviderError(503), ProviderError(529), self.mock_response
+        ]
+        self.assertEqual(query_llm("Test prompt", client=self.mock_client), "Test response")
+        self.assertEqual(len(self.clock.sleeps), 2)
+        self.assertTrue(0.5 <= self.clock.sleeps[0] <= 1.0)
+        self.assertTrue(1.0 <= self.clock.sleeps[1] <= 2.0)
+
+    @patch('tools.llm_api.MAX_RETRIES', 3)
+    def test_retries_exhausted(self):
+        self.mock_client.chat.completions.create.side_effect = ProviderError(429)
+        self.assertIsNone(query_llm("Test prompt", client=self.mock_client))
+        self.assertEqual(self.mock_client.chat.completions.create.call_count, 4)
+
+    def test_retry_after_is_capped(self):
+        self.mock_client.chat.completions.create.side_effect = [
+            ProviderError(429, {'retry-after': '7200'}), self.mock_response
+        ]
+        self.assertEqual(query_llm("Test prompt", client=self.mock_client), "Test response")
+        self.assertEqual(self.clock.sleeps, [RETRY_MAX_DELAY])
+
+    def test_sdk_retries_disabled_on_caller_clients(self):
+        client = MagicMock(max_retries=2)
+        client.with_options.return_value.chat.completions.create.return_value = self.mock_response
+        self.assertEqual(query_llm("Test prompt", client=client), "Test response")
+        client.with_options.assert_called_once_with(max_retries=0)
+        client.chat.completions.create.assert_not_called()
+
+    def test_anthropic_stream_retries_throttling(self):
+        stream = MagicMock()
+        stream.text_stream = iter(["Hi"])
+        manager = MagicMock()
+        manager.__enter__.side_effect = [ProviderError(429, {'retry-after': '1'}), stream]
+        client = MagicMock()
+        client.messages.stream.return_value = manager
+        self.assertEqual(list(stream_llm("Test prompt", client=client, provider="anthropic")), ["Hi"])
+        self.assertEqual(self.clock.sleeps, [1.0])
+        manager.__exit__.assert_called_once()
+
+    def test_gemini_stream_retries_throttling(self):
+        genai_client = MagicMock()
+        genai_client.GenerativeModel.return_value.generate_content.side_effect = [
+            ProviderError(429), iter([MagicMock(text="Gem")])
+        ]
+        self.assertEqual(list(stream_llm("Test prompt", client=genai_client, provider="gemini")), ["Gem"])
+        self.assertEqual(len(self.clock.sleeps), 1)
+
+    def test_client_errors_not_retried(self):
+        self.mock_client.chat.completions.create.side_effect = ProviderError(400)
+        self.assertIsNone(query_llm("Test prompt", client=self.mock_client))
+        self.mock_client.chat.completions.create.assert_called_once()
+
+    def test_refused_connections_fail_at_once(self):
+        def connection_error(cause):
+            error = openai.APIConnectionError(request=httpx.Request("POST", "http://localhost:8000/v1"))
+            error.__cause__ = httpx.ConnectError("refused")
+            error.__cause__.__context__ = cause
+            return error
+
+        self.mock_client.chat.completions.create.side_effect = connection_error(ConnectionRefusedError(111, "refused"))
+        self.assertIsNone(query_llm("Test prompt", client=self.mock_client))
+        self.mock_client.chat.completions.create.assert_called_once()
+        self.assertEqual(self.clock.sleeps, [])
+        # Dropped connections and timeouts are still retried
+        self.mock_client.chat.completions.create.reset_mock()
+        self.mock_client.chat.completions.create.side_effect = [
+            connection_error(ConnectionResetError(104, "reset")), openai.APITimeoutError(httpx.Request("POST", "http://x")),
+            self.mock_response
+        ]
+        self.assertEqual(query_llm("Test prompt", client=self.mock_client), "Test response")
+        self.assertEqual(len(self.clock.sleeps), 2)
+
+class TestImagePreparation(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def save_image(self, name, size, mode='RGB'):
+        path = os.path.join(self.temp_dir.name, name)
+        Image.new(mode, size, 'white').save(path)
+        return path
+
+    def decode(self, payload):
+        return Image.open(io.BytesIO(base64.b64decode(payload[0])))
+
+    @unittest.skipIf(Image is None, "Pillow is not installed")
+    def test_tall_screenshot_is_tiled_and_downscaled(self):
+        path = self.save_image('tall.png', (1280, 12000))
+        payloads = prepare_image(path, "anthropic")
+        self.assertEqual(len(payloads), 4)
+        for payload in payloads:
+            self.assertEqual(payload[1], 'image/jpeg')
+            tile = self.decode(payload)
+            self.assertLessEqual(max(tile.size), 1568)
+            self.assertLessEqual(tile.width * tile.height, 1_150_000)
+
+    @unittest.skipIf(Image is None, "Pillow is not installed")
+    def test_openai_short_edge_limit(self):
+        path = self.save_image('wide.png', (4000, 3000))
+        payloads = prepare_image(path, "openai")
+        self.assertEqual(len(payloads), 1)
+        self.assertEqual(self.decode(payloads[0]).size, (1024, 768))
+
+    @unittest.skipIf(Image is None, "Pillow is not installed")
+    def test_transparent_image_stays_png(self):
+        path = os.path.join(self.temp_dir.name, 'alpha.png')
+        Image.new('RGBA', (3000, 1000), (0, 0, 0, 0)).save(path)
+        payloads = prepare_image(path, "anthropic")
+        self.assertEqual(payloads[0][1], 'image/png')
+
+    @unittest.skipIf(Image is None, "Pillow is not installed")
+    def test_small_image_sent_unchanged(self):
+        path = self.save_image('small.png', (10, 10))
+        self.assertEqual(prepare_image(path, "openai"), [encode_image_file(path)])
+
+    def test_non_image_falls_back_to_raw_encoding(self):
+        path = os.path.join(self.temp_dir.name, 'fake.png')
+        with open(path, 'wb') as f:
+            f.write(b'fake_screenshot_data')
+        self.assertEqual(prepare_image(path, "openai"), [encode_image_file(path)])
+
+    @unittest.skipIf(Image is None, "Pillow is not installed")
+    def test_payloads_cached_by_content(self):
+        path = self.save_image('cached.png', (3000, 3000))
+        first = prepare_image(path, "openai")
+        with patch('tools.llm_api._encode_image_tiles') as mock_encode:
+            self.assertIs(prepare_image(path, "openai"), first)
+            mock_encode.assert_not_called()
+
+    @unittest.skipIf(Image is None, "Pillow is not installed")
+    def test_query_attaches_every_tile(self):
+        path = self.save_image('tiles.png', (1000, 6000))
+        mock_client = MagicMock()
+        query_llm("Describe", client=mock_client, provider="anthropic", image_path=path)
+        content = mock_client.messages.create.call_args[1]["messages"][0]["content"]
+        self.assertEqual([block["type"] for block in content], ["text", "image", "image", "image"])
+
+def make_openai_client(content=None, error=None, delay=0):
+    def create(**kwargs):
+        time.sleep(delay)
+        if error:
+            raise error
+        response = MagicMock()
+        response.choices[0].message.content = content
+        return response
+
+    client = MagicMock()
+    client.chat.completions.create.side_effect = create
+    return client
+
+class TestFailover(unittest.TestCase):
+    def setUp(self):
+        self.clients = {}
+        self.patcher = patch('tools.llm_api.create_llm_client',
+                             side_effect=lambda provider, shared=False: self.clients[provider])
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def test_fails_over_in_order(self):
+        self.clients = {
+            "openai": make_openai_client(error=ProviderError(400)),
+            "deepseek": make_openai_client(error=ProviderError(401)),
+            "local": make_openai_client("Local response"),
+        }
+        response = query_llm_with_failover("Test prompt", ["openai", "deepseek", "local:qwen"])
+        self.assertEqual(response, "Local response")
+        self.assertEqual(self.clients["local"].chat.completions.create.call_args[1]["model"], "qwen")
+
+    def test_all_targets_fail(self):
+        self.clients = {"openai": make_openai_client(error=ProviderError(400))}
+        self.assertIsNone(query_llm_with_failover("Test prompt", ["openai"]))
+
+    def test_hedges_slow_primary(self):
+        self.clients = {
+            "openai": make_openai_client("Slow response", delay=1.0),
+            "deepseek": make_openai_client("Fast response"),
+        }
+        start = time.perf_counter()
+        response = query_llm_with_failover("Test prompt", ["openai", "deepseek"], hedge=True, hedge_delay=0.05)
+        self.assertEqual(response, "Fast response")
+        self.assertLess(time.perf_counter() - start, 0.9)
+
+    def test_slow_loser_does_not_delay_exit(self):
+        script = (
+            "import time\n"
+            "from unittest.mock import patch\n"
+            "from tools import llm_api\n"
+            "def complete(prompt, client, model, provider, *args):\n"
+            "    time.sleep(5 if provider == 'openai' else 0)\n"
+            "    return provider\n"
+            "with patch('tools.llm_api.create_llm_client'), patch('tools.llm_api._complete', complete):\n"
+            "    print(llm_api.query_llm_with_failover('p', ['openai', 'deepseek'], hedge=True, hedge_delay=0.05))\n"
+        )
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, timeout=30,
+                                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.assertEqual(result.stdout.strip(), "deepseek")
+        self.assertLess(time.perf_counter() - start, 4)
+
+    def test_no_hedge_when_primary_is_fast(self):
+        self.clients = {
+            "openai": make_openai_client("Primary response"),
+            "deepseek": make_openai_client("Backup response"),
+        }
+        response = query_llm_with_failover("Test prompt", ["openai", "deepseek"], hedge=True, hedge_delay=1.0)
+        self.assertEqual(response, "Primary response")
+        self.clients["deepseek"].chat.completions.create.assert_not_called()
+
+    def test_latency_percentile(self):
+        tracker = LatencyTracker(min_samples=5)
+        for seconds in range(1, 5):
+            tracker.record("openai", "gpt-4o", seconds)
+        self.assertIsNone(tracker.percentile("openai", "gpt-4o", 0.95))
+        for seconds in range(5, 101):
+            tracker.record("openai", "gpt-4o", seconds)
+        self.assertEqual(tracker.percentile("openai", "gpt-4o", 0.95), 96)
+
+class TestAsyncFailover(unittest.IsolatedAsyncioTestCase):
+    async def test_hedge_cancels_slow_primary(self):
+        cancelled = asyncio.Event()
+
+        async def slow_create(**kwargs):
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        slow_client = MagicMock()
+        slow_client.chat.completions.create = slow_create
+        fast_client = MagicMock()
+        fast_client.chat.completions.create = AsyncMock()
+        fast_client.chat.completions.create.return_value.choices[0].message.content = "Fast response"
+
+        response = await aquery_llm_with_failover(
+            "Test prompt", ["openai", "deepseek"], hedge=True, hedge_delay=0.01,
+            clients={"openai": slow_client, "deepseek": fast_client}
+        )
+        self.assertEqual(response, "Fast response")
+        await asyncio.wait_for(cancelled.wait(), timeout=1)
+
+class TestCallInstrumentation(unittest.TestCase):
+    def setUp(self):
+        self.records = []
+        add_call_hook(self.records.append)
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.mock_client = MagicMock()
+        self.mock_response = MagicMock()
+        self.mock_response.choices[0].message.content = "Test response"
+        self.mock_response.usage.prompt_tokens = 12
+        self.mock_response.usage.completion_tokens = 34
+        self.mock_client.chat.completions.create.return_value = self.mock_response
+
+    def tearDown(self):
+        remove_call_hook(self.records.append)
+        self.temp_dir.cleanup()
+
+    def test_record_for_successful_call(self):
+        query_llm("Test prompt", client=self.mock_client)
+        record = self.records[-1]
+        self.assertEqual((record["provider"], record["model"]), ("openai", "gpt-4o"))
+        self.assertEqual((record["prompt_tokens"], record["completion_tokens"]), (12, 34))
+        self.assertIsNone(record["error"])
+        self.assertFalse(record["cache_hit"])
+        self.assertGreaterEqual(record["wall_time"], 0)
+
+    def test_record_for_anthropic_usage(self):
+        mock_client = MagicMock()
+        mock_client.messages.create.return_value.content[0].text = "Test response"
+        mock_client.messages.create.return_value.usage.input_tokens = 7
+        mock_client.messages.create.return_value.usage.output_tokens = 8
+        query_llm("Test prompt", client=mock_client, provider="anthropic")
+        self.assertEqual((self.records[-1]["prompt_tokens"], self.records[-1]["completion_tokens"]), (7, 8))
+
+    def test_record_counts_retries(self):
+        self.mock_client.chat.completions.create.side_effect = [ProviderError(429, {'retry-after': '0'}),
+                                                                self.mock_response]
+        query_llm("Test prompt", client=self.mock_client)
+        self.assertEqual(self.records[-1]["retries"], 1)
+
+    def test_record_for_failed_call(self):
+        self.mock_client.chat.completions.create.side_effect = Exception("Test error")
+        query_llm("Test prompt", client=self.mock_client)
+        self.assertEqual(self.records[-1]["error"], "Test error")
+
+    def test_record_for_cache_hit(self):
+        cache = ResponseCache(self.temp_dir.name)
+        query_llm("Test prompt", client=self.mock_client, cache=cache)
+        query_llm("Test prompt", client=self.mock_client, cache=cache)
+        self.assertEqual([record["cache_hit"] for record in self.records], [False, True])
+
+    def test_stats_file_sink(self):
+        stats_file = os.path.join(self.temp_dir.name, 'calls.jsonl')
+        with patch.dict('os.environ', {'LLM_STATS_FILE': stats_file}):
+            query_llm("Test prompt", client=self.mock_client)
+            query_llm("Test prompt", client=self.mock_client)
+        records = load_call_records(stats_file)
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0]["completion_tokens"], 34)
+
+    def test_summarize_call_records(self):
+        records = [
+            {"provider": "openai", "model": "gpt-4o", "wall_time": float(i), "error": None, "cache_hit": False,
+             "retries": 0, "prompt_tokens": 10, "completion_tokens": 10}
+            for i in range(1, 101)
+        ]
+        records.append({"provider": "openai", "model": "gpt-4o", "wall_time": 0.001, "error": None,
+                        "cache_hit": True, "retries": 0, "prompt_tokens": None, "completion_tokens": None})
+        summary = summarize_call_records(records)[("openai", "gpt-4o")]
+        self.assertEqual(summary["calls"], 101)
+        self.assertEqual(summary["cache_hits"], 1)
+        self.assertEqual((summary["p50"], summary["p95"], summary["p99"]), (51.0, 96.0, 100.0))
+        self.assertAlmostEqual(summary["tokens_per_second"], 1000 / 5050)
+
+class TestStartupTime(unittest.TestCase):
+    # Seconds allowed for `python -m tools.llm_api --help`; override on slow machines
+    startup_budget = float(os.getenv('LLM_API_STARTUP_BUDGET', '1.0'))
+
+    def run_python(self, *args):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        return subprocess.run([sys.executable, *args], cwd=root, capture_output=True, text=True, timeout=60)
+
+    def test_import_does_not_load_provider_sdks(self):
+        result = self.run_python('-c', (
+            "import sys, tools.llm_api; "
+            "print(','.join(m for m in ('openai', 'anthropic', 'google.generativeai') if m in sys.modules))"
+        ))
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.strip(), '')
+
+    def test_help_startup_budget(self):
+        # Best of three runs to smooth out cold filesystem caches
+        timings = []
+        for _ in range(3):
+            start = time.perf_counter()
+            result = self.run_python('-m', 'tools.llm_api', '--help')
+            timings.append(time.perf_counter() - start)
+            self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertLess(min(timings), self.startup_budget)
+
+class TestSharedClientRegistry(unittest.TestCase):
+    def setUp(self):
+        clear_shared_clients()
+        self.env_patcher = patch.dict('os.environ', {'OPENAI_API_KEY': 'key-one'})
+        self.env_patcher.start()
+        self.http_patcher = patch('tools.llm_api._pooled_http_client')
+        self.mock_http_client = self.http_patcher.start()
+
+    def tearDown(self):
+        clear_shared_clients()
+        self.http_patcher.stop()
+        self.env_patcher.stop()
+
+    @patch('tools.llm_api.OpenAI')
+    def test_shared_client_is_reused(self, mock_openai):
+        mock_openai.side_effect = lambda **kwargs: MagicMock()
+        first = create_llm_client("openai", shared=True)
+        second = create_llm_client("openai", shared=True)
+        self.assertIs(first, second)
+        mock_openai.assert_called_once_with(api_key='key-one', http_client=self.mock_http_client.return_value,
+                                            max_retries=0)
+        self.assertIsNot(create_llm_client("openai"), first)
+
+    @patch('tools.llm_api.OpenAI')
+    def test_registry_keyed_by_api_key(self, mock_openai):
+        mock_openai.side_effect = lambda **kwargs: MagicMock()
+        first = create_llm_client("openai", shared=True)
+        with patch.dict('os.environ', {'OPENAI_API_KEY': 'key-two'}):
+            second = create_llm_client("openai", shared=True)
+        self.assertIsNot(first, second)
+
+    @patch('tools.llm_api.OpenAI')
+    def test_query_without_client_uses_registry(self, mock_openai):
+        mock_client = MagicMock()
+        mock_client.chat.completions.create.return_value.choices[0].message.content = "Shared response"
+        mock_openai.return_value = mock_client
+        self.assertEqual(query_llm("Test prompt"), "Shared response")
+        self.assertEqual(query_llm("Test prompt"), "Shared response")
+        mock_openai.assert_called_once()
+        self.assertEqual(mock_client.chat.completions.create.call_count, 2)
+
+class TestSingleFlight(unittest.TestCase):
+    def setUp(self):
+        self.release = threading.Event()
+        self.mock_client = MagicMock()
+
+        def slow_create(**kwargs):
+            self.release.wait(5)
+            response = MagicMock()
+            response.choices[0].message.content = "Shared response"
+            return response
+        self.mock_client.chat.completions.create.side_effect = slow_create
+
+    def run_concurrently(self, count, **kwargs):
+        results = [None] * count
+        def worker(i):
+            results[i] = query_llm("Same prompt", client=self.mock_client, **kwargs)
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.2)
+        self.release.set()
+        for thread in threads:
+            thread.join(5)
+        return results
+
+    def test_identical_requests_are_coalesced(self):
+        self.assertEqual(self.run_concurrently(5), ["Shared response"] * 5)
+        self.mock_client.chat.completions.create.assert_called_once()
+
+    def test_coalescing_can_be_disabled(self):
+        self.assertEqual(self.run_concurrently(3, coalesce=False), ["Shared response"] * 3)
+        self.assertEqual(self.mock_client.chat.completions.create.call_count, 3)
+
+    def test_distinct_prompts_are_not_coalesced(self):
+        self.release.set()
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            list(executor.map(lambda i: query_llm(f"Prompt {i}", client=self.mock_client), range(3)))
+        self.assertEqual(self.mock_client.chat.completions.create.call_count, 3)
+
+    def test_waiters_receive_leader_error(self):
+        flight = SingleFlight()
+        started = threading.Event()
+        errors = []
+
+        def failing():
+            started.set()
+            time.sleep(0.2)
+            raise ValueError("upstream failed")
+
+        def call():
+            try:
+                flight.do("key", failing)
+            except ValueError as e:
+                errors.append(str(e))
+        leader = threading.Thread(target=call)
+        leader.start()
+        started.wait(5)
+        follower = threading.Thread(target=call)
+        follower.start()
+        leader.join(5)
+        follower.join(5)
+        self.assertEqual(errors, ["upstream failed"] * 2)
+        self.assertEqual(flight.coalesced, 1)
+
+    def test_process_lock_shares_cached_response(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            # Separate cache instances stand in for separate processes sharing the directory
+            caches = [ResponseCache(temp_dir, process_lock=True) for _ in range(2)]
+            results = [None, None]
+            def worker(i):
+                results[i] = query_llm("Same prompt", client=self.mock_client, cache=caches[i], coalesce=False)
+            threads = [threading.Thread(target=worker, args=(i,)) for i in range(2)]
+            for thread in threads:
+                thread.start()
+            time.sleep(0.2)
+            self.release.set()
+            for thread in threads:
+                thread.join(5)
+            self.assertEqual(results, ["Shared response"] * 2)
+            self.mock_client.chat.completions.create.assert_called_once()
+            self.assertEqual(list(Path(temp_dir, 'locks').iterdir()), [])
+
+class TestAsyncSingleFlight(unittest.IsolatedAsyncioTestCase):
+    async def test_identical_requests_are_coalesced(self):
+        mock_client = MagicMock()
+        async def slow_create(**kwargs):
+            await asyncio.sleep(0.1)
+            response = MagicMock()
+            response.choices[0].message.content = "Shared response"
+            return response
+        mock_client.chat.completions.create = AsyncMock(side_effect=slow_create)
+        responses = await asyncio.gather(*[aquery_llm("Same prompt", client=mock_client) for _ in range(5)])
+        self.assertEqual(responses, ["Shared response"] * 5)
+        self.assertEqual(mock_client.chat.completions.create.await_count, 1)
+
+    async def test_cancelled_waiter_does_not_cancel_shared_call(self):
+        mock_client = MagicMock()
+        async def slow_create(**kwargs):
+            await asyncio.sleep(0.1)
+            response = MagicMock()
+            response.choices[0].message.content = "Shared response"
+            return response
+        mock_client.chat.completions.create = AsyncMock(side_effect=slow_create)
+        first = asyncio.create_task(aquery_llm("Same prompt", client=mock_client))
+        second = asyncio.create_task(aquery_llm("Same prompt", client=mock_client))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        self.assertEqual(await second, "Shared response")
+        self.assertEqual(mock_client.chat.completions.create.await_count, 1)
+
+class TestChunkedQuery(unittest.TestCase):
+    def setUp(self):
+        self.mock_client = MagicMock()
+        self.prompts = []
+        lock = threading.Lock()
+
+        def create(**kwargs):
+            prompt = kwargs["messages"][0]["content"][0]["text"]
+            with lock:
+                self.prompts.append(prompt)
+            response = MagicMock()
+            # Long enough that only a few partial results fit into one chunk
+            response.choices[0].message.content = f"summary{len(prompt)} " + "x" * 150
+            return response
+        self.mock_client.chat.completions.create.side_effect = create
+
+    def test_split_short_text(self):
+        self.assertEqual(split_text("Short text.", chunk_tokens=100, overlap_tokens=10), ["Short text."])
+
+    def test_split_prefers_paragraph_boundaries(self):
+        paragraphs = [f"Paragraph {i} " + "word " * 30 for i in range(10)]
+        chunks = split_text("\n\n".join(paragraphs), chunk_tokens=100, overlap_tokens=0)
+        self.assertGreater(len(chunks), 1)
+        for chunk in chunks:
+            self.assertTrue(chunk.startswith("Paragraph"))
+            self.assertLessEqual(len(chunk), 400)
+        self.assertEqual("".join(chunks).count("Paragraph"), len(paragraphs))
+
+    def test_split_overlap(self):
+        text = " ".join(f"w{i}" for i in range(500))
+        chunks = split_text(text, chunk_tokens=50, overlap_tokens=10)
+        for first, second in zip(chunks, chunks[1:]):
+            self.assertIn(second.split()[0], first.split())
+        self.assertEqual(chunks[-1].split()[-1], "w499")
+
+    def test_split_invalid_sizes(self):
+        with self.assertRaises(ValueError):
+            split_text("text", chunk_tokens=10, overlap_tokens=10)
+
+    def test_single_chunk_uses_map_prompt_only(self):
+        result = query_llm_chunked("Short text", "Summarize: {text}", "Merge: {text}", self.mock_client)
+        self.assertEqual(self.prompts, ["Summarize: Short text"])
+        self.assertTrue(result.startswith(f"summary{len('Summarize: Short text')} "))
+
+    def test_map_then_hierarchical_reduce(self):
+        text = "\n\n".join(f"Paragraph {i} " + "word " * 30 for i in range(40))
+        result = query_llm_chunked(text, "Summarize: {text}", "Merge: {text}", self.mock_client,
+                                   chunk_tokens=100, overlap_tokens=0, max_concurrent=8)
+        map_prompts = [p for p in self.prompts if p.startswith("Summarize: ")]
+        reduce_prompts = [p for p in self.prompts if p.startswith("Merge: ")]
+        self.assertEqual(len(map_prompts), len(split_text(text, 100, 0)))
+        # Forty partial results do not fit into one chunk, so merging takes several rounds
+        self.assertGreater(len(reduce_prompts), 1)
+        self.assertTrue(result.startswith(f"summary{len(self.prompts[-1])} "))
+
+    def test_failed_chunk_fails_whole_query(self):
+        self.mock_client.chat.completions.create.side_effect = Exception("Test error")
+        self.assertIsNone(query_llm_chunked("word " * 500, "Summarize: {text}", client=self.mock_client,
+                                            chunk_tokens=100, overlap_tokens=0))
+
+    def test_templates_need_placeholder(self):
+        with self.assertRaises(ValueError):
+            query_llm_chunked("text", "Summarize this", client=self.mock_client)
+
+class TestSystemPrompt(unittest.TestCase):
+    def setUp(self):
+        self.records = []
+        add_call_hook(self.records.append)
+
+    def tearDown(self):
+        remove_call_hook(self.records.append)
+
+    def test_anthropic_system_prompt_is_cached(self):
+        mock_client = MagicMock()
+        mock_client.messages.create.return_value.content = [MagicMock(text="Anthropic response")]
+        mock_client.messages.create.return_value.usage.input_tokens = 10
+        mock_client.messages.create.return_value.usage.output_tokens = 5
+        mock_client.messages.create.return_value.usage.cache_read_input_tokens = 2048
+        response = query_llm("Test prompt", client=mock_client, provider="anthropic",
+                             system_prompt="Static rules", max_tokens=4000)
+        self.assertEqual(response, "Anthropic response")
+        mock_client.messages.create.assert_called_once_with(
+            model="claude-3-sonnet-20240229",
+            max_tokens=4000,
+            messages=[{"role": "user", "content": [{"type": "text", "text": "Test prompt"}]}],
+            system=[{"type": "text", "text": "Static rules", "cache_control": {"type": "ephemeral"}}]
+        )
+        self.assertEqual(self.records[-1]["cached_prompt_tokens"], 2048)
+
+    def test_openai_system_message_first(self):
+        mock_client = MagicMock()
+        mock_client.chat.completions.create.return_value.choices[0].message.content = "OpenAI response"
+        mock_client.chat.completions.create.return_value.usage.prompt_tokens_details.cached_tokens = 1024
+        query_llm("Test prompt", client=mock_client, system_prompt="Static rules", max_tokens=200)
+        mock_client.chat.completions.create.assert_called_once_with(
+            model="gpt-4o",
+            messages=[
+                {"role": "system", "content": "Static rules"},
+                {"role": "user", "content": [{"type": "text", "text": "Test prompt"}]},
+            ],
+            temperature=0.7,
+            max_tokens=200
+        )
+        self.assertEqual(self.records[-1]["cached_prompt_tokens"], 1024)
+
+    def test_o1_uses_max_completion_tokens(self):
+        mock_client = MagicMock()
+        mock_client.chat.completions.create.return_value.choices[0].message.content = "o1 response"
+        query_llm("Test prompt", client=mock_client, model="o1", max_tokens=200)
+        kwargs = mock_client.chat.completions.create.call_args.kwargs
+        self.assertEqual(kwargs["max_completion_tokens"], 200)
+        self.assertNotIn("max_tokens", kwargs)
+
+    def test_gemini_system_instruction(self):
+        mock_genai = MagicMock()
+        mock_genai.GenerativeModel.return_value.generate_content.return_value.text = "Gemini response"
+        query_llm("Test prompt", client=mock_genai, provider="gemini", system_prompt="Static rules",
+                  max_tokens=300)
+        mock_genai.GenerativeModel.assert_called_once_with("gemini-pro", system_instruction="Static rules")
+        mock_genai.GenerativeModel.return_value.generate_content.assert_called_once_with(
+            "Test prompt", generation_config={"max_output_tokens": 300})
+
+    def test_cache_key_includes_system_prompt_and_max_tokens(self):
+        key = ResponseCache.make_key("openai", "gpt-4o", "prompt", 0.7)
+        self.assertEqual(key, ResponseCache.make_key("openai", "gpt-4o", "prompt", 0.7, None, None, None))
+        self.assertNotEqual(key, ResponseCache.make_key("openai", "gpt-4o", "prompt", 0.7, system_prompt="rules"))
+        self.assertNotEqual(key, ResponseCache.make_key("openai", "gpt-4o", "prompt", 0.7, max_tokens=100))
+
+class TestBenchmarkHarness(unittest.TestCase):
+    def test_all_modes_against_fake_server(self):
+        from tests.benchmark_llm_api import run_benchmark, MODES, PROVIDERS
+        with patch.dict('os.environ'):
+            results = run_benchmark(requests=3, concurrency=2, response_tokens=5)
+        self.assertEqual(len(results), len(MODES) * len(PROVIDERS))
+        for row in results:
+            self.assertEqual(row["errors"], 0, row)
+            self.assertGreater(row["requests_per_second"], 0)
+            self.assertIsNotNone(row["p99"])
+
+    @patch('tools.llm_api.OpenAI')
+    def test_local_url_override(self, mock_openai):
+        with patch.dict('os.environ', {'LOCAL_LLM_URL': 'http://127.0.0.1:9000/v1'}):
+            create_llm_client("local")
+        mock_openai.assert_called_once_with(base_url='http://127.0.0.1:9000/v1', api_key='not-needed',
+                                            max_retries=0)
+
+class TestEmbed(unittest.TestCase):
+    def test_hashing_embeddings_are_local(self):
+        with patch('tools.llm_api.create_llm_client') as mock_create_client:
+            vectors = embed(["The cat sat on the mat", "A cat sat on a mat", "Quarterly revenue grew"],
+                            provider="hashing")
+        mock_create_client.assert_not_called()
+        dot = lambda a, b: sum(x * y for x, y in zip(a, b))
+        self.assertAlmostEqual(dot(vectors[0], vectors[0]), 1.0)
+        self.assertGreater(dot(vectors[0], vectors[1]), dot(vectors[0], vectors[2]))
+
+    def test_openai_embeddings_batched_in_order(self):
+        mock_client = MagicMock()
+        def create(model, input):
+            response = MagicMock()
+            # Returned out of order; embed sorts by index
+            response.data = [MagicMock(index=i, embedding=[float(len(text))]) for i, text in enumerate(input)][::-1]
+            return response
+        mock_client.embeddings.create.side_effect = create
+        vectors = embed(["a", "bb", "ccc"], client=mock_client, batch_size=2)
+        self.assertEqual(vectors, [[1.0], [2.0], [3.0]])
+        self.assertEqual(mock_client.embeddings.create.call_count, 2)
+        mock_client.embeddings.create.assert_any_call(model="text-embedding-3-small", input=["a", "bb"])
+
+    def test_gemini_embeddings(self):
+        mock_genai = MagicMock()
+        mock_genai.embed_content.return_value = {"embedding": [[0.1], [0.2]]}
+        self.assertEqual(embed(["a", "b"], provider="gemini", client=mock_genai), [[0.1], [0.2]])
+        mock_genai.embed_content.assert_called_once_with(model="models/text-embedding-004", content=["a", "b"])
+
+    def test_provider_without_embeddings(self):
+        with self.assertRaises(ValueError):
+            embed("text", provider="anthropic")
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cache = ResponseCache(self.temp_dir.name)
+        self.server = create_daemon_server(port=0, cache=self.cache)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.temp_dir.cleanup()
+
+    def post(self, body=b'{}', headers=None):
+        request = urllib.request.Request(
+            f"http://127.0.0.1:{self.port}/query", data=body, method='POST',
+            headers={'Content-Type': 'application/json', 'Authorization': f"Bearer {self.server.token}",
+                     **(headers or {})})
+        with self.assertRaises(urllib.error.HTTPError) as context:
+            urllib.request.urlopen(request)
+        return context.exception.code
+
+    def test_health(self):
+        with urllib.request.urlopen(f"http://127.0.0.1:{self.port}/health") as response:
+            self.assertEqual(json.loads(response.read())["status"], "ok")
+
+    @patch('tools.llm_api.create_llm_client')
+    def test_query_reuses_warm_cache(self, mock_create_client):
+        mock_client = MagicMock()
+        mock_client.chat.completions.create.return_value.choices[0].message.content = "Daemon response"
+        mock_create_client.return_value = mock_client
+        for _ in range(2):
+            self.assertEqual(query_daemon("Test prompt", model="gpt-4o", port=self.port, token=self.server.token),
+                             "Daemon response")
+        mock_client.chat.completions.create.assert_called_once()
+        self.assertEqual(self.cache.stats()["hits"], 1)
+
+    @patch('tools.llm_api.create_llm_client')
+    def test_token_file_roundtrip(self, mock_create_client):
+        mock_create_client.return_value.chat.completions.create.return_value.choices[0].message.content = "OK"
+        with patch('tools.llm_api.DEFAULT_CACHE_DIR', Path(self.temp_dir.name) / 'daemon'):
+            path = write_daemon_token(self.server)
+            self.assertEqual(path.stat().st_mode & 0o777, 0o600)
+            self.assertEqual(query_daemon("Test prompt", port=self.port), "OK")
+
+    def test_missing_prompt_is_an_error(self):
+        self.assertEqual(self.post(), 400)
+
+    def test_rejects_requests_without_token(self):
+        self.assertEqual(self.post(headers={'Authorization': 'Bearer wrong'}), 403)
+        with self.assertRaises(urllib.error.HTTPError) as context:
+            urllib.request.urlopen(f"http://127.0.0.1:{self.port}/stats")
+        self.assertEqual(context.exception.code, 403)
+
+    def test_rejects_cross_origin_requests(self):
+        # A simple cross-origin POST from a web page cannot set a JSON content type
+        self.assertEqual(self.post(headers={'Content-Type': 'text/plain'}), 415)
+        # DNS rebinding reaches the daemon under the attacker's host name
+        self.assertEqual(self.post(headers={'Host': f'evil.example:{self.port}'}), 403)
+
+    def test_unreachable_daemon_raises_oserror(self):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            free_port = sock.getsockname()[1]
+        with self.assertRaises(OSError):
+            query_daemon("Test prompt", port=free_port, token="token")
+        with patch('tools.llm_api.DEFAULT_CACHE_DIR', Path(self.temp_dir.name)):
+            with self.assertRaises(OSError):
+                query_daemon("Test prompt", port=free_port)
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cache = ResponseCache(self.temp_dir.name)
+
+        self.mock_client = MagicMock()
+        mock_response = MagicMock()
+        mock_response.choices[0].message.content = "Cached response"
+        self.mock_client.chat.completions.create.return_value = mock_response
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_key_depends_on_request(self):
+        key = ResponseCache.make_key("openai", "gpt-4o", "prompt", 0.7)
+        self.assertEqual(key, ResponseCache.make_key("openai", "gpt-4o", "prompt", 0.7))
+        self.assertNotEqual(key, ResponseCache.make_key("openai", "gpt-4o", "prompt", None))
+        self.assertNotEqual(key, ResponseCache.make_key("anthropic", "gpt-4o", "prompt", 0.7))
+        self.assertNotEqual(key, ResponseCache.make_key("openai", "gpt-4o", "other prompt", 0.7))
+
+    def test_get_and_set(self):
+        self.assertIsNone(self.cache.get("key"))
+        self.cache.set("key", "value")
+        self.assertEqual(self.cache.get("key"), "value")
+        self.assertEqual(self.cache.stats(), {"hits": 1, "misses": 1, "approximate_hits": 0, "entries": 1})
+
+    def test_ttl_expiry(self):
+        cache = ResponseCache(self.temp_dir.name, ttl=60)
+        with patch('tools.llm_api.time.time', return_value=1000.0):
+            cache.set("key", "value")
+        with patch('tools.llm_api.time.time', return_value=1030.0):
+            self.assertEqual(cache.get("key"), "value")
+        with patch('tools.llm_api.time.time', return_value=1061.0):
+            self.assertIsNone(cache.get("key"))
+
+    def test_lru_eviction(self):
+        cache = ResponseCache(self.temp_dir.name, max_entries=2)
+        with patch('tools.llm_api.time.time', return_value=1.0):
+            cache.set("a", "1")
+        with patch('tools.llm_api.time.time', return_value=2.0):
+            cache.set("b", "2")
+        with patch('tools.llm_api.time.time', return_value=3.0):
+            cache.get("a")
+        with patch('tools.llm_api.time.time', return_value=4.0):
+            cache.set("c", "3")
+            self.assertEqual(cache.get("a"), "1")
+            self.assertIsNone(cache.get("b"))
+            self.assertEqual(cache.get("c"), "3")
+
+    def test_query_uses_cache(self):
+        first = query_llm("Test prompt", client=self.mock_client, cache=self.cache)
+        second = query_llm("Test prompt", client=self.mock_client, cache=self.cache)
+        self.assertEqual(first, "Cached response")
+        self.assertEqual(second, "Cached response")
+        self.mock_client.chat.completions.create.assert_called_once()
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_failed_query_is_not_cached(self):
+        self.mock_client.chat.completions.create.side_effect = Exception("Test error")
+        self.assertIsNone(query_llm("Test prompt", client=self.mock_client, cache=self.cache))
+        self.assertEqual(self.cache.stats()["entries"], 0)
+
+class TestApproximateCache(unittest.TestCase):
+    PROMPT = ("Summarize the following incident report for the on-call engineer. "
+              "Report generated at 2024-05-01 10:32:11 for request 7f3a9c2e-1b2d-4c5e-8f90-123456789abc: "
+              "the checkout service returned errors for 12 minutes after the deploy of build 4821 "
+              "because the payment gateway connection pool was exhausted and retries piled up.")
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cache = ResponseCache(self.temp_dir.name, similarity_threshold=0.9)
+        self.mock_client = MagicMock()
+        self.mock_client.chat.completions.create.return_value.choices[0].message.content = "Incident summary"
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_normalize_masks_volatile_tokens(self):
+        self.assertEqual(normalize_prompt("  Run at 2024-05-01T10:32:11Z,\n id 42!  "), "run at <time> id 42")
+        self.assertEqual(normalize_prompt("Hello   World"), normalize_prompt("hello world."))
+        self.assertEqual(normalize_prompt("What is 17*23?"), "what is 17 * 23")
+
+    def test_simhash_similarity(self):
+        base = simhash(normalize_prompt(self.PROMPT))
+        reworded = simhash(normalize_prompt(self.PROMPT.replace("for the on-call engineer", "for the on call engineer")))
+        unrelated = simhash(normalize_prompt("Write a haiku about autumn leaves falling on a quiet pond."))
+        self.assertEqual(simhash_similarity(base, base), 1.0)
+        self.assertGreaterEqual(simhash_similarity(base, reworded), 0.9)
+        self.assertLess(simhash_similarity(base, unrelated), 0.9)
+
+    def test_near_duplicate_prompt_served_approximately(self):
+        first = query_llm(self.PROMPT, client=self.mock_client, cache=self.cache)
+        self.assertEqual(first, "Incident summary")
+        variant = self.PROMPT.replace("2024-05-01 10:32:11", "2024-05-02 08:01:45").replace("  ", " ") + "\n"
+        response = query_llm(variant, client=self.mock_client, cache=self.cache)
+        self.assertEqual(response, "Incident summary")
+        self.mock_client.chat.completions.create.assert_called_once()
+        self.assertIsInstance(response, CachedResponse)
+        self.assertEqual(response.provenance["match"], "approximate")
+        self.assertEqual(response.provenance["prompt"], self.PROMPT)
+        self.assertGreaterEqual(response.provenance["similarity"], 0.9)
+        self.assertEqual(self.cache.stats()["approximate_hits"], 1)
+
+    def test_streams_share_the_approximate_index(self):
+        variant = self.PROMPT.replace("2024-05-01 10:32:11", "2024-05-02 08:01:45")
+        self.mock_client.chat.completions.create.return_value = iter([make_openai_chunk("Streamed summary")])
+        self.assertEqual(list(stream_llm(self.PROMPT, client=self.mock_client, cache=self.cache)),
+                         ["Streamed summary"])
+        # A streamed answer serves near-duplicate prompts, streamed or not
+        self.assertEqual(query_llm(variant, client=self.mock_client, cache=self.cache), "Streamed summary")
+        deltas = list(stream_llm(variant + "\n", client=self.mock_client, cache=self.cache))
+        self.assertEqual(deltas, ["Streamed summary"])
+        self.assertEqual(deltas[0].provenance["match"], "approximate")
+        self.mock_client.chat.completions.create.assert_called_once()
+
+        async def astream():
+            return [delta async for delta in astream_llm(variant, client=MagicMock(), cache=self.cache)]
+
+        self.assertEqual(asyncio.run(astream()), ["Streamed summary"])
+        self.assertEqual(self.cache.stats()["approximate_hits"], 3)
+
+    def test_exact_hit_provenance(self):
+        query_llm(self.PROMPT, client=self.mock_client, cache=self.cache)
+        response = query_llm(self.PROMPT, client=self.mock_client, cache=self.cache)
+        self.assertEqual(response.provenance["match"], "exact")
+        self.assertEqual(response.provenance["similarity"], 1.0)
+
+    def test_prompts_differing_in_numbers_miss(self):
+        cache = ResponseCache(self.temp_dir.name, similarity_threshold=0.5)
+        query_llm("What is 17 * 23?", client=self.mock_client, cache=cache)
+        query_llm("What is 12 * 45?", client=self.mock_client, cache=cache)
+        query_llm("What is 17 + 23?", client=self.mock_client, cache=cache)
+        self.assertEqual(self.mock_client.chat.completions.create.call_count, 3)
+        # Long prompts too, where one number barely moves the fingerprint
+        query_llm(self.PROMPT, client=self.mock_client, cache=self.cache)
+        query_llm(self.PROMPT.replace("12 minutes", "45 minutes"), client=self.mock_client, cache=self.cache)
+        self.assertEqual(self.mock_client.chat.completions.create.call_count, 5)
+        self.assertEqual(self.cache.stats()["approximate_hits"], 0)
+
+    def test_dissimilar_prompt_misses(self):
+        query_llm(self.PROMPT, client=self.mock_client, cache=self.cache)
+        query_llm("Write a haiku about autumn leaves falling on a quiet pond.", client=self.mock_client,
+                  cache=self.cache)
+        self.assertEqual(self.mock_client.chat.completions.create.call_count, 2)
+
+    def test_matches_stay_within_model(self):
+        query_llm(self.PROMPT, client=self.mock_client, model="gpt-4o", cache=self.cache)
+        query_llm(self.PROMPT + " ", client=self.mock_client, model="gpt-4o-mini", cache=self.cache)
+        self.assertEqual(self.mock_client.chat.completions.create.call_count, 2)
+
+    def test_disabled_without_threshold(self):
+        cache = ResponseCache(self.temp_dir.name)
+        query_llm(self.PROMPT, client=self.mock_client, cache=cache)
+        query_llm(self.PROMPT + " ", client=self.mock_client, cache=cache)
+        self.assertEqual(self.mock_client.chat.completions.create.call_count, 2)
+
+    def test_evicted_entries_leave_index(self):
+        cache = ResponseCache(self.temp_dir.name, max_entries=1, similarity_threshold=0.9)
+        query_llm(self.PROMPT, client=self.mock_client, cache=cache)
+        with patch('tools.llm_api.time.time', return_value=time.time() + 1):
+            query_llm("Write a haiku about autumn leaves.", client=self.mock_client, cache=cache)
+        self.assertIsNone(cache.get_similar(self.PROMPT, cache.make_scope("openai", "gpt-4o", 0.7)))
+        with cache.get_connection() as conn:
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM sketches").fetchone()[0], 1)
+            self.assertEqual(conn.execute("SELECT COUNT(DISTINCT key) FROM sketch_buckets").fetchone()[0], 1)
+
+    def test_invalid_threshold(self):
+        with self.assertRaises(ValueError):
+            ResponseCache(self.temp_dir.name, similarity_threshold=1.5)
+
 if __name__ == '__main__':
     unittest.main()
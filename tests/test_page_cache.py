@@ -0,0 +1,229 @@
+import unittest
+from unittest.mock import patch, AsyncMock
+import tempfile
+import time
+from email.utils import formatdate
+import httpx
+from tools.page_cache import PageCache, freshness_lifetime, parse_cache_control, DEFAULT_TTL
+from tools.web_scraper import fetch_page, process_urls
+
+PAGE = '<html><body><p>' + 'Cached article text. ' * 20 + '</p></body></html>'
+
+
+class TestFreshness(unittest.TestCase):
+    def test_parse_cache_control(self):
+        self.assertEqual(parse_cache_control('public, Max-Age=60, no-cache="set-cookie"'),
+                         {'public': None, 'max-age': '60', 'no-cache': 'set-cookie'})
+        self.assertEqual(parse_cache_control(None), {})
+
+    def test_lifetime(self):
+        now = time.time()
+        headers = lambda **h: httpx.Headers({k.replace('_', '-'): v for k, v in h.items()})
+        self.assertIsNone(freshness_lifetime(headers(cache_control='no-store, max-age=60')))
+        self.assertEqual(freshness_lifetime(headers(cache_control='no-cache')), 0)
+        self.assertEqual(freshness_lifetime(headers(cache_control='max-age=60', age='20')), 40)
+        self.assertAlmostEqual(freshness_lifetime(headers(date=formatdate(now, usegmt=True),
+                                                          expires=formatdate(now + 120, usegmt=True))), 120)
+        self.assertEqual(freshness_lifetime(headers(expires='0')), 0)
+        # A tenth of the time since the last change
+        self.assertAlmostEqual(freshness_lifetime(headers(date=formatdate(now, usegmt=True),
+                                                          last_modified=formatdate(now - 1000, usegmt=True))), 100)
+        self.assertEqual(freshness_lifetime(headers()), DEFAULT_TTL)
+        self.assertEqual(freshness_lifetime(None, default_ttl=5), 5)
+
+
+class TestPageCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.cache = PageCache(self.tmp.name)
+
+    def test_roundtrip(self):
+        self.assertIsNone(self.cache.get('http://a.test/'))
+        self.assertTrue(self.cache.put('http://a.test/', PAGE, {'etag': '"v1"', 'cache-control': 'max-age=60'}))
+        entry = self.cache.get('http://a.test/')
+        self.assertEqual(entry['html'], PAGE)
+        self.assertTrue(entry['fresh'])
+        self.assertFalse(entry['rendered'])
+        self.assertEqual(self.cache.conditional_headers(entry), {'If-None-Match': '"v1"'})
+        # Reopening sees the same data
+        self.assertEqual(PageCache(self.tmp.name).get('http://a.test/')['html'], PAGE)
+
+    def test_no_store_is_not_cached(self):
+        self.cache.put('http://a.test/', PAGE)
+        self.assertFalse(self.cache.put('http://a.test/', PAGE, {'cache-control': 'no-store'}))
+        self.assertIsNone(self.cache.get('http://a.test/'))
+        self.assertEqual(self.cache.stats()['bytes'], 0)
+
+    def test_stale_entries_and_revalidation(self):
+        self.cache.put('http://a.test/', PAGE, {'cache-control': 'no-cache', 'last-modified': 'Mon, 01 Jan 2024 00:00:00 GMT'})
+        entry = self.cache.get('http://a.test/')
+        self.assertFalse(entry['fresh'])
+        self.assertEqual(self.cache.conditional_headers(entry),
+                         {'If-Modified-Since': 'Mon, 01 Jan 2024 00:00:00 GMT'})
+        self.cache.mark_revalidated('http://a.test/', {'cache-control': 'max-age=60', 'etag': '"v2"'})
+        entry = self.cache.get('http://a.test/')
+        self.assertTrue(entry['fresh'])
+        self.assertEqual(entry['etag'], '"v2"')
+        self.assertEqual(entry['last_modified'], 'Mon, 01 Jan 2024 00:00:00 GMT')
+
+    def test_ttl_overrides_headers(self):
+        cache = PageCache(self.tmp.name, ttl=0)
+        cache.put('http://a.test/', PAGE, {'cache-control': 'max-age=3600'})
+        self.assertFalse(cache.get('http://a.test/')['fresh'])
+        cache = PageCache(self.tmp.name, ttl=3600)
+        cache.put('http://b.test/', PAGE, {'cache-control': 'no-cache'})
+        self.assertTrue(cache.get('http://b.test/')['fresh'])
+
+    def test_refresh_ignores_stored_pages(self):
+        self.cache.put('http://a.test/', PAGE)
+        self.assertIsNone(PageCache(self.tmp.name, refresh=True).get('http://a.test/'))
+
+    def test_identical_pages_share_a_blob(self):
+        self.cache.put('http://a.test/', PAGE)
+        self.cache.put('http://b.test/', PAGE)
+        size = self.cache.stats()['bytes']
+        self.cache.put('http://c.test/', PAGE + 'x')
+        self.assertEqual(self.cache.stats()['pages'], 3)
+        self.assertGreater(self.cache.stats()['bytes'], size)
+        self.cache.put('http://c.test/', PAGE)
+        self.assertEqual(self.cache.stats()['bytes'], size)
+
+    def test_text_cache(self):
+        self.assertIsNone(self.cache.get_text(PAGE, 'lxml'))
+        # Text of pages that are not cached is not kept
+        self.cache.put_text(PAGE, 'lxml', 'text')
+        self.assertIsNone(self.cache.get_text(PAGE, 'lxml'))
+        self.cache.put('http://a.test/', PAGE)
+        self.cache.put_text(PAGE, 'lxml', 'text')
+        self.assertEqual(self.cache.get_text(PAGE, 'lxml'), 'text')
+        self.assertIsNone(self.cache.get_text(PAGE, 'html5lib'))
+        self.cache.put('http://a.test/', PAGE + 'changed')
+        self.assertIsNone(self.cache.get_text(PAGE, 'lxml'))
+
+    def test_missing_blobs_are_rewritten(self):
+        self.cache.put('http://a.test/', PAGE)
+        self.cache.put('http://b.test/', PAGE)
+        self.cache.put_text(PAGE, 'lxml', 'text')
+        for blob in self.cache.blob_dir.glob('*/*'):
+            blob.unlink()
+        self.assertIsNone(self.cache.get('http://a.test/'))
+        self.assertIsNone(self.cache.get_text(PAGE, 'lxml'))
+        self.cache.put('http://a.test/', PAGE)
+        self.cache.put_text(PAGE, 'lxml', 'text')
+        self.assertEqual(self.cache.get('http://a.test/')['html'], PAGE)
+        self.assertEqual(self.cache.get('http://b.test/')['html'], PAGE)
+        self.assertEqual(self.cache.get_text(PAGE, 'lxml'), 'text')
+
+    def test_evicts_least_recently_used(self):
+        pages = {f'http://{i}.test/': f'<p>{i}</p>' + '<!-- %d -->' % (i * 7919) * 2000 for i in range(3)}
+        for url, html in pages.items():
+            self.cache.put(url, html)
+        self.cache.max_bytes = self.cache.stats()['bytes'] - 1
+        self.cache.get('http://0.test/')
+        self.cache.put('http://0.test/', pages['http://0.test/'])
+        self.assertIsNone(self.cache.get('http://1.test/'))
+        self.assertIsNotNone(self.cache.get('http://0.test/'))
+        self.assertIsNotNone(self.cache.get('http://2.test/'))
+        self.assertLessEqual(self.cache.stats()['bytes'], self.cache.max_bytes)
+
+    def test_clear(self):
+        self.cache.put('http://a.test/', PAGE)
+        self.cache.clear()
+        self.assertEqual(self.cache.stats()['pages'], 0)
+        self.assertEqual(list(self.cache.blob_dir.glob('*/*')), [])
+
+
+class TestCachedFetch(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.cache = PageCache(tmp.name)
+        self.requests = []
+        self.headers = {'content-type': 'text/html', 'etag': '"v1"', 'cache-control': 'no-cache'}
+        self.offline = False
+        self.status = 200
+
+        def handler(request):
+            if self.offline:
+                raise httpx.ConnectError('offline', request=request)
+            self.requests.append(request)
+            if request.headers.get('if-none-match') == '"v1"':
+                return httpx.Response(304, headers={'etag': '"v1"', 'cache-control': 'no-cache'})
+            if self.status != 200:
+                return httpx.Response(self.status, text='Error', headers={'content-type': 'text/html'})
+            if request.url.path == '/spa':
+                return httpx.Response(200, text='<div id="root"></div>', headers=self.headers)
+            return httpx.Response(200, text=PAGE, headers=self.headers)
+
+        self.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        self.render = AsyncMock(return_value='<html><body>Rendered</body></html>')
+        for patcher in [patch('tools.web_scraper._get_http_client', return_value=self.client),
+                        patch('tools.web_scraper.render_page', self.render)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def asyncTearDown(self):
+        await self.client.aclose()
+
+    async def test_fresh_pages_skip_the_network(self):
+        self.headers['cache-control'] = 'max-age=60'
+        self.assertEqual(await fetch_page('http://docs.test/', cache=self.cache), PAGE)
+        self.assertEqual(await fetch_page('http://docs.test/', cache=self.cache), PAGE)
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+    async def test_stale_pages_are_revalidated(self):
+        self.assertEqual(await fetch_page('http://docs.test/', cache=self.cache), PAGE)
+        self.assertEqual(await fetch_page('http://docs.test/', cache=self.cache), PAGE)
+        self.assertEqual(len(self.requests), 2)
+        self.assertEqual(self.requests[1].headers['if-none-match'], '"v1"')
+        self.assertEqual(self.cache.stats()['revalidated'], 1)
+
+    async def test_stale_copy_served_when_offline(self):
+        await fetch_page('http://docs.test/', cache=self.cache)
+        self.offline = True
+        self.assertEqual(await fetch_page('http://docs.test/', cache=self.cache), PAGE)
+        self.assertIsNone(await fetch_page('http://docs.test/other', render='never', cache=self.cache))
+
+    async def test_rendered_pages_are_cached(self):
+        self.headers['cache-control'] = 'max-age=60'
+        await fetch_page('http://docs.test/spa', cache=self.cache)
+        self.assertEqual(await fetch_page('http://docs.test/spa', cache=self.cache),
+                         '<html><body>Rendered</body></html>')
+        self.render.assert_called_once()
+        self.assertTrue(self.cache.get('http://docs.test/spa')['rendered'])
+
+    async def test_always_ignores_static_copies(self):
+        self.headers['cache-control'] = 'max-age=60'
+        await fetch_page('http://docs.test/', cache=self.cache)
+        self.assertEqual(await fetch_page('http://docs.test/', render='always', cache=self.cache),
+                         '<html><body>Rendered</body></html>')
+        await fetch_page('http://docs.test/', render='always', cache=self.cache)
+        self.render.assert_called_once()
+        # The rendered copy is fresh, so the third fetch made no request
+        self.assertEqual(len(self.requests), 2)
+
+    async def test_failed_responses_are_not_cached(self):
+        for status in (404, 503):
+            self.status = status
+            url = f'http://docs.test/{status}'
+            self.assertEqual(await fetch_page(url, cache=self.cache), '<html><body>Rendered</body></html>')
+            self.assertIsNone(self.cache.get(url))
+        self.offline = True
+        await fetch_page('http://docs.test/offline', render='always', cache=self.cache)
+        self.assertIsNone(self.cache.get('http://docs.test/offline'))
+        self.assertEqual(self.cache.stats()['pages'], 0)
+
+    async def test_extracted_text_is_reused(self):
+        self.headers['cache-control'] = 'max-age=60'
+        first = await process_urls(['http://docs.test/'], cache=self.cache)
+        with patch('tools.web_scraper.parse_html_async', AsyncMock()) as parse:
+            second = await process_urls(['http://docs.test/'], cache=self.cache)
+        parse.assert_not_called()
+        self.assertEqual(first, second)
+        self.assertIn('Cached article text.', second[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
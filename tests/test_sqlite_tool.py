@@ -0,0 +1,91 @@
+import unittest
+import os
+import tempfile
+from unittest.mock import patch
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from tools.sqlite_tool import SQLiteTools, VectorIndex
+
+PASSAGES = [
+    "Python is a programming language with dynamic typing and garbage collection.",
+    "The Eiffel Tower is a wrought-iron lattice tower in Paris, France.",
+    "Cats are small domesticated carnivorous mammals that like to sleep.",
+    "埃菲尔铁塔位于法国巴黎，是一座铁制镂空塔。",
+]
+
+@unittest.skipIf(numpy is None, "NumPy is not installed")
+class TestVectorIndex(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.temp_dir.name, 'data.db')
+        self.index = VectorIndex(self.db_path)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_add_and_search(self):
+        rows = self.index.add(PASSAGES, [{"id": i} for i in range(len(PASSAGES))])
+        self.assertEqual(rows, [0, 1, 2, 3])
+        results = self.index.search("Where is the Eiffel Tower?", k=2)
+        self.assertEqual(results[0]["text"], PASSAGES[1])
+        self.assertEqual(results[0]["metadata"], {"id": 1})
+        self.assertGreaterEqual(results[0]["score"], results[1]["score"])
+        self.assertEqual(self.index.search("埃菲尔铁塔在哪里", k=1)[0]["row"], 3)
+
+    def test_persisted_next_to_database(self):
+        self.index.add(PASSAGES[:2])
+        self.index.add(PASSAGES[2:])
+        self.assertTrue(os.path.exists(os.path.join(self.temp_dir.name, 'data.default.npy')))
+        reopened = VectorIndex(self.db_path)
+        self.assertEqual(len(reopened), len(PASSAGES))
+        self.assertEqual(reopened.search("domesticated cats", k=1)[0]["text"], PASSAGES[2])
+        entries = SQLiteTools(self.db_path).execute_query("SELECT COUNT(*) AS n FROM vector_entries")
+        self.assertEqual(entries[0]["n"], len(PASSAGES))
+
+    def test_add_document_splits_into_passages(self):
+        rows = self.index.add_document("\n\n".join(PASSAGES * 5), {"source": "page.md"}, chunk_tokens=30,
+                                       overlap_tokens=0)
+        self.assertGreater(len(rows), 1)
+        self.assertEqual(self.index.search("Eiffel Tower", k=1)[0]["metadata"], {"source": "page.md"})
+
+    def test_embeddings_are_batched(self):
+        with patch('tools.llm_api.embed', side_effect=lambda texts, **kwargs: [[1.0, 0.0]] * len(texts)) as mock_embed:
+            self.index.add(PASSAGES, batch_size=3)
+        self.assertEqual(mock_embed.call_args.kwargs["batch_size"], 3)
+
+    def test_interrupted_add_keeps_rows_aligned(self):
+        self.index.add(PASSAGES[:1])
+        # Interrupted after the entries were committed, before the matrix was replaced
+        with patch('tools.sqlite_tool.os.replace', side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                self.index.add(PASSAGES[1:3])
+        self.assertEqual(len(VectorIndex(self.db_path)), 1)
+        # Interrupted while writing the entries: the matrix is left alone
+        with patch('tools.sqlite_tool.json.dumps', side_effect=ValueError("not serializable")):
+            with self.assertRaises(ValueError):
+                self.index.add(PASSAGES[1:3], [{"id": 1}, {"id": 2}])
+        self.assertEqual(len(VectorIndex(self.db_path)), 1)
+        # Interrupted while writing the matrix: nothing is committed
+        with patch('tools.sqlite_tool.np.save', side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                self.index.add(PASSAGES[1:])
+        self.assertEqual(self.index.add(PASSAGES[3:]), [1])
+        reopened = VectorIndex(self.db_path)
+        self.assertEqual(reopened.search("埃菲尔铁塔在哪里", k=1)[0]["text"], PASSAGES[3])
+        entries = SQLiteTools(self.db_path).execute_query("SELECT row FROM vector_entries ORDER BY row")
+        self.assertEqual([entry["row"] for entry in entries], [0, 1])
+
+    def test_empty_index(self):
+        self.assertEqual(self.index.search("anything"), [])
+
+    def test_mismatched_provider_rejected(self):
+        self.index.add(PASSAGES[:1])
+        with self.assertRaises(ValueError):
+            VectorIndex(self.db_path, provider="openai")
+
+if __name__ == '__main__':
+    unittest.main()
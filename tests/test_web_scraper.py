@@ -1,13 +1,24 @@
 import unittest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, AsyncMock
 import asyncio
+import random
+import os
+import httpx
 import pytest
 from tools.web_scraper import (
     validate_url,
     parse_html,
     fetch_page,
-    process_urls
+    process_urls,
+    needs_javascript,
+    ResourceBlocker,
+    stream_urls,
+    parse_html_async,
+    close_parse_pool
 )
+import tools.web_scraper as web_scraper
+import tools.browser_pool as browser_pool
+from concurrent.futures.process import BrokenProcessPool
 
 pytestmark = pytest.mark.asyncio
 
@@ -105,5 +116,438 @@ class TestWebScraper(unittest.TestCase):
             self.assertEqual(results[1], "Test content")
             self.assertEqual(self.mock_session.get.call_count, 2)
 
+STATIC_PAGE = "<html><body><h1>Docs</h1><p>" + "Plain documentation text. " * 20 + "</p></body></html>"
+GBK_PAGE = ('<html><head><meta charset="gbk"><title>\u6587\u6863</title></head><body><p>'
+            + '\u4e2d\u6587\u6587\u6863\u5185\u5bb9\u3002' * 60 + '</p></body></html>')
+SPA_SHELL = '<html><body><div id="root"></div><script src="/static/app.js"></script></body></html>'
+
+
+class TestTieredFetch(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.requests = []
+
+        def handler(request):
+            self.requests.append(str(request.url))
+            path = request.url.path
+            if path == '/static':
+                return httpx.Response(200, text=STATIC_PAGE, headers={'content-type': 'text/html; charset=utf-8'})
+            if path == '/spa':
+                return httpx.Response(200, text=SPA_SHELL, headers={'content-type': 'text/html'})
+            if path == '/gbk':
+                return httpx.Response(200, content=GBK_PAGE.encode('gbk'), headers={'content-type': 'text/html'})
+            if path == '/undeclared':
+                return httpx.Response(200, content=GBK_PAGE.replace('<meta charset="gbk">', '').encode('gbk'),
+                                      headers={'content-type': 'text/html'})
+            if path == '/pdf':
+                return httpx.Response(200, content=b'%PDF-1.4', headers={'content-type': 'application/pdf'})
+            return httpx.Response(404, text='Not found', headers={'content-type': 'text/html'})
+
+        self.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        self.render = AsyncMock(return_value='<html><body>Rendered</body></html>')
+        patchers = [
+            patch('tools.web_scraper._get_http_client', return_value=self.client),
+            patch('tools.web_scraper.render_page', self.render),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def asyncTearDown(self):
+        await self.client.aclose()
+
+    def test_needs_javascript(self):
+        self.assertTrue(needs_javascript(None))
+        self.assertTrue(needs_javascript('   '))
+        self.assertTrue(needs_javascript(SPA_SHELL))
+        self.assertTrue(needs_javascript(
+            '<html><body><div id="__next"></div></body></html>'))
+        self.assertTrue(needs_javascript(
+            '<html><body><noscript>You need to enable JavaScript to run this app.</noscript>'
+            '<p>Loading</p></body></html>'))
+        self.assertTrue(needs_javascript(
+            '<html><body><p>Loading...</p><script>render()</script></body></html>'))
+        self.assertFalse(needs_javascript(STATIC_PAGE))
+        self.assertFalse(needs_javascript('<html><body><p>Short but static</p></body></html>'))
+        # A comment widget notice under a long article is not a JS-only page
+        self.assertFalse(needs_javascript(
+            STATIC_PAGE.replace('</body>', '<p>' + 'More article text. ' * 80 + '</p>'
+                                '<noscript>Please enable JavaScript to view the comments.</noscript></body>')))
+
+    async def test_auto_serves_static_pages_over_http(self):
+        content = await fetch_page('http://docs.test/static')
+        self.assertEqual(content, STATIC_PAGE)
+        self.render.assert_not_called()
+
+    async def test_charset_from_meta_tag(self):
+        self.assertEqual(await fetch_page('http://docs.test/gbk'), GBK_PAGE)
+        self.render.assert_not_called()
+
+    async def test_undeclared_charset_escalates(self):
+        content = await fetch_page('http://docs.test/undeclared')
+        self.assertEqual(content, '<html><body>Rendered</body></html>')
+        self.render.assert_called_once()
+        self.assertIsNotNone(await fetch_page('http://docs.test/undeclared', render='never'))
+
+    async def test_auto_escalates_script_rendered_pages(self):
+        content = await fetch_page('http://docs.test/spa')
+        self.assertEqual(content, '<html><body>Rendered</body></html>')
+        self.render.assert_called_once_with('http://docs.test/spa', None, None)
+
+    async def test_auto_escalates_http_failures(self):
+        await fetch_page('http://docs.test/missing')
+        await fetch_page('http://docs.test/pdf')
+        self.assertEqual(self.render.call_count, 2)
+
+    async def test_never_skips_the_browser(self):
+        self.assertEqual(await fetch_page('http://docs.test/spa', render='never'), SPA_SHELL)
+        self.assertIsNone(await fetch_page('http://docs.test/missing', render='never'))
+        self.render.assert_not_called()
+
+    async def test_always_skips_http(self):
+        await fetch_page('http://docs.test/static', render='always')
+        self.assertEqual(self.requests, [])
+        self.render.assert_called_once()
+
+    async def test_unknown_render_mode(self):
+        with self.assertRaises(ValueError):
+            await fetch_page('http://docs.test/static', render='sometimes')
+
+
+def make_route(url, resource_type, navigation=False, main_frame=True):
+    request = MagicMock(url=url, resource_type=resource_type)
+    request.is_navigation_request.return_value = navigation
+    request.frame.parent_frame = None if main_frame else MagicMock()
+    return MagicMock(request=request, abort=AsyncMock(), continue_=AsyncMock())
+
+
+class TestResourceBlocker(unittest.IsolatedAsyncioTestCase):
+    def test_reason(self):
+        blocker = ResourceBlocker()
+        self.assertEqual(blocker.reason('image', 'https://example.com/a.png'), 'image')
+        self.assertEqual(blocker.reason('font', 'https://fonts.example.com/a.woff2'), 'font')
+        self.assertIsNone(blocker.reason('script', 'https://example.com/app.js'))
+        self.assertIsNone(blocker.reason('stylesheet', 'https://example.com/app.css'))
+        self.assertEqual(blocker.reason('script', 'https://www.google-analytics.com/analytics.js'), 'tracker')
+        self.assertEqual(blocker.reason('image', 'https://connect.facebook.net/en_US/fbevents.js'), 'tracker')
+        # Path-scoped entries only match their path
+        self.assertEqual(blocker.reason('image', 'https://www.facebook.com/tr?id=1'), 'tracker')
+        self.assertIsNone(blocker.reason('document', 'https://www.facebook.com/help'))
+        # Look-alike hosts are not trackers
+        self.assertIsNone(blocker.reason('script', 'https://notdoubleclick.net/x.js'))
+
+    def test_custom_configuration(self):
+        blocker = ResourceBlocker(resource_types=['stylesheet'], tracker_domains=[])
+        self.assertEqual(blocker.reason('stylesheet', 'https://example.com/a.css'), 'stylesheet')
+        self.assertIsNone(blocker.reason('image', 'https://example.com/a.png'))
+        self.assertIsNone(blocker.reason('script', 'https://www.googletagmanager.com/gtm.js'))
+
+    async def test_handle_counts_blocked_and_allowed(self):
+        blocker = ResourceBlocker()
+        routes = [
+            make_route('https://example.com/', 'document', navigation=True),
+            make_route('https://example.com/logo.png', 'image'),
+            make_route('https://example.com/app.js', 'script'),
+            make_route('https://www.googletagmanager.com/gtm.js', 'script'),
+            make_route('https://doubleclick.net/ad', 'document', navigation=True, main_frame=False),
+        ]
+        for route in routes:
+            await blocker.handle(route)
+
+        routes[0].continue_.assert_called_once()
+        routes[1].abort.assert_called_once_with('blockedbyclient')
+        routes[2].continue_.assert_called_once()
+        routes[3].abort.assert_called_once()
+        routes[4].abort.assert_called_once()
+        stats = blocker.stats()
+        self.assertEqual(stats['requests_allowed'], 2)
+        self.assertEqual(stats['requests_blocked'], 3)
+        self.assertEqual(stats['blocked_by_reason'], {'image': 1, 'tracker': 2})
+
+    async def test_main_document_is_never_blocked(self):
+        blocker = ResourceBlocker(tracker_domains=['example.com'])
+        route = make_route('https://example.com/', 'document', navigation=True)
+        await blocker.handle(route)
+        route.continue_.assert_called_once()
+
+    async def test_attach_routes_page_and_counts_bytes(self):
+        blocker = ResourceBlocker()
+        page = MagicMock(route=AsyncMock())
+        await blocker.attach(page)
+        page.route.assert_called_once_with('**/*', blocker.handle)
+        page.on.assert_called_once_with('response', blocker.on_response)
+
+        blocker.on_response(MagicMock(headers={'content-length': '2048'}))
+        blocker.on_response(MagicMock(headers={}))
+        self.assertEqual(blocker.stats()['bytes_loaded'], 2048)
+        self.assertEqual(blocker.stats()['pages'], 1)
+        self.assertIn('2.0 KB', blocker.summary())
+
+    async def test_detach_undoes_attach(self):
+        blocker = ResourceBlocker()
+        page = MagicMock(route=AsyncMock(), unroute=AsyncMock())
+        await blocker.attach(page)
+        await blocker.detach(page)
+        page.unroute.assert_called_once_with('**/*', blocker.handle)
+        page.remove_listener.assert_called_once_with('response', blocker.on_response)
+
+    async def test_disabled_blocker_only_counts(self):
+        blocker = ResourceBlocker(resource_types=[], tracker_domains=[])
+        page = MagicMock(route=AsyncMock())
+        await blocker.attach(page)
+        page.route.assert_not_called()
+        page.on.assert_called_once()
+
+
+class TestStreamUrls(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.fetched = []
+
+        async def fake_fetch(url, render='auto', blocker=None, cache=None):
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            self.fetched.append(url)
+            # Later URLs finish first
+            await asyncio.sleep(0.05 / (int(url.rsplit('/', 1)[1]) + 1))
+            self.in_flight -= 1
+            return f"<html><body><p>Page {url}</p></body></html>"
+
+        patcher = patch('tools.web_scraper.fetch_page', side_effect=fake_fetch)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.urls = [f"http://example.com/{i}" for i in range(6)]
+
+    async def test_yields_in_completion_order(self):
+        items = [item async for item in stream_urls(self.urls, max_concurrent=3)]
+        self.assertEqual(sorted(index for index, _, _ in items), list(range(6)))
+        self.assertNotEqual([index for index, _, _ in items], list(range(6)))
+        for index, url, text in items:
+            self.assertEqual(url, self.urls[index])
+            self.assertIn(f"Page {url}", text)
+        self.assertLessEqual(self.max_in_flight, 3)
+
+    async def test_process_urls_keeps_input_order(self):
+        results = await process_urls(self.urls, max_concurrent=3)
+        self.assertEqual([text.strip() for text in results], [f"Page {url}" for url in self.urls])
+
+    async def test_slow_consumer_pauses_fetching(self):
+        urls = (f"http://example.com/{i}" for i in range(100))
+        stream = stream_urls(urls, max_concurrent=2)
+        first = await stream.__anext__()
+        await asyncio.sleep(0.2)
+        # Two fetching plus two waiting for the consumer
+        self.assertLessEqual(len(self.fetched), 4)
+        await stream.aclose()
+        self.assertIn(first[0], range(4))
+
+    async def test_worker_failure_cancels_siblings(self):
+        fetched = []
+
+        async def failing_fetch(url, render='auto', blocker=None, cache=None):
+            fetched.append(url)
+            if url.endswith('/0'):
+                raise RuntimeError("fetch crashed")
+            await asyncio.sleep(10)
+
+        with patch('tools.web_scraper.fetch_page', side_effect=failing_fetch):
+            with self.assertRaisesRegex(RuntimeError, "fetch crashed"):
+                await asyncio.wait_for(process_urls(self.urls, max_concurrent=3), timeout=5)
+        await asyncio.sleep(0)
+        # The two slow siblings were cancelled rather than left fetching the rest
+        self.assertEqual(len(fetched), 3)
+        self.assertEqual(asyncio.all_tasks(), {asyncio.current_task()})
+
+    async def test_failed_pages_yield_empty_text(self):
+        with patch('tools.web_scraper.fetch_page', AsyncMock(return_value=None)):
+            results = await process_urls(self.urls[:2])
+        self.assertEqual(results, ["", ""])
+
+    def test_process_urls_closes_what_it_opened(self):
+        async def run():
+            await process_urls(self.urls[:2])
+            loop = asyncio.get_running_loop()
+            self.assertNotIn(loop, web_scraper._http_clients)
+            self.assertNotIn(loop, browser_pool._pools)
+            # Resources the caller opened stay warm
+            client = web_scraper._get_http_client()
+            pool = web_scraper.get_browser_pool()
+            await process_urls(self.urls[:2])
+            self.assertIs(web_scraper._get_http_client(), client)
+            self.assertFalse(pool.closed)
+            await web_scraper.close_http_client()
+            await web_scraper.close_browser_pool()
+
+        with patch('tools.browser_pool.BrowserPool.close', AsyncMock()) as close:
+            asyncio.run(run())
+        self.assertEqual(close.await_count, 2)
+
+
+class TestParserBackends(unittest.TestCase):
+    HTML = """<!DOCTYPE html>
+    <html><head><title>T</title><script>var x = 1;</script></head>
+    <body>
+        <nav><a href="/home">Home</a><a href="#top">Top</a><a href="javascript:void(0)">Menu</a></nav>
+        <h1>Guide</h1>
+        <p>Intro with <a href="/docs">docs</a> and <b>bold</b> tail text.</p>
+        <p>Intro with <a href="/other">docs</a></p>
+        <table><tr><th>Key</th><th>Value</th></tr><tr><td>a</td><td>1</td></tr></table>
+        <div><span></span>after empty span</div>
+        <p>load app.js first</p>
+        <!-- build 42 -->
+        <style>p { color: red; }</style>
+    </body></html>"""
+
+    def test_backends_agree(self):
+        html5lib_text = parse_html(self.HTML, parser='html5lib')
+        self.assertEqual(parse_html(self.HTML, parser='lxml'), html5lib_text)
+        self.assertEqual(parse_html(self.HTML), html5lib_text)
+
+    def test_extraction_rules(self):
+        lines = parse_html(self.HTML, parser='html5lib').split('\n')
+        stripped = [line.strip() for line in lines]
+        self.assertIn('[Home](/home)', stripped)
+        self.assertNotIn('Top', ''.join(stripped))
+        self.assertNotIn('Menu', ''.join(stripped))
+        # Repeated text is emitted once, links included
+        self.assertEqual(stripped.count('[docs](/docs)'), 1)
+        self.assertNotIn('[docs](/other)', stripped)
+        self.assertIn('tail text.', stripped)
+        # Implied tbody puts cells at the same depth for both parsers
+        self.assertIn('        Key', lines)
+        # Tails of elements without text are dropped, as before
+        self.assertNotIn('after empty span', stripped)
+        # Noise lines are filtered
+        self.assertNotIn('load app.js first', stripped)
+        self.assertIn('build 42', stripped)
+
+    @unittest.skipIf(web_scraper.lxml is None, "lxml is not installed")
+    def test_auto_matches_html5lib_on_misnested_markup(self):
+        cases = {
+            'formatting': "<html><body><p><b>bold <i>both</b> italic</i> rest</p></body></html>",
+            'table': "<html><body><table><tr><td>a</td></tr><p>stray</p><tr><td>b</td></tr></table>"
+                     "<p>after</p></body></html>",
+            'nul': "<html><body><p>a\x00b</p></body></html>",
+            'headings': "<html><body><h1>A<h2>B</h2></h1></body></html>",
+            'image': "<html><body><image src=x>after</body></html>",
+        }
+        for name, html in cases.items():
+            with self.subTest(name):
+                html5lib_text = parse_html(html, parser='html5lib')
+                self.assertNotEqual(parse_html(html, parser='lxml'), html5lib_text)
+                self.assertEqual(parse_html(html), html5lib_text)
+        self.assertEqual(parse_html(cases['formatting']).split('\n'),
+                         ['    bold', '      both', '    italic', '    rest'])
+        self.assertNotIn('\ufffd', parse_html(cases['nul']))
+        # Well-formed pages still go through lxml
+        self.assertIsNotNone(web_scraper._parse_with_lxml(self.HTML, strict=True))
+
+    @unittest.skipIf(web_scraper.lxml is None, "lxml is not installed")
+    def test_auto_matches_html5lib_on_random_markup(self):
+        rng = random.Random(0)
+        tags = ['a', 'b', 'i', 'p', 'div', 'span', 'h1', 'h2', 'pre', 'ul', 'li', 'dl', 'dt', 'dd', 'table',
+                'tbody', 'tr', 'td', 'th', 'caption', 'section', 'form', 'br', 'img', 'image', 'select',
+                'option', 'textarea', 'title', 'body', 'html', 'svg', 'nobr', 'font', 'button']
+        words = ['alpha', 'beta', 'x y', '&amp;', '&copy', '\x00', '<!-- c -->', '\n', 'a<b']
+
+        def soup(closing_rate):
+            out, stack = [], []
+            for _ in range(rng.randint(3, 30)):
+                r = rng.random()
+                if r < 0.35:
+                    tag = rng.choice(tags)
+                    out.append(f'<{tag} href="/{tag}">' if tag == 'a' else f'<{tag}>')
+                    stack.append(tag)
+                elif r < 0.6 and stack:
+                    out.append(f'</{stack.pop() if rng.random() < closing_rate else rng.choice(tags)}>')
+                else:
+                    out.append(rng.choice(words))
+            return '<html><body>' + ''.join(out) + ''.join(f'</{tag}>' for tag in reversed(stack)) + '</body></html>'
+
+        used_lxml = 0
+        for i in range(600):
+            html = soup(1.0 if i % 2 else 0.7)
+            with self.subTest(html=html):
+                self.assertEqual(parse_html(html), parse_html(html, parser='html5lib'))
+            used_lxml += web_scraper._parse_with_lxml(html, strict=True) is not None
+        # The comparison covers pages auto sends to lxml, not just html5lib fallbacks
+        self.assertGreater(used_lxml, 10)
+
+    def test_deep_nesting(self):
+        depth = 1500
+        html = "<html><body>" + "<div><i></i>" * depth + "<p>deepest</p>" + "</div>" * depth + "</body></html>"
+        for parser in ('html5lib', 'lxml'):
+            self.assertEqual(parse_html(html, parser=parser).strip(), 'deepest')
+
+    def test_falls_back_without_lxml(self):
+        with patch('tools.web_scraper.lxml', None):
+            self.assertEqual(parse_html(self.HTML, parser='auto'), parse_html(self.HTML, parser='html5lib'))
+            with self.assertLogs('tools.web_scraper', level='WARNING'):
+                self.assertIn('Guide', parse_html(self.HTML, parser='lxml'))
+
+    def test_falls_back_when_lxml_rejects_input(self):
+        html = '<?xml version="1.0" encoding="utf-8"?><html><body><p>Declared</p></body></html>'
+        self.assertEqual(parse_html(html, parser='lxml').strip(), 'Declared')
+
+    def test_unknown_parser(self):
+        with self.assertRaises(ValueError):
+            parse_html(self.HTML, parser='regex')
+
+
+class TestParsePool(unittest.IsolatedAsyncioTestCase):
+    LARGE = "<html><body>" + "".join(f"<p>Paragraph {i}</p>" for i in range(5000)) + "</body></html>"
+
+    def setUp(self):
+        close_parse_pool()
+        self.addCleanup(close_parse_pool)
+
+    def _segments(self):
+        return set(os.listdir('/dev/shm')) if os.path.isdir('/dev/shm') else set()
+
+    async def test_small_pages_parse_inline(self):
+        self.assertEqual(await parse_html_async("<p>Small</p>"), parse_html("<p>Small</p>"))
+        self.assertEqual(await parse_html_async(None), "")
+        self.assertIsNone(web_scraper._parse_executor)
+
+    async def test_large_pages_use_persistent_pool(self):
+        self.assertGreater(len(self.LARGE), web_scraper.PARSE_INLINE_MAX_CHARS)
+        before = self._segments()
+        text = await parse_html_async(self.LARGE + "<p>caf\u00e9 \u4e2d\u6587</p>")
+        self.assertEqual(text, parse_html(self.LARGE + "<p>caf\u00e9 \u4e2d\u6587</p>"))
+        executor = web_scraper._parse_executor
+        self.assertIsNotNone(executor)
+        await parse_html_async(self.LARGE)
+        self.assertIs(web_scraper._parse_executor, executor)
+        # Shared memory segments are removed once parsed
+        self.assertEqual(self._segments() - before, set())
+
+    async def test_inline_flag_skips_pool(self):
+        await parse_html_async(self.LARGE, inline=True)
+        self.assertIsNone(web_scraper._parse_executor)
+
+    async def test_broken_pool_falls_back_inline(self):
+        broken = MagicMock()
+        broken.submit.side_effect = BrokenProcessPool("worker died")
+        with patch('tools.web_scraper._get_parse_executor', return_value=broken):
+            with self.assertLogs('tools.web_scraper', level='WARNING'):
+                text = await parse_html_async(self.LARGE)
+        self.assertEqual(text, parse_html(self.LARGE))
+
+    async def test_stream_parses_small_batches_inline(self):
+        calls = []
+
+        async def fake_parse(html_content, parser=None, inline=False):
+            calls.append(inline)
+            return ""
+
+        with patch('tools.web_scraper.fetch_page', AsyncMock(return_value="<p>x</p>")), \
+                patch('tools.web_scraper.parse_html_async', side_effect=fake_parse):
+            await process_urls(["http://a.test/1", "http://a.test/2"])
+            await process_urls([f"http://a.test/{i}" for i in range(5)])
+            async for _ in stream_urls(iter(["http://a.test/1"])):
+                pass
+        self.assertEqual(calls, [True, True] + [False] * 5 + [False])
+
+
 if __name__ == '__main__':
     unittest.main()
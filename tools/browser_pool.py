@@ -0,0 +1,484 @@
+#!/usr/bin/env python3
+
+"""
+Shared Playwright browser pool for web_scraper and screenshot_utils.
+
+Launching Chromium costs far more than loading a small page, so both tools
+borrow pages from a pool that keeps one warm browser (plus a few warm
+contexts) per event loop. The browser is recycled after a fixed number of
+pages or as soon as it crashes, and pages can be kept open and reused for the
+next URL. An optional memory ceiling holds back new pages while the browser
+processes use too much memory. When BROWSER_CDP_URL is set the pool connects
+to a long-lived browser started with ``browser_pool.py serve`` instead of
+launching its own, so separate CLI invocations skip the launch entirely.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+import weakref
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Dict, List, Optional
+
+from playwright.async_api import async_playwright
+
+try:
+    import psutil
+except ImportError:  # Optional; /proc is read directly on Linux
+    psutil = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_PAGES = 100
+DEFAULT_CONTEXTS = 4
+DEFAULT_CDP_HOST = '127.0.0.1'
+DEFAULT_CDP_PORT = 9222
+# How long a memory reading is reused, and how often a throttled page rechecks it
+MEMORY_SAMPLE_INTERVAL = 0.5
+
+# Substrings of Playwright errors that mean the browser (not just the page) is gone
+_CRASH_MARKERS = (
+    'target crashed',
+    'target closed',
+    'has been closed',
+    'browser closed',
+    'disconnected',
+    'connection closed',
+)
+
+
+def _is_crash(error: BaseException) -> bool:
+    """Return True if the error indicates the browser died underneath us."""
+    message = str(error).lower()
+    return any(marker in message for marker in _CRASH_MARKERS)
+
+
+def _is_python(exe: str) -> bool:
+    return os.path.basename(exe).startswith('python')
+
+
+def _proc_tree_rss(root_pid: int) -> Optional[int]:
+    """Sum the RSS in bytes of root_pid's non-Python descendants by reading /proc."""
+    if not os.path.isdir('/proc'):
+        return None
+    children: Dict[int, List[int]] = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat', 'rb') as f:
+                # The command name may contain spaces; fields resume after its closing parenthesis
+                fields = f.read().rsplit(b')', 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        children.setdefault(int(fields[1]), []).append(int(entry))
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    total = 0
+    stack = list(children.get(root_pid, []))
+    while stack:
+        pid = stack.pop()
+        stack.extend(children.get(pid, []))
+        try:
+            if _is_python(os.readlink(f'/proc/{pid}/exe')):
+                continue
+            with open(f'/proc/{pid}/statm', 'rb') as f:
+                total += int(f.read().split()[1]) * page_size
+        except (OSError, IndexError, ValueError):
+            continue
+    return total
+
+
+def browser_memory_mb() -> Optional[float]:
+    """
+    Return the resident memory of the browsers launched by this process in MB.
+
+    Sums every descendant process except Python ones (such as web_scraper's
+    parse pool), which covers the Playwright driver and its Chromium
+    processes but not a browser reached over CDP. RSS is summed per process,
+    so pages shared between Chromium processes are counted more than once.
+    Returns None when neither psutil nor /proc is available.
+    """
+    if psutil is not None:
+        total = 0
+        for child in psutil.Process().children(recursive=True):
+            try:
+                if not _is_python(child.exe()):
+                    total += child.memory_info().rss
+            except psutil.Error:
+                continue
+        return total / (1024 * 1024)
+    total = _proc_tree_rss(os.getpid())
+    return None if total is None else total / (1024 * 1024)
+
+
+class _BrowserSlot:
+    """A launched (or connected) browser together with its warm contexts."""
+
+    def __init__(self, browser: Any):
+        self.browser = browser
+        self.contexts: List[Any] = []
+        self.idle_pages: List[Any] = []
+        self.next_context = 0
+        self.pages = 0  # pages handed out so far
+        self.active = 0  # pages not yet closed
+        self.retired = False
+        self.closed = False
+
+
+class BrowserPool:
+    """
+    Hand out Playwright pages from a warm, periodically recycled browser.
+
+    Playwright objects are bound to the event loop that created them, so use
+    get_browser_pool() to obtain the pool of the running loop rather than
+    sharing an instance across loops.
+
+    Args:
+        max_pages (int, optional): Pages served before the browser is replaced.
+            Defaults to BROWSER_POOL_MAX_PAGES or 100.
+        contexts (int): Warm contexts kept per browser for pages opened
+            without options. Defaults to 4.
+        cdp_url (str, optional): Browser server to connect to over CDP.
+            Defaults to BROWSER_CDP_URL; falls back to launching on failure.
+        launch_options (dict, optional): Keyword arguments for chromium.launch().
+        playwright_factory (callable, optional): Returns the Playwright context
+            manager. Defaults to async_playwright.
+        max_memory_mb (float, optional): Hold back new pages while the
+            launched browsers use more memory than this. Defaults to
+            BROWSER_POOL_MAX_MEMORY_MB; no limit when unset.
+    """
+
+    def __init__(self, max_pages: Optional[int] = None, contexts: int = DEFAULT_CONTEXTS,
+                 cdp_url: Optional[str] = None, launch_options: Optional[Dict[str, Any]] = None,
+                 playwright_factory: Optional[Callable[[], Any]] = None,
+                 max_memory_mb: Optional[float] = None):
+        if max_pages is None:
+            max_pages = int(os.getenv('BROWSER_POOL_MAX_PAGES', DEFAULT_MAX_PAGES))
+        self.max_pages = max(1, max_pages)
+        self.contexts = max(1, contexts)
+        if max_memory_mb is None and os.getenv('BROWSER_POOL_MAX_MEMORY_MB'):
+            max_memory_mb = float(os.environ['BROWSER_POOL_MAX_MEMORY_MB'])
+        self.max_memory_mb = max_memory_mb
+        self._memory_sample = (0.0, 0.0)  # (monotonic time, MB)
+        self.cdp_url = cdp_url if cdp_url is not None else os.getenv('BROWSER_CDP_URL')
+        self.launch_options = launch_options if launch_options is not None else {'headless': True}
+        self._factory = playwright_factory or async_playwright
+        self._manager = None
+        self._playwright = None
+        self._slot: Optional[_BrowserSlot] = None
+        self._retiring: List[_BrowserSlot] = []
+        self._lock = asyncio.Lock()
+        self.closed = False
+        self.launches = 0
+        self.connects = 0
+        self.recycles = 0
+        self.crashes = 0
+        self.pages_served = 0
+        self.reused = 0
+        self.throttled = 0
+
+    async def _start_browser(self) -> _BrowserSlot:
+        """Connect to the browser server if configured, otherwise launch Chromium."""
+        if self._playwright is None:
+            self._manager = self._factory()
+            self._playwright = await self._manager.__aenter__()
+        if self.cdp_url:
+            try:
+                browser = await self._playwright.chromium.connect_over_cdp(self.cdp_url)
+                self.connects += 1
+                logger.debug(f"Connected to browser server at {self.cdp_url}")
+                return _BrowserSlot(browser)
+            except Exception as e:
+                logger.warning(f"Could not connect to browser server at {self.cdp_url} ({e}); "
+                               "launching a local browser")
+                self.cdp_url = None
+        browser = await self._playwright.chromium.launch(**self.launch_options)
+        self.launches += 1
+        return _BrowserSlot(browser)
+
+    async def _close_slot(self, slot: _BrowserSlot) -> None:
+        """Close a browser and its contexts, ignoring errors from a dead browser."""
+        if slot.closed:
+            return
+        slot.closed = True
+        if slot in self._retiring:
+            self._retiring.remove(slot)
+        slot.idle_pages.clear()
+        for context in slot.contexts:
+            try:
+                await context.close()
+            except Exception as e:
+                logger.debug(f"Error closing browser context: {e}")
+        try:
+            await slot.browser.close()
+        except Exception as e:
+            logger.debug(f"Error closing browser: {e}")
+
+    async def _retire(self, slot: _BrowserSlot) -> None:
+        """Stop handing out pages from a browser; close it once its pages are done."""
+        slot.retired = True
+        if self._slot is slot:
+            self._slot = None
+        if slot.active == 0:
+            await self._close_slot(slot)
+        elif slot not in self._retiring:
+            self._retiring.append(slot)
+
+    def _memory_mb(self) -> Optional[float]:
+        now = time.monotonic()
+        sampled_at, value = self._memory_sample
+        if now - sampled_at >= MEMORY_SAMPLE_INTERVAL:
+            value = browser_memory_mb()
+            self._memory_sample = (now, value)
+        return value
+
+    async def _wait_for_memory(self) -> None:
+        """Hold a new page back while the browsers are over max_memory_mb."""
+        if not self.max_memory_mb:
+            return
+        throttled = False
+        while True:
+            used = self._memory_mb()
+            if used is None or used <= self.max_memory_mb:
+                return
+            if not throttled:
+                throttled = True
+                self.throttled += 1
+                logger.info(f"Browser memory at {used:.0f} MB (limit {self.max_memory_mb:.0f} MB); "
+                            "waiting for open pages to finish")
+            if not any(slot.active for slot in self._slots()):
+                # Nothing left to wait for: restart the browser to release its memory,
+                # unless it is fresh and restarting cannot help
+                async with self._lock:
+                    slot = self._slot
+                    if slot is not None and slot.pages > 1 and not any(s.active for s in self._slots()):
+                        self.recycles += 1
+                        await self._retire(slot)
+                self._memory_sample = (0.0, 0.0)
+                return
+            await asyncio.sleep(MEMORY_SAMPLE_INTERVAL)
+
+    def _slots(self) -> List[_BrowserSlot]:
+        return self._retiring + ([self._slot] if self._slot is not None else [])
+
+    async def _acquire(self, shared_context: bool, reuse: bool = False):
+        """Reserve a page on the current browser, returning (slot, context or None, idle page or None)."""
+        if self.closed:
+            raise RuntimeError("Browser pool is closed")
+        await self._wait_for_memory()
+        async with self._lock:
+            slot = self._slot
+            if slot is not None and (slot.retired or slot.pages >= self.max_pages):
+                if not slot.retired:
+                    self.recycles += 1
+                await self._retire(slot)
+                slot = None
+            if slot is None:
+                slot = self._slot = await self._start_browser()
+            slot.pages += 1
+            slot.active += 1
+            if reuse and slot.idle_pages:
+                self.reused += 1
+                return slot, None, slot.idle_pages.pop()
+            context = None
+            if shared_context:
+                try:
+                    if len(slot.contexts) < self.contexts:
+                        context = await slot.browser.new_context()
+                        slot.contexts.append(context)
+                    else:
+                        context = slot.contexts[slot.next_context % len(slot.contexts)]
+                        slot.next_context += 1
+                except BaseException:
+                    slot.active -= 1
+                    raise
+            return slot, context, None
+
+    async def _release(self, slot: _BrowserSlot) -> None:
+        slot.active -= 1
+        self.pages_served += 1
+        if slot.retired and slot.active == 0:
+            await self._close_slot(slot)
+
+    async def _park(self, slot: _BrowserSlot, page: Any) -> bool:
+        """Blank a finished page and keep it for reuse; False if it should be closed instead."""
+        if slot.retired or self.closed:
+            return False
+        try:
+            await page.goto('about:blank')
+        except Exception as e:
+            logger.debug(f"Could not reset page for reuse: {e}")
+            if _is_crash(e):
+                self._mark_crashed(slot)
+            return False
+        if slot.retired or self.closed:
+            return False
+        slot.idle_pages.append(page)
+        return True
+
+    def _mark_crashed(self, slot: _BrowserSlot) -> None:
+        if not slot.retired:
+            slot.retired = True
+            self.crashes += 1
+            logger.warning("Browser crashed or disconnected; it will be replaced")
+
+    @asynccontextmanager
+    async def page(self, reuse: bool = False, **options):
+        """
+        Borrow a page for the duration of the block.
+
+        Without options the page is opened in one of the pool's warm contexts.
+        With options (e.g. viewport) it gets an isolated context via
+        browser.new_page(**options), which still reuses the warm browser.
+        With ``reuse`` (ignored when options are given) a page that finishes
+        without error is blanked and handed to the next ``reuse`` caller
+        instead of being closed; callers must undo any routes or listeners
+        they added. A page that fails to open because the browser crashed is
+        retried once on a fresh browser.
+        """
+        reuse = reuse and not options
+        for attempt in range(2):
+            slot, context, page = await self._acquire(shared_context=not options, reuse=reuse)
+            if page is not None:
+                break
+            try:
+                page = await (context.new_page() if context is not None
+                              else slot.browser.new_page(**options))
+                break
+            except Exception as e:
+                await self._release(slot)
+                if not _is_crash(e) or attempt:
+                    raise
+                self._mark_crashed(slot)
+        failed = True
+        try:
+            yield page
+            failed = False
+        except Exception as e:
+            if _is_crash(e):
+                self._mark_crashed(slot)
+            raise
+        finally:
+            if failed or not reuse or not await self._park(slot, page):
+                try:
+                    await page.close()
+                except Exception as e:
+                    logger.debug(f"Error closing page: {e}")
+            await self._release(slot)
+
+    def stats(self) -> Dict[str, int]:
+        """Return launch, connect, recycle, crash, page, reuse and throttle counters."""
+        return {
+            'launches': self.launches,
+            'connects': self.connects,
+            'recycles': self.recycles,
+            'crashes': self.crashes,
+            'pages': self.pages_served,
+            'reused': self.reused,
+            'throttled': self.throttled,
+        }
+
+    async def close(self) -> None:
+        """Close every browser owned by the pool and stop Playwright."""
+        if self.closed:
+            return
+        self.closed = True
+        slots = list(self._retiring)
+        if self._slot is not None:
+            slots.append(self._slot)
+            self._slot = None
+        for slot in slots:
+            await self._close_slot(slot)
+        if self._manager is not None:
+            manager, self._manager, self._playwright = self._manager, None, None
+            await manager.__aexit__(None, None, None)
+        logger.debug(f"Browser pool closed: {self.stats()}")
+
+    async def __aenter__(self) -> 'BrowserPool':
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+
+_pools: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, BrowserPool]' = weakref.WeakKeyDictionary()
+
+
+def get_browser_pool(**kwargs) -> BrowserPool:
+    """
+    Return the browser pool of the running event loop, creating it on first use.
+
+    Keyword arguments are passed to BrowserPool and only apply when the pool
+    is created. Call close_browser_pool() before the loop finishes.
+    """
+    loop = asyncio.get_running_loop()
+    pool = _pools.get(loop)
+    if pool is None or pool.closed:
+        pool = _pools[loop] = BrowserPool(**kwargs)
+    return pool
+
+
+async def close_browser_pool() -> None:
+    """Close the browser pool of the running event loop, if there is one."""
+    pool = _pools.pop(asyncio.get_running_loop(), None)
+    if pool is not None:
+        await pool.close()
+
+
+@asynccontextmanager
+async def browser_pool_scope(**kwargs):
+    """
+    Use the browser pool of the running event loop for the duration of a block.
+
+    Yields get_browser_pool(**kwargs). If the loop had no open pool on entry,
+    the pool is closed on exit, so a call made through asyncio.run() does not
+    leave a browser behind; a pool the caller already keeps warm stays open.
+    """
+    pool = _pools.get(asyncio.get_running_loop())
+    owned = pool is None or pool.closed
+    pool = get_browser_pool(**kwargs)
+    try:
+        yield pool
+    finally:
+        if owned:
+            await close_browser_pool()
+
+
+async def serve(host: str = DEFAULT_CDP_HOST, port: int = DEFAULT_CDP_PORT) -> None:
+    """Run a headless Chromium that accepts CDP connections until interrupted."""
+    async with async_playwright() as p:
+        browser = await p.chromium.launch(headless=True, args=[
+            f'--remote-debugging-address={host}',
+            f'--remote-debugging-port={port}',
+        ])
+        stopped = asyncio.Event()
+        browser.on('disconnected', lambda _: stopped.set())
+        print(f"Browser server listening on http://{host}:{port}", file=sys.stderr)
+        print(f"Set BROWSER_CDP_URL=http://{host}:{port} to use it from web_scraper and screenshot_utils",
+              file=sys.stderr)
+        try:
+            await stopped.wait()
+        finally:
+            await browser.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a long-lived browser for web_scraper and screenshot_utils.')
+    parser.add_argument('command', choices=['serve'], help='serve: start a browser that accepts CDP connections')
+    parser.add_argument('--host', default=DEFAULT_CDP_HOST, help=f'Address to listen on (default: {DEFAULT_CDP_HOST})')
+    parser.add_argument('--port', type=int, default=DEFAULT_CDP_PORT,
+                        help=f'Remote debugging port (default: {DEFAULT_CDP_PORT})')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', stream=sys.stderr)
+    try:
+        asyncio.run(serve(args.host, args.port))
+    except KeyboardInterrupt:
+        print("Browser server stopped", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
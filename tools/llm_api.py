@@ -1,18 +1,71 @@
 #!/usr/bin/env /workspace/tmp_windsurf/venv/bin/python3
 
-import google.generativeai as genai
-from openai import OpenAI, AzureOpenAI
-from anthropic import Anthropic
 import argparse
 import os
 from dotenv import load_dotenv
 from pathlib import Path
 import sys
 import base64
-from typing import Optional, Union, List
+from typing import Optional, Union, List, Iterator, AsyncIterator
 import mimetypes
+import hashlib
+import hmac
+import secrets
+import json
+import sqlite3
+import time
+from contextlib import contextmanager, asynccontextmanager, ExitStack, AsyncExitStack
+import importlib
+import threading
+import weakref
+import asyncio
+import random
+from email.utils import parsedate_to_datetime
+from collections import OrderedDict, deque
+from functools import lru_cache
+import io
+import math
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import urllib.request
+import re
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-def load_environment():
+try:
+    import fcntl
+except ImportError:  # Not available on Windows; cross-process coalescing is disabled there
+    fcntl = None
+
+DEFAULT_CACHE_DIR = Path.home() / '.cache' / 'llm_api'
+
+# Provider SDKs are heavy to import (gRPC for Gemini in particular), so they are
+# only imported the first time a client for that provider is created.
+_LAZY_SDKS = {
+    'OpenAI': ('openai', 'OpenAI'),
+    'AzureOpenAI': ('openai', 'AzureOpenAI'),
+    'Anthropic': ('anthropic', 'Anthropic'),
+    'AsyncOpenAI': ('openai', 'AsyncOpenAI'),
+    'AsyncAzureOpenAI': ('openai', 'AsyncAzureOpenAI'),
+    'AsyncAnthropic': ('anthropic', 'AsyncAnthropic'),
+    'genai': ('google.generativeai', None),
+}
+
+def _sdk(name: str):
+    """Return a provider SDK object, importing it on first use."""
+    if name not in globals():
+        module_name, attribute = _LAZY_SDKS[name]
+        module = importlib.import_module(module_name)
+        globals()[name] = getattr(module, attribute) if attribute else module
+    return globals()[name]
+
+def __getattr__(name: str):
+    if name in _LAZY_SDKS:
+        return _sdk(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+_environment_loaded = False
+_environment_lock = threading.Lock()
+
+def load_environment(verbose: bool = False):
     """Load environment variables from .env files in order of precedence"""
     # Order of precedence:
     # 1. System environment variables (already loaded)
@@ -23,28 +76,36 @@ def load_environment():
     env_files = ['.env.local', '.env', '.env.example']
     env_loaded = False
     
-    print("Current working directory:", Path('.').absolute(), file=sys.stderr)
-    print("Looking for environment files:", env_files, file=sys.stderr)
+    if verbose:
+        print("Current working directory:", Path('.').absolute(), file=sys.stderr)
+        print("Looking for environment files:", env_files, file=sys.stderr)
     
     for env_file in env_files:
         env_path = Path('.') / env_file
-        print(f"Checking {env_path.absolute()}", file=sys.stderr)
+        if verbose:
+            print(f"Checking {env_path.absolute()}", file=sys.stderr)
         if env_path.exists():
-            print(f"Found {env_file}, loading variables...", file=sys.stderr)
             load_dotenv(dotenv_path=env_path)
             env_loaded = True
-            print(f"Loaded environment variables from {env_file}", file=sys.stderr)
-            # Print loaded keys (but not values for security)
-            with open(env_path) as f:
-                keys = [line.split('=')[0].strip() for line in f if '=' in line and not line.startswith('#')]
-                print(f"Keys loaded from {env_file}: {keys}", file=sys.stderr)
+            if verbose:
+                print(f"Loaded environment variables from {env_file}", file=sys.stderr)
+                # Print loaded keys (but not values for security)
+                with open(env_path) as f:
+                    keys = [line.split('=')[0].strip() for line in f if '=' in line and not line.startswith('#')]
+                    print(f"Keys loaded from {env_file}: {keys}", file=sys.stderr)
     
-    if not env_loaded:
+    if not env_loaded and verbose:
         print("Warning: No .env files found. Using system environment variables only.", file=sys.stderr)
-        print("Available system environment variables:", list(os.environ.keys()), file=sys.stderr)
 
-# Load environment variables at module import
-load_environment()
+def ensure_environment(verbose: bool = False):
+    """Load the .env files once per process; later calls are no-ops."""
+    global _environment_loaded
+    if _environment_loaded:
+        return
+    with _environment_lock:
+        if not _environment_loaded:
+            load_environment(verbose=verbose)
+            _environment_loaded = True
 
 def encode_image_file(image_path: str) -> tuple[str, str]:
     """
@@ -65,162 +126,2367 @@ def encode_image_file(image_path: str) -> tuple[str, str]:
         
     return encoded_string, mime_type
 
-def create_llm_client(provider="openai"):
+# Largest image edge (pixels) each provider accepts without downscaling it itself
+IMAGE_MAX_EDGE = {"openai": 2048, "anthropic": 1568}
+# Further provider limits: OpenAI scales the shortest side to 768px, Anthropic to ~1.15 megapixels
+IMAGE_OPENAI_SHORT_EDGE = 768
+IMAGE_ANTHROPIC_MAX_PIXELS = 1_150_000
+# Images taller than IMAGE_TILE_ASPECT times their width are split into at most IMAGE_MAX_TILES tiles
+IMAGE_TILE_ASPECT = 2.0
+IMAGE_MAX_TILES = 4
+IMAGE_JPEG_QUALITY = 85
+IMAGE_CACHE_SIZE = 32
+
+_image_payloads = OrderedDict()
+_image_payloads_lock = threading.Lock()
+
+def _image_scale(width: int, height: int, provider: str) -> float:
+    """Return the downscale factor that fits an image within the provider's limits."""
+    scale = min(1.0, IMAGE_MAX_EDGE.get(provider, 2048) / max(width, height))
     if provider == "openai":
-        api_key = os.getenv('OPENAI_API_KEY')
-        if not api_key:
-            raise ValueError("OPENAI_API_KEY not found in environment variables")
-        return OpenAI(
-            api_key=api_key
+        scale = min(scale, IMAGE_OPENAI_SHORT_EDGE / min(width, height))
+    elif provider == "anthropic":
+        scale = min(scale, math.sqrt(IMAGE_ANTHROPIC_MAX_PIXELS / (width * height)))
+    return scale
+
+def _encode_image_tiles(data: bytes, provider: str) -> List[tuple[str, str]]:
+    """Downscale, tile and re-encode image bytes with Pillow."""
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+    if has_alpha and image.convert('RGBA').getextrema()[3][0] == 255:
+        has_alpha = False  # Fully opaque screenshots can be stored as JPEG
+
+    width, height = image.size
+    tile_height = height
+    if height > width * IMAGE_TILE_ASPECT:
+        tile_height = max(int(width * IMAGE_TILE_ASPECT), math.ceil(height / IMAGE_MAX_TILES))
+    tiles = [image.crop((0, top, width, min(height, top + tile_height))) for top in range(0, height, tile_height)]
+
+    payloads = []
+    for tile in tiles:
+        scale = _image_scale(tile.width, tile.height, provider)
+        if scale < 1.0:
+            tile = tile.resize((max(1, round(tile.width * scale)), max(1, round(tile.height * scale))),
+                               Image.LANCZOS)
+        buffer = io.BytesIO()
+        if has_alpha:
+            tile.save(buffer, format='PNG', optimize=True)
+            mime_type = 'image/png'
+        else:
+            tile.convert('RGB').save(buffer, format='JPEG', quality=IMAGE_JPEG_QUALITY, optimize=True)
+            mime_type = 'image/jpeg'
+        payloads.append((buffer.getvalue(), mime_type))
+
+    # An image that needed no resizing may already be smaller than its re-encoding
+    if len(tiles) == 1 and len(payloads[0][0]) >= len(data) and _image_scale(width, height, provider) >= 1.0:
+        return [(base64.b64encode(data).decode('utf-8'), Image.MIME.get(image.format, 'image/png'))]
+    return [(base64.b64encode(payload).decode('utf-8'), mime_type) for payload, mime_type in payloads]
+
+def prepare_image(image_path: str, provider: str = "openai") -> List[tuple[str, str]]:
+    """
+    Encode an image for a multimodal prompt, sized for the provider.
+    
+    Large images are downscaled to the provider's preferred resolution, tall
+    images (such as full-page screenshots) are split into tiles, and opaque images
+    are re-encoded as JPEG. Encoded payloads are cached in memory by content hash.
+    Without Pillow, or for files Pillow cannot read, the file is sent unchanged.
+    
+    Args:
+        image_path (str): Path to the image file
+        provider (str): The API provider the image is sent to
+        
+    Returns:
+        list: (base64_encoded_string, mime_type) tuples, one per tile
+    """
+    with open(image_path, 'rb') as image_file:
+        data = image_file.read()
+    key = (hashlib.sha256(data).hexdigest(), provider)
+    with _image_payloads_lock:
+        if key in _image_payloads:
+            _image_payloads.move_to_end(key)
+            return _image_payloads[key]
+
+    try:
+        payloads = _encode_image_tiles(data, provider)
+    except Exception:  # Pillow missing or not an image it can decode
+        payloads = [encode_image_file(image_path)]
+
+    with _image_payloads_lock:
+        _image_payloads[key] = payloads
+        while len(_image_payloads) > IMAGE_CACHE_SIZE:
+            _image_payloads.popitem(last=False)
+    return payloads
+
+# Approximate cache matching: 64-bit SimHash fingerprints split into LSH bands.
+# Fingerprints differing in fewer than SIMHASH_BANDS bits always share a band.
+SIMHASH_BITS = 64
+SIMHASH_BANDS = 8
+_SIMHASH_BAND_BITS = SIMHASH_BITS // SIMHASH_BANDS
+# Volatile tokens replaced before sketching, most specific first. Other numbers and
+# arithmetic operators carry meaning and are kept as separate tokens.
+_PROMPT_NORMALIZERS = [
+    (re.compile(r'\b\d{4}-\d{2}-\d{2}(?:[t ]\d{1,2}:\d{2}(?::\d{2}(?:\.\d+)?)?(?:z|[+-]\d{2}:?\d{2})?)?\b'), ' <time> '),
+    (re.compile(r'\b\d{1,2}:\d{2}(?::\d{2})?\b'), ' <time> '),
+    (re.compile(r'\b[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\b'), ' <id> '),
+    (re.compile(r'\b(?=[0-9a-f]*\d)[0-9a-f]{12,}\b'), ' <id> '),
+    (re.compile(r'([+*/=^%]|-(?=\s*\d))'), r' \1 '),
+    (re.compile(r'[^\w\s<>+*/=^%-]+|-(?!\s*\d)'), ' '),
+]
+# Numbers and operators that must match exactly for an approximate cache hit
+_PROMPT_LITERALS = re.compile(r'\d+(?:\.\d+)?|[+*/=^%]|-(?= \d)')
+
+def normalize_prompt(prompt: str) -> str:
+    """Lower-case a prompt, mask timestamps and ids, and drop punctuation and extra whitespace."""
+    text = prompt.lower()
+    for pattern, replacement in _PROMPT_NORMALIZERS:
+        text = pattern.sub(replacement, text)
+    return " ".join(text.split())
+
+def _prompt_literals(normalized: str) -> List[str]:
+    """Return the numbers and arithmetic operators of a normalized prompt, in order."""
+    return _PROMPT_LITERALS.findall(normalized)
+
+def simhash(text: str) -> int:
+    """Return the 64-bit SimHash of the words and word pairs of ``text``."""
+    words = text.split()
+    features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+    if not features:
+        return 0
+    bits = [format(int.from_bytes(hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest(), 'big'), '064b')
+            for feature in features]
+    fingerprint = 0
+    for column in zip(*bits):
+        fingerprint = (fingerprint << 1) | (column.count('1') * 2 > len(features))
+    return fingerprint
+
+def simhash_similarity(a: int, b: int) -> float:
+    """Fraction of equal bits between two fingerprints."""
+    return 1 - bin(a ^ b).count('1') / SIMHASH_BITS
+
+def _simhash_buckets(fingerprint: int) -> List[int]:
+    mask = (1 << _SIMHASH_BAND_BITS) - 1
+    return [band << _SIMHASH_BAND_BITS | (fingerprint >> (band * _SIMHASH_BAND_BITS)) & mask
+            for band in range(SIMHASH_BANDS)]
+
+def _to_sqlite_int(value: int) -> int:
+    # SQLite integers are signed 64-bit
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+class CachedResponse(str):
+    """
+    A response served from the ResponseCache.
+    
+    Behaves like the response text and carries ``provenance``: whether the match
+    was "exact" or "approximate", its similarity, and the key, prompt (for
+    approximate matches) and creation time of the entry that served it.
+    """
+
+    def __new__(cls, text: str, provenance: dict):
+        response = super().__new__(cls, text)
+        response.provenance = provenance
+        return response
+
+class ResponseCache:
+    """
+    Persistent on-disk cache for LLM responses.
+
+    Responses are stored in a SQLite database under ``cache_dir`` and keyed by a
+    hash of the provider, model, prompt, temperature and attached image content.
+    Entries older than ``ttl`` seconds are treated as misses, and the least
+    recently used entries are evicted once more than ``max_entries`` are stored.
+
+    With ``process_lock=True``, processes sharing ``cache_dir`` also coalesce
+    concurrent identical requests: one process queries the provider while the
+    others wait on a per-key lock file and then read its answer from the cache.
+
+    With a ``similarity_threshold`` (0-1], prompts that miss the exact cache are
+    also matched against earlier prompts for the same provider, model,
+    temperature and image: both are normalized (see normalize_prompt), sketched
+    with SimHash and looked up through an LSH band index, and the closest entry
+    at or above the threshold is served. Responses returned by the cache are
+    CachedResponse strings recording how they matched.
+    """
+
+    def __init__(self, cache_dir: Union[str, Path] = DEFAULT_CACHE_DIR, ttl: Optional[float] = 7 * 24 * 3600,
+                 max_entries: int = 10000, process_lock: bool = False,
+                 similarity_threshold: Optional[float] = None):
+        if similarity_threshold is not None and not 0 < similarity_threshold <= 1:
+            raise ValueError("similarity_threshold must be in (0, 1]")
+        self.cache_dir = Path(cache_dir).expanduser()
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.db_path = self.cache_dir / 'responses.sqlite3'
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.process_lock = process_lock and fcntl is not None
+        self.lock_dir = self.cache_dir / 'locks'
+        if self.process_lock:
+            self.lock_dir.mkdir(exist_ok=True)
+        self.similarity_threshold = similarity_threshold
+        self.hits = 0
+        self.misses = 0
+        self.approximate_hits = 0
+        self._counter_lock = threading.Lock()
+        with self.get_connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+                "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_accessed_at ON responses (accessed_at)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sketches ("
+                "key TEXT PRIMARY KEY, scope TEXT NOT NULL, simhash INTEGER NOT NULL, prompt TEXT NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sketch_buckets ("
+                "scope TEXT NOT NULL, bucket INTEGER NOT NULL, key TEXT NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_sketch_buckets ON sketch_buckets (scope, bucket)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_sketch_buckets_key ON sketch_buckets (key)")
+
+    @contextmanager
+    def get_connection(self):
+        """Open a connection to the cache database and commit on exit."""
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            yield conn
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _acquire_lock_file(self, key: str) -> tuple:
+        """Lock the file for ``key``; return (fd, contended)."""
+        path = self.lock_dir / f"{key}.lock"
+        contended = False
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                contended = True
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            # The previous holder unlinks the file on release; retry if we locked a stale inode
+            try:
+                if os.fstat(fd).st_ino == os.stat(path).st_ino:
+                    return fd, contended
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+
+    def _release_lock_file(self, key: str, fd: int):
+        try:
+            os.unlink(self.lock_dir / f"{key}.lock")
+        except FileNotFoundError:
+            pass
+        os.close(fd)
+
+    @contextmanager
+    def lock(self, key: str):
+        """
+        Hold the cross-process lock for ``key`` when ``process_lock`` is enabled.
+
+        Yields True if another process held the lock first, in which case its
+        response is probably in the cache by now.
+        """
+        if not self.process_lock:
+            yield False
+            return
+        fd, contended = self._acquire_lock_file(key)
+        try:
+            yield contended
+        finally:
+            self._release_lock_file(key, fd)
+
+    @asynccontextmanager
+    async def alock(self, key: str):
+        """Async counterpart of lock; waiting for the file lock happens off the event loop."""
+        if not self.process_lock:
+            yield False
+            return
+        fd, contended = await asyncio.to_thread(self._acquire_lock_file, key)
+        try:
+            yield contended
+        finally:
+            self._release_lock_file(key, fd)
+
+    @staticmethod
+    def make_key(provider: str, model: Optional[str], prompt: str, temperature: Optional[float] = None,
+                 image_path: Optional[str] = None, system_prompt: Optional[str] = None,
+                 max_tokens: Optional[int] = None) -> str:
+        """Build the content-addressed cache key for a request."""
+        image_hash = None
+        if image_path:
+            with open(image_path, 'rb') as image_file:
+                image_hash = hashlib.sha256(image_file.read()).hexdigest()
+        request = {
+            "provider": provider,
+            "model": model,
+            "prompt": prompt,
+            "temperature": temperature,
+            "image": image_hash,
+        }
+        # Only present when set, so keys of plain requests stay stable
+        if system_prompt is not None:
+            request["system"] = system_prompt
+        if max_tokens is not None:
+            request["max_tokens"] = max_tokens
+        payload = json.dumps(request, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def make_scope(provider: str, model: Optional[str], temperature: Optional[float] = None,
+                   image_path: Optional[str] = None, system_prompt: Optional[str] = None,
+                   max_tokens: Optional[int] = None) -> str:
+        """Identify the request parameters other than the prompt; approximate matches stay within a scope."""
+        return ResponseCache.make_key(provider, model, "", temperature, image_path, system_prompt, max_tokens)
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        """Return the cached response for ``key``, or None on a miss."""
+        now = time.time()
+        with self.get_connection() as conn:
+            row = conn.execute("SELECT response, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.ttl is not None and row[1] + self.ttl < now:
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                with self._counter_lock:
+                    self.misses += 1
+                return None
+            conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+        with self._counter_lock:
+            self.hits += 1
+        return CachedResponse(row[0], {"match": "exact", "similarity": 1.0, "key": key, "created_at": row[1]})
+
+    def get_similar(self, prompt: str, scope: str) -> Optional[CachedResponse]:
+        """
+        Return the response of the most similar earlier prompt in ``scope``.
+        
+        Only entries whose SimHash similarity reaches ``similarity_threshold``
+        and whose numbers and operators equal the prompt's qualify; returns None
+        when approximate matching is disabled.
+        """
+        if self.similarity_threshold is None:
+            return None
+        normalized = normalize_prompt(prompt)
+        literals = _prompt_literals(normalized)
+        fingerprint = simhash(normalized)
+        buckets = _simhash_buckets(fingerprint)
+        now = time.time()
+        with self.get_connection() as conn:
+            rows = conn.execute(
+                "SELECT s.key, s.simhash, s.prompt, r.response, r.created_at FROM sketches s "
+                "JOIN responses r ON r.key = s.key WHERE s.key IN "
+                f"(SELECT key FROM sketch_buckets WHERE scope = ? AND bucket IN ({','.join('?' * len(buckets))}))",
+                (scope, *buckets)
+            ).fetchall()
+            best = None
+            for key, stored, source_prompt, response, created_at in rows:
+                if self.ttl is not None and created_at + self.ttl < now:
+                    continue
+                similarity = simhash_similarity(fingerprint, stored % (1 << 64))
+                if similarity < self.similarity_threshold or (best is not None and similarity <= best[0]):
+                    continue
+                # "What is 17 * 23?" must not be answered from "What is 12 * 45?"
+                if _prompt_literals(normalize_prompt(source_prompt)) == literals:
+                    best = (similarity, key, source_prompt, response, created_at)
+            if best is None:
+                return None
+            similarity, key, source_prompt, response, created_at = best
+            conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+        with self._counter_lock:
+            self.approximate_hits += 1
+        return CachedResponse(response, {"match": "approximate", "similarity": similarity, "key": key,
+                                         "prompt": source_prompt, "created_at": created_at})
+
+    def set(self, key: str, response: str, prompt: Optional[str] = None, scope: Optional[str] = None):
+        """
+        Store a response and evict expired or least recently used entries.
+        
+        Pass the ``prompt`` and its ``scope`` to make the entry available to
+        approximate lookups.
+        """
+        now = time.time()
+        with self.get_connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, response, now, now)
+            )
+            if self.similarity_threshold is not None and prompt is not None and scope is not None:
+                fingerprint = simhash(normalize_prompt(prompt))
+                conn.execute("DELETE FROM sketch_buckets WHERE key = ?", (key,))
+                conn.execute("INSERT OR REPLACE INTO sketches (key, scope, simhash, prompt) VALUES (?, ?, ?, ?)",
+                             (key, scope, _to_sqlite_int(fingerprint), prompt))
+                conn.executemany("INSERT INTO sketch_buckets (scope, bucket, key) VALUES (?, ?, ?)",
+                                 [(scope, bucket, key) for bucket in _simhash_buckets(fingerprint)])
+            changes = conn.total_changes
+            if self.ttl is not None:
+                conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl,))
+            conn.execute(
+                "DELETE FROM responses WHERE key IN "
+                "(SELECT key FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+            if conn.total_changes != changes:
+                conn.execute("DELETE FROM sketches WHERE key NOT IN (SELECT key FROM responses)")
+                conn.execute("DELETE FROM sketch_buckets WHERE key NOT IN (SELECT key FROM responses)")
+
+    def stats(self) -> dict:
+        """Return hit/miss counters and the number of stored entries."""
+        with self.get_connection() as conn:
+            entries = conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "approximate_hits": self.approximate_hits,
+                "entries": entries}
+
+OPENAI_COMPATIBLE_PROVIDERS = ["openai", "local", "deepseek", "azure"]
+
+# Connection-pool limits for clients handed out by the shared registry
+SHARED_POOL_MAX_CONNECTIONS = 20
+SHARED_POOL_MAX_KEEPALIVE = 10
+SHARED_POOL_KEEPALIVE_EXPIRY = 120.0
+
+# Base URLs and API key variables of each provider
+_PROVIDER_ENDPOINTS = {
+    "openai": "https://api.openai.com/v1",
+    "azure": "https://msopenai.openai.azure.com",
+    "deepseek": "https://api.deepseek.com/v1",
+    "anthropic": "https://api.anthropic.com",
+    "gemini": "https://generativelanguage.googleapis.com",
+    "local": "http://192.168.180.137:8006/v1",
+}
+_PROVIDER_KEY_ENV = {
+    "openai": "OPENAI_API_KEY",
+    "azure": "AZURE_OPENAI_API_KEY",
+    "deepseek": "DEEPSEEK_API_KEY",
+    "anthropic": "ANTHROPIC_API_KEY",
+    "gemini": "GOOGLE_API_KEY",
+}
+
+_shared_clients = {}
+_shared_clients_lock = threading.Lock()
+# Async clients are bound to the loop they first ran on, so they are shared per loop
+_shared_async_clients: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict]' = weakref.WeakKeyDictionary()
+
+def _provider_endpoint(provider: str) -> str:
+    """Return the base URL of a provider; $LOCAL_LLM_URL overrides the local server."""
+    if provider == "local":
+        return os.getenv('LOCAL_LLM_URL') or _PROVIDER_ENDPOINTS[provider]
+    return _PROVIDER_ENDPOINTS[provider]
+
+def _get_api_key(provider: str) -> str:
+    env_var = _PROVIDER_KEY_ENV[provider]
+    api_key = os.getenv(env_var)
+    if not api_key:
+        raise ValueError(f"{env_var} not found in environment variables")
+    return api_key
+
+def _pooled_http_client(sdk_module: str, asynchronous: bool = False):
+    """Create an SDK-compatible HTTP client with tuned keep-alive pool limits."""
+    import httpx
+    sdk = importlib.import_module(sdk_module)
+    factory = sdk.DefaultAsyncHttpxClient if asynchronous else sdk.DefaultHttpxClient
+    return factory(limits=httpx.Limits(
+        max_connections=SHARED_POOL_MAX_CONNECTIONS,
+        max_keepalive_connections=SHARED_POOL_MAX_KEEPALIVE,
+        keepalive_expiry=SHARED_POOL_KEEPALIVE_EXPIRY,
+    ))
+
+def _build_llm_client(provider: str, pooled: bool = False, asynchronous: bool = False):
+    prefix = 'Async' if asynchronous else ''
+    # Retries are left to _call_with_retry, which honours the shared rate limiter
+    extra = {'max_retries': 0}
+    if pooled and provider in ["openai", "azure", "deepseek", "local"]:
+        extra.update(http_client=_pooled_http_client('openai', asynchronous))
+    elif pooled and provider == "anthropic":
+        extra.update(http_client=_pooled_http_client('anthropic', asynchronous))
+
+    if provider == "openai":
+        return _sdk(prefix + 'OpenAI')(
+            api_key=_get_api_key(provider),
+            **extra
         )
     elif provider == "azure":
-        api_key = os.getenv('AZURE_OPENAI_API_KEY')
-        if not api_key:
-            raise ValueError("AZURE_OPENAI_API_KEY not found in environment variables")
-        return AzureOpenAI(
-            api_key=api_key,
+        return _sdk(prefix + 'AzureOpenAI')(
+            api_key=_get_api_key(provider),
             api_version="2024-08-01-preview",
-            azure_endpoint="https://msopenai.openai.azure.com"
+            azure_endpoint=_PROVIDER_ENDPOINTS[provider],
+            **extra
         )
     elif provider == "deepseek":
-        api_key = os.getenv('DEEPSEEK_API_KEY')
-        if not api_key:
-            raise ValueError("DEEPSEEK_API_KEY not found in environment variables")
-        return OpenAI(
-            api_key=api_key,
-            base_url="https://api.deepseek.com/v1",
+        return _sdk(prefix + 'OpenAI')(
+            api_key=_get_api_key(provider),
+            base_url=_PROVIDER_ENDPOINTS[provider],
+            **extra
         )
     elif provider == "anthropic":
-        api_key = os.getenv('ANTHROPIC_API_KEY')
-        if not api_key:
-            raise ValueError("ANTHROPIC_API_KEY not found in environment variables")
-        return Anthropic(
-            api_key=api_key
+        return _sdk(prefix + 'Anthropic')(
+            api_key=_get_api_key(provider),
+            **extra
         )
     elif provider == "gemini":
-        api_key = os.getenv('GOOGLE_API_KEY')
-        if not api_key:
-            raise ValueError("GOOGLE_API_KEY not found in environment variables")
-        genai.configure(api_key=api_key)
+        genai = _sdk('genai')
+        genai.configure(api_key=_get_api_key(provider))
         return genai
     elif provider == "local":
-        return OpenAI(
-            base_url="http://192.168.180.137:8006/v1",
-            api_key="not-needed"
+        return _sdk(prefix + 'OpenAI')(
+            base_url=_provider_endpoint(provider),
+            api_key="not-needed",
+            **extra
         )
     else:
         raise ValueError(f"Unsupported provider: {provider}")
 
-def query_llm(prompt: str, client=None, model=None, provider="openai", image_path: Optional[str] = None) -> Optional[str]:
+def _shared_client_key(provider: str) -> tuple:
+    """Key shared clients by provider, endpoint and API key fingerprint."""
+    if provider not in _PROVIDER_ENDPOINTS:
+        raise ValueError(f"Unsupported provider: {provider}")
+    api_key = _get_api_key(provider) if provider in _PROVIDER_KEY_ENV else ""
+    return provider, _provider_endpoint(provider), hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16]
+
+def create_llm_client(provider="openai", shared: bool = False):
+    """
+    Create an LLM client for the given provider.
+
+    Args:
+        provider (str): The API provider to use
+        shared (bool): Return a process-wide client keyed by provider, endpoint and
+            API key fingerprint instead of a new one, so back-to-back queries reuse
+            the same keep-alive connection pool and TLS sessions
+
+    Returns:
+        The provider client (the ``google.generativeai`` module for Gemini)
+    """
+    ensure_environment()
+    if not shared:
+        return _build_llm_client(provider)
+
+    key = _shared_client_key(provider)
+    with _shared_clients_lock:
+        if key not in _shared_clients:
+            _shared_clients[key] = _build_llm_client(provider, pooled=True)
+        return _shared_clients[key]
+
+def clear_shared_clients():
+    """Close and forget every client in the shared registry."""
+    with _shared_clients_lock:
+        for client in _shared_clients.values():
+            close = getattr(client, 'close', None)
+            if callable(close):
+                close()
+        _shared_clients.clear()
+
+def create_async_llm_client(provider="openai", shared: bool = False):
+    """
+    Create an asyncio-native LLM client for the given provider.
+
+    Async clients own a connection pool bound to the running event loop, so create
+    one per loop and pass it to every aquery_llm call made on that loop.
+
+    Args:
+        provider (str): The API provider to use
+        shared (bool): Return the running event loop's client for this provider,
+            endpoint and API key instead of a new one (the async counterpart of
+            ``create_llm_client(shared=True)``); close them with
+            aclose_shared_clients() before the loop finishes
+
+    Returns:
+        The async provider client (the ``google.generativeai`` module for Gemini)
+    """
+    ensure_environment()
+    if not shared:
+        return _build_llm_client(provider, asynchronous=True)
+
+    key = _shared_client_key(provider)
+    clients = _shared_async_clients.setdefault(asyncio.get_running_loop(), {})
+    if key not in clients:
+        clients[key] = _build_llm_client(provider, pooled=True, asynchronous=True)
+    return clients[key]
+
+async def aclose_shared_clients():
+    """Close and forget the running event loop's shared async clients."""
+    clients = _shared_async_clients.pop(asyncio.get_running_loop(), {})
+    for client in clients.values():
+        close = getattr(client, 'close', None)
+        if callable(close):
+            result = close()
+            if asyncio.iscoroutine(result):
+                await result
+
+def _estimate_tokens(text: str) -> int:
+    """Roughly estimate the token count of a text (about four characters per token)."""
+    return max(1, len(text) // 4) if text else 0
+
+# Retry policy for throttled or transiently failing provider calls
+MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', '3'))
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504, 529}
+RETRYABLE_ERROR_NAMES = {'APITimeoutError', 'ResourceExhausted', 'ServiceUnavailable', 'DeadlineExceeded'}
+# An APIConnectionError is only retried when it was caused by a timeout or a dropped
+# connection; refused connections and DNS failures fail at once
+TRANSIENT_CONNECTION_ERRORS = (TimeoutError, ConnectionResetError, ConnectionAbortedError, BrokenPipeError)
+TRANSIENT_CONNECTION_ERROR_NAMES = {'ConnectTimeout', 'ReadTimeout', 'WriteTimeout', 'PoolTimeout',
+                                    'ReadError', 'WriteError', 'RemoteProtocolError'}
+
+class RateLimiter:
+    """
+    Token-bucket limiter for requests and tokens per minute.
+
+    One limiter is shared by every thread (``acquire``) and coroutine
+    (``acquire_async``) that talks to a provider. Time spent waiting for capacity
+    and in retry backoff is accumulated for reporting.
+    """
+
+    def __init__(self, requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._requests = requests_per_minute or 0.0
+        self._tokens = tokens_per_minute or 0.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.throttled_seconds = 0.0
+        self.throttled_calls = 0
+        self.retries = 0
+        self.backoff_seconds = 0.0
+
+    def _reserve(self, tokens: int) -> float:
+        """Take capacity for one request, or return how long to wait before trying again."""
+        with self._lock:
+            now = time.monotonic()
+            elapsed = now - self._updated
+            self._updated = now
+            rpm, tpm = self.requests_per_minute, self.tokens_per_minute
+            if rpm:
+                self._requests = min(rpm, self._requests + elapsed * rpm / 60)
+            if tpm:
+                self._tokens = min(tpm, self._tokens + elapsed * tpm / 60)
+                # A request larger than the bucket waits for a full bucket rather than forever
+                tokens = min(tokens, tpm)
+            wait = 0.0
+            if rpm and self._requests < 1:
+                wait = max(wait, (1 - self._requests) * 60 / rpm)
+            if tpm and self._tokens < tokens:
+                wait = max(wait, (tokens - self._tokens) * 60 / tpm)
+            if wait > 0:
+                return wait
+            if rpm:
+                self._requests -= 1
+            if tpm:
+                self._tokens -= tokens
+            return 0.0
+
+    def _record_throttle(self, waited: float):
+        if waited > 0:
+            with self._lock:
+                self.throttled_seconds += waited
+                self.throttled_calls += 1
+
+    def acquire(self, tokens: int = 0):
+        """Block the calling thread until the request fits within the limits."""
+        waited = 0.0
+        while (wait := self._reserve(tokens)) > 0:
+            time.sleep(wait)
+            waited += wait
+        self._record_throttle(waited)
+
+    async def acquire_async(self, tokens: int = 0):
+        """Wait on the event loop until the request fits within the limits."""
+        waited = 0.0
+        while (wait := self._reserve(tokens)) > 0:
+            await asyncio.sleep(wait)
+            waited += wait
+        self._record_throttle(waited)
+
+    def record_retry(self, delay: float):
+        with self._lock:
+            self.retries += 1
+            self.backoff_seconds += delay
+
+    def stats(self) -> dict:
+        """Return the time spent throttled and in retry backoff."""
+        with self._lock:
+            return {
+                "throttled_seconds": self.throttled_seconds,
+                "throttled_calls": self.throttled_calls,
+                "retries": self.retries,
+                "backoff_seconds": self.backoff_seconds,
+            }
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+def _env_float(name: str) -> Optional[float]:
+    value = os.getenv(name)
+    return float(value) if value else None
+
+def configure_rate_limit(provider: str, requests_per_minute: Optional[float] = None,
+                         tokens_per_minute: Optional[float] = None) -> RateLimiter:
+    """Set the request and token limits shared by all calls to a provider."""
+    with _rate_limiters_lock:
+        limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        _rate_limiters[provider] = limiter
+        return limiter
+
+def get_rate_limiter(provider: str) -> RateLimiter:
+    """
+    Return the shared limiter of a provider.
+
+    Limits default to the LLM_RATE_LIMIT_RPM_<PROVIDER> and
+    LLM_RATE_LIMIT_TPM_<PROVIDER> environment variables; without them the
+    limiter only tracks retries.
+    """
+    with _rate_limiters_lock:
+        if provider not in _rate_limiters:
+            _rate_limiters[provider] = RateLimiter(
+                _env_float(f'LLM_RATE_LIMIT_RPM_{provider.upper()}'),
+                _env_float(f'LLM_RATE_LIMIT_TPM_{provider.upper()}'),
+            )
+        return _rate_limiters[provider]
+
+def _retry_after(error: Exception) -> Optional[float]:
+    """Read the Retry-After header of a provider error, in seconds."""
+    headers = getattr(getattr(error, 'response', None), 'headers', None)
+    if not headers:
+        return None
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        value = headers.get('retry-after')
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def _without_sdk_retries(client):
+    """
+    Return ``client`` with the SDK's own retries turned off.
+
+    Clients built here already have max_retries=0; caller-supplied OpenAI and
+    Anthropic clients would otherwise retry inside each _call_with_retry
+    attempt, bypassing the rate limiter and the retry counters. The copy shares
+    the original's connection pool.
+    """
+    max_retries = getattr(client, 'max_retries', None)
+    if isinstance(max_retries, int) and max_retries > 0 and hasattr(client, 'with_options'):
+        return client.with_options(max_retries=0)
+    return client
+
+def _is_transient_connection_error(error: Exception) -> bool:
+    """Return whether a connection error was caused by a timeout or a dropped connection."""
+    seen = set()
+    cause = error.__cause__ or error.__context__
+    while cause is not None and id(cause) not in seen:
+        if isinstance(cause, TRANSIENT_CONNECTION_ERRORS) or type(cause).__name__ in TRANSIENT_CONNECTION_ERROR_NAMES:
+            return True
+        seen.add(id(cause))
+        cause = cause.__cause__ or cause.__context__
+    return False
+
+def _retry_delay(error: Exception, attempt: int) -> Optional[float]:
+    """Return the backoff before retrying ``error``, or None if it should not be retried."""
+    status = getattr(error, 'status_code', None) or getattr(error, 'code', None)
+    if not (isinstance(status, int) and status in RETRYABLE_STATUS_CODES) and \
+            type(error).__name__ not in RETRYABLE_ERROR_NAMES and \
+            not (type(error).__name__ == 'APIConnectionError' and _is_transient_connection_error(error)):
+        return None
+    retry_after = _retry_after(error)
+    if retry_after is not None:
+        return min(retry_after, RETRY_MAX_DELAY)
+    # Exponential backoff with jitter so concurrent callers do not retry in lockstep
+    return random.uniform(0.5, 1.0) * min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)
+
+def _call_with_retry(provider: str, call, tokens: int = 0, record: Optional[dict] = None):
+    """Run a provider call under its rate limiter, retrying throttled and transient errors."""
+    limiter = get_rate_limiter(provider)
+    for attempt in range(MAX_RETRIES + 1):
+        limiter.acquire(tokens)
+        try:
+            return call()
+        except Exception as e:
+            delay = _retry_delay(e, attempt)
+            if delay is None or attempt == MAX_RETRIES:
+                raise
+            print(f"LLM request failed ({e}), retrying in {delay:.1f}s", file=sys.stderr)
+            limiter.record_retry(delay)
+            if record is not None:
+                record["retries"] += 1
+            time.sleep(delay)
+
+async def _acall_with_retry(provider: str, call, tokens: int = 0, record: Optional[dict] = None):
+    """Async counterpart of _call_with_retry; ``call`` returns an awaitable."""
+    limiter = get_rate_limiter(provider)
+    for attempt in range(MAX_RETRIES + 1):
+        await limiter.acquire_async(tokens)
+        try:
+            return await call()
+        except Exception as e:
+            delay = _retry_delay(e, attempt)
+            if delay is None or attempt == MAX_RETRIES:
+                raise
+            print(f"LLM request failed ({e}), retrying in {delay:.1f}s", file=sys.stderr)
+            limiter.record_retry(delay)
+            if record is not None:
+                record["retries"] += 1
+            await asyncio.sleep(delay)
+
+def _default_model(provider: str) -> Optional[str]:
+    """Return the default model used by query_llm for a provider."""
+    if provider == "openai":
+        return "gpt-4o"
+    elif provider == "azure":
+        return os.getenv('AZURE_OPENAI_MODEL_DEPLOYMENT', 'gpt-4o-ms')  # Get from env with fallback
+    elif provider == "deepseek":
+        return "deepseek-chat"
+    elif provider == "anthropic":
+        return "claude-3-sonnet-20240229"
+    elif provider == "gemini":
+        return "gemini-pro"
+    elif provider == "local":
+        return "Qwen/Qwen2.5-32B-Instruct-AWQ"
+    return None
+
+def _request_temperature(provider: str, model: str) -> Optional[float]:
+    """Return the sampling temperature sent to the provider (part of the cache key)."""
+    return 0.7 if provider in OPENAI_COMPATIBLE_PROVIDERS and model != "o1" else None
+
+# Anthropic requires max_tokens on every request
+ANTHROPIC_DEFAULT_MAX_TOKENS = 1000
+
+def _openai_request(prompt: str, model: str, provider: str, image_path: Optional[str] = None,
+                    system_prompt: Optional[str] = None, max_tokens: Optional[int] = None) -> dict:
+    """
+    Build the chat.completions.create arguments for OpenAI-compatible providers.
+    
+    The system prompt is sent as the first message: OpenAI and DeepSeek cache
+    long identical prompt prefixes automatically, so it should hold the static part.
+    """
+    messages = [{"role": "user", "content": []}]
+    
+    # Add text content
+    messages[0]["content"].append({
+        "type": "text",
+        "text": prompt
+    })
+    
+    # Add image content if provided
+    if image_path:
+        if provider == "openai":
+            messages[0]["content"] = [{"type": "text", "text": prompt}] + [
+                {"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{encoded_image}"}}
+                for encoded_image, mime_type in prepare_image(image_path, provider)
+            ]
+    
+    if system_prompt:
+        messages.insert(0, {"role": "system", "content": system_prompt})
+    
+    kwargs = {
+        "model": model,
+        "messages": messages,
+        "temperature": 0.7,
+    }
+    
+    # Add o1-specific parameters
+    if model == "o1":
+        kwargs["response_format"] = {"type": "text"}
+        kwargs["reasoning_effort"] = "low"
+        del kwargs["temperature"]
+    if max_tokens is not None:
+        kwargs["max_completion_tokens" if model == "o1" else "max_tokens"] = max_tokens
+    return kwargs
+
+def _anthropic_request(prompt: str, model: str, image_path: Optional[str] = None,
+                       system_prompt: Optional[str] = None, max_tokens: Optional[int] = None) -> dict:
+    """
+    Build the messages.create arguments for Anthropic.
+    
+    The system prompt is marked for prompt caching, so later requests sharing it
+    read the prefix from Anthropic's cache instead of processing it again.
+    """
+    messages = [{"role": "user", "content": []}]
+    
+    # Add text content
+    messages[0]["content"].append({
+        "type": "text",
+        "text": prompt
+    })
+    
+    # Add image content if provided
+    if image_path:
+        for encoded_image, mime_type in prepare_image(image_path, "anthropic"):
+            messages[0]["content"].append({
+                "type": "image",
+                "source": {
+                    "type": "base64",
+                    "media_type": mime_type,
+                    "data": encoded_image
+                }
+            })
+    
+    kwargs = {
+        "model": model,
+        "max_tokens": ANTHROPIC_DEFAULT_MAX_TOKENS if max_tokens is None else max_tokens,
+        "messages": messages,
+    }
+    if system_prompt:
+        kwargs["system"] = [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}]
+    return kwargs
+
+def _gemini_request(client, model: str, system_prompt: Optional[str] = None,
+                    max_tokens: Optional[int] = None) -> tuple:
+    """Return the Gemini model object and generate_content keyword arguments."""
+    if system_prompt:
+        gemini_model = client.GenerativeModel(model, system_instruction=system_prompt)
+    else:
+        gemini_model = client.GenerativeModel(model)
+    kwargs = {}
+    if max_tokens is not None:
+        kwargs["generation_config"] = {"max_output_tokens": max_tokens}
+    return gemini_model, kwargs
+
+_call_hooks = []
+_stats_file_lock = threading.Lock()
+
+def add_call_hook(hook):
+    """Register a callable that receives the record of every LLM call."""
+    _call_hooks.append(hook)
+
+def remove_call_hook(hook):
+    _call_hooks.remove(hook)
+
+def _new_call_record(provider: str, model: Optional[str], mode: str) -> dict:
+    return {
+        "timestamp": time.time(),
+        "provider": provider,
+        "model": model,
+        "mode": mode,
+        "prompt_tokens": None,
+        "completion_tokens": None,
+        "cached_prompt_tokens": None,
+        "wall_time": None,
+        "time_to_first_byte": None,
+        "cache_hit": False,
+        "cache_similarity": None,
+        "coalesced": False,
+        "retries": 0,
+        "error": None,
+    }
+
+def _emit_call_record(record: dict):
+    """Pass a call record to the registered hooks and append it to $LLM_STATS_FILE."""
+    for hook in list(_call_hooks):
+        try:
+            hook(record)
+        except Exception as e:
+            print(f"Error in LLM call hook: {e}", file=sys.stderr)
+    stats_file = os.getenv('LLM_STATS_FILE')
+    if stats_file:
+        with _stats_file_lock, open(stats_file, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+def _as_int(value) -> Optional[int]:
+    return value if isinstance(value, int) else None
+
+def _cached_prompt_tokens(provider: str, usage) -> Optional[int]:
+    """Return the prompt tokens the provider served from its prompt cache."""
+    if usage is None:
+        return None
+    if provider == "anthropic":
+        return _as_int(getattr(usage, 'cache_read_input_tokens', None))
+    if provider == "gemini":
+        return _as_int(getattr(usage, 'cached_content_token_count', None))
+    return _as_int(getattr(getattr(usage, 'prompt_tokens_details', None), 'cached_tokens', None))
+
+def _usage_tokens(provider: str, usage) -> tuple:
+    """Return (prompt_tokens, completion_tokens) from a response's usage data."""
+    if usage is None:
+        return None, None
+    if provider == "anthropic":
+        return _as_int(getattr(usage, 'input_tokens', None)), _as_int(getattr(usage, 'output_tokens', None))
+    if provider == "gemini":
+        return (_as_int(getattr(usage, 'prompt_token_count', None)),
+                _as_int(getattr(usage, 'candidates_token_count', None)))
+    return _as_int(getattr(usage, 'prompt_tokens', None)), _as_int(getattr(usage, 'completion_tokens', None))
+
+def _response_usage(provider: str, response):
+    return getattr(response, 'usage_metadata' if provider == "gemini" else 'usage', None)
+
+def _percentile(sorted_values: List[float], q: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+class LatencyTracker:
+    """Rolling window of recent successful call latencies per provider and model."""
+
+    def __init__(self, window: int = 200, min_samples: int = 5):
+        self.window = window
+        self.min_samples = min_samples
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, provider: str, model: Optional[str], seconds: float):
+        with self._lock:
+            self._samples.setdefault((provider, model), deque(maxlen=self.window)).append(seconds)
+
+    def observe(self, record: dict):
+        """Call hook recording the latency of successful, uncached calls."""
+        if not record["error"] and not record["cache_hit"] and record["wall_time"] is not None:
+            self.record(record["provider"], record["model"], record["wall_time"])
+
+    def percentile(self, provider: str, model: Optional[str], q: float) -> Optional[float]:
+        """Return the ``q`` quantile (0-1) of recent latencies, or None without enough samples."""
+        with self._lock:
+            samples = sorted(self._samples.get((provider, model), ()))
+        if len(samples) < self.min_samples:
+            return None
+        return _percentile(samples, q)
+
+latency_tracker = LatencyTracker()
+add_call_hook(latency_tracker.observe)
+
+def _complete(prompt: str, client, model: str, provider: str, image_path: Optional[str] = None,
+              system_prompt: Optional[str] = None, max_tokens: Optional[int] = None) -> Optional[str]:
+    """Send one request to a provider and return the response text; errors propagate."""
+    client = _without_sdk_retries(client)
+    record = _new_call_record(provider, model, "sync")
+    start = time.perf_counter()
+    response_text = None
+    tokens = _estimate_tokens(prompt) + _estimate_tokens(system_prompt or "")
+    try:
+        if provider in OPENAI_COMPATIBLE_PROVIDERS:
+            kwargs = _openai_request(prompt, model, provider, image_path, system_prompt, max_tokens)
+            response = _call_with_retry(provider, lambda: client.chat.completions.create(**kwargs), tokens, record)
+            response_text = response.choices[0].message.content
+            
+        elif provider == "anthropic":
+            kwargs = _anthropic_request(prompt, model, image_path, system_prompt, max_tokens)
+            response = _call_with_retry(provider, lambda: client.messages.create(**kwargs), tokens, record)
+            response_text = response.content[0].text
+            
+        elif provider == "gemini":
+            gemini_model, kwargs = _gemini_request(client, model, system_prompt, max_tokens)
+            response = _call_with_retry(provider, lambda: gemini_model.generate_content(prompt, **kwargs), tokens,
+                                        record)
+            response_text = response.text
+        
+        if response_text is not None:
+            usage = _response_usage(provider, response)
+            record["prompt_tokens"], record["completion_tokens"] = _usage_tokens(provider, usage)
+            record["cached_prompt_tokens"] = _cached_prompt_tokens(provider, usage)
+        return response_text
+    except Exception as e:
+        record["error"] = str(e)
+        raise
+    finally:
+        record["wall_time"] = time.perf_counter() - start
+        # Non-streaming responses are only available once the whole body has arrived
+        record["time_to_first_byte"] = record["wall_time"]
+        _emit_call_record(record)
+
+async def _acomplete(prompt: str, client, model: str, provider: str, image_path: Optional[str] = None,
+                     system_prompt: Optional[str] = None, max_tokens: Optional[int] = None) -> Optional[str]:
+    """Async counterpart of _complete."""
+    client = _without_sdk_retries(client)
+    record = _new_call_record(provider, model, "async")
+    start = time.perf_counter()
+    response_text = None
+    tokens = _estimate_tokens(prompt) + _estimate_tokens(system_prompt or "")
+    try:
+        if provider in OPENAI_COMPATIBLE_PROVIDERS:
+            kwargs = _openai_request(prompt, model, provider, image_path, system_prompt, max_tokens)
+            response = await _acall_with_retry(provider, lambda: client.chat.completions.create(**kwargs), tokens,
+                                               record)
+            response_text = response.choices[0].message.content
+        
+        elif provider == "anthropic":
+            kwargs = _anthropic_request(prompt, model, image_path, system_prompt, max_tokens)
+            response = await _acall_with_retry(provider, lambda: client.messages.create(**kwargs), tokens, record)
+            response_text = response.content[0].text
+        
+        elif provider == "gemini":
+            gemini_model, kwargs = _gemini_request(client, model, system_prompt, max_tokens)
+            response = await _acall_with_retry(provider, lambda: gemini_model.generate_content_async(prompt, **kwargs),
+                                               tokens, record)
+            response_text = response.text
+        
+        if response_text is not None:
+            usage = _response_usage(provider, response)
+            record["prompt_tokens"], record["completion_tokens"] = _usage_tokens(provider, usage)
+            record["cached_prompt_tokens"] = _cached_prompt_tokens(provider, usage)
+        return response_text
+    except BaseException as e:  # Includes cancellation of a losing hedged request
+        record["error"] = str(e) or type(e).__name__
+        raise
+    finally:
+        record["wall_time"] = time.perf_counter() - start
+        record["time_to_first_byte"] = record["wall_time"]
+        _emit_call_record(record)
+
+def _emit_cache_hit(provider: str, model: Optional[str], mode: str, start: float,
+                    cached: Optional[CachedResponse] = None):
+    record = _new_call_record(provider, model, mode)
+    record["cache_hit"] = True
+    if cached is not None and cached.provenance["match"] == "approximate":
+        record["cache_similarity"] = cached.provenance["similarity"]
+    record["wall_time"] = time.perf_counter() - start
+    record["time_to_first_byte"] = record["wall_time"]
+    _emit_call_record(record)
+
+class _Flight:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls that share a key into a single execution.
+    
+    The first caller for a key runs the function; callers arriving while it is
+    in flight wait for it and receive the same result or exception.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._tasks = {}
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        """Run ``fn()`` unless a call with ``key`` is already in flight; return (result, coalesced)."""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self.coalesced += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+        try:
+            flight.result = fn()
+            return flight.result, False
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    async def ado(self, key, coro_fn):
+        """
+        Async counterpart of do.
+        
+        The shared call runs as its own task, so cancelling one waiter leaves the
+        request running for the others.
+        """
+        loop = asyncio.get_running_loop()
+        flight_key = (id(loop), key)
+        with self._lock:
+            task = self._tasks.get(flight_key)
+            coalesced = task is not None
+            if coalesced:
+                self.coalesced += 1
+            else:
+                task = self._tasks[flight_key] = loop.create_task(coro_fn())
+                task.add_done_callback(lambda done: self._finish_task(flight_key, done))
+        return await asyncio.shield(task), coalesced
+
+    def _finish_task(self, flight_key, task):
+        with self._lock:
+            self._tasks.pop(flight_key, None)
+        if not task.cancelled():
+            task.exception()  # Mark as retrieved when every waiter was cancelled
+
+_single_flight = SingleFlight()
+
+def _cache_lookup(cache: ResponseCache, key: str, prompt: str, scope: Optional[str]) -> Optional[CachedResponse]:
+    """Look a request up by exact key, then by prompt similarity when the cache allows it."""
+    cached = cache.get(key)
+    if cached is None and scope is not None:
+        cached = cache.get_similar(prompt, scope)
+    return cached
+
+def _emit_coalesced(provider: str, model: Optional[str], mode: str, start: float):
+    record = _new_call_record(provider, model, mode)
+    record["coalesced"] = True
+    record["wall_time"] = time.perf_counter() - start
+    record["time_to_first_byte"] = record["wall_time"]
+    _emit_call_record(record)
+
+def query_llm(prompt: str, client=None, model=None, provider="openai", image_path: Optional[str] = None,
+              cache: Optional[ResponseCache] = None, coalesce: bool = True, system_prompt: Optional[str] = None,
+              max_tokens: Optional[int] = None) -> Optional[str]:
     """
     Query an LLM with a prompt and optional image attachment.
     
+    Concurrent identical requests (same client, provider, model, prompt and
+    image) are coalesced into one upstream call unless ``coalesce`` is False.
+    Responses served from ``cache`` are CachedResponse strings whose
+    ``provenance`` tells whether they matched the prompt exactly or approximately.
+    
+    Put large static instructions into ``system_prompt``: it is sent ahead of
+    the prompt and marked for provider-side prompt caching on Anthropic, while
+    OpenAI and DeepSeek cache such identical prefixes automatically.
+    
     Args:
         prompt (str): The text prompt to send
         client: The LLM client instance
         model (str, optional): The model to use
         provider (str): The API provider to use
         image_path (str, optional): Path to an image file to attach
+        cache (ResponseCache, optional): Response cache to consult before querying the provider
+        coalesce (bool): Share the result of an identical request already in flight
+        system_prompt (str, optional): Static instructions sent before the prompt and cached by the provider
+        max_tokens (int, optional): Maximum response length (Anthropic default: 1000)
         
     Returns:
         Optional[str]: The LLM's response or None if there was an error
     """
+    ensure_environment()
     if client is None:
-        client = create_llm_client(provider)
+        client = create_llm_client(provider, shared=True)
     
     try:
         # Set default model
         if model is None:
-            if provider == "openai":
-                model = "gpt-4o"
-            elif provider == "azure":
-                model = os.getenv('AZURE_OPENAI_MODEL_DEPLOYMENT', 'gpt-4o-ms')  # Get from env with fallback
-            elif provider == "deepseek":
-                model = "deepseek-chat"
-            elif provider == "anthropic":
-                model = "claude-3-sonnet-20240229"
-            elif provider == "gemini":
-                model = "gemini-pro"
-            elif provider == "local":
-                model = "Qwen/Qwen2.5-32B-Instruct-AWQ"
-        
-        if provider in ["openai", "local", "deepseek", "azure"]:
-            messages = [{"role": "user", "content": []}]
-            
-            # Add text content
-            messages[0]["content"].append({
-                "type": "text",
-                "text": prompt
-            })
-            
-            # Add image content if provided
-            if image_path:
-                if provider == "openai":
-                    encoded_image, mime_type = encode_image_file(image_path)
-                    messages[0]["content"] = [
-                        {"type": "text", "text": prompt},
-                        {"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{encoded_image}"}}
-                    ]
-            
-            kwargs = {
-                "model": model,
-                "messages": messages,
-                "temperature": 0.7,
-            }
-            
-            # Add o1-specific parameters
-            if model == "o1":
-                kwargs["response_format"] = {"type": "text"}
-                kwargs["reasoning_effort"] = "low"
-                del kwargs["temperature"]
-            
-            response = client.chat.completions.create(**kwargs)
-            return response.choices[0].message.content
+            model = _default_model(provider)
+        
+        start = time.perf_counter()
+        temperature = _request_temperature(provider, model)
+        cache_key = None
+        if cache is not None or coalesce:
+            cache_key = ResponseCache.make_key(provider, model, prompt, temperature, image_path, system_prompt,
+                                               max_tokens)
+        scope = None
+        if cache is not None:
+            if cache.similarity_threshold is not None:
+                scope = cache.make_scope(provider, model, temperature, image_path, system_prompt, max_tokens)
+            cached = _cache_lookup(cache, cache_key, prompt, scope)
+            if cached is not None:
+                _emit_cache_hit(provider, model, "sync", start, cached)
+                return cached
+        
+        def fetch() -> Optional[str]:
+            if cache is None:
+                return _complete(prompt, client, model, provider, image_path, system_prompt, max_tokens)
+            with cache.lock(cache_key) as contended:
+                if contended:
+                    cached = cache.get(cache_key)
+                    if cached is not None:
+                        _emit_cache_hit(provider, model, "sync", start)
+                        return cached
+                response_text = _complete(prompt, client, model, provider, image_path, system_prompt, max_tokens)
+                if response_text is not None:
+                    cache.set(cache_key, response_text, prompt, scope)
+                return response_text
+        
+        if not coalesce:
+            return fetch()
+        response_text, coalesced = _single_flight.do((cache_key, id(client)), fetch)
+        if coalesced:
+            _emit_coalesced(provider, model, "sync", start)
+        return response_text
             
+    except Exception as e:
+        print(f"Error querying LLM: {e}", file=sys.stderr)
+        return None
+
+async def aquery_llm(prompt: str, client=None, model=None, provider="openai", image_path: Optional[str] = None,
+                     cache: Optional[ResponseCache] = None, coalesce: bool = True,
+                     system_prompt: Optional[str] = None, max_tokens: Optional[int] = None) -> Optional[str]:
+    """
+    Asynchronously query an LLM with a prompt and optional image attachment.
+    
+    Same defaults, image handling and request coalescing as query_llm, but
+    awaits the provider's async client so many requests can share one event loop.
+    
+    Args:
+        prompt (str): The text prompt to send
+        client: Async LLM client from create_async_llm_client (default: the
+            event loop's shared client for the provider)
+        model (str, optional): The model to use
+        provider (str): The API provider to use
+        image_path (str, optional): Path to an image file to attach
+        cache (ResponseCache, optional): Response cache to consult before querying the provider
+        coalesce (bool): Share the result of an identical request already in flight
+        system_prompt (str, optional): Static instructions sent before the prompt and cached by the provider
+        max_tokens (int, optional): Maximum response length (Anthropic default: 1000)
+        
+    Returns:
+        Optional[str]: The LLM's response or None if there was an error
+    """
+    ensure_environment()
+    if client is None:
+        client = create_async_llm_client(provider, shared=True)
+    
+    try:
+        if model is None:
+            model = _default_model(provider)
+        
+        start = time.perf_counter()
+        temperature = _request_temperature(provider, model)
+        cache_key = None
+        if cache is not None or coalesce:
+            cache_key = ResponseCache.make_key(provider, model, prompt, temperature, image_path, system_prompt,
+                                               max_tokens)
+        scope = None
+        if cache is not None:
+            if cache.similarity_threshold is not None:
+                scope = cache.make_scope(provider, model, temperature, image_path, system_prompt, max_tokens)
+            cached = _cache_lookup(cache, cache_key, prompt, scope)
+            if cached is not None:
+                _emit_cache_hit(provider, model, "async", start, cached)
+                return cached
+        
+        async def fetch() -> Optional[str]:
+            if cache is None:
+                return await _acomplete(prompt, client, model, provider, image_path, system_prompt, max_tokens)
+            async with cache.alock(cache_key) as contended:
+                if contended:
+                    cached = cache.get(cache_key)
+                    if cached is not None:
+                        _emit_cache_hit(provider, model, "async", start)
+                        return cached
+                response_text = await _acomplete(prompt, client, model, provider, image_path, system_prompt,
+                                                 max_tokens)
+                if response_text is not None:
+                    cache.set(cache_key, response_text, prompt, scope)
+                return response_text
+        
+        if not coalesce:
+            return await fetch()
+        response_text, coalesced = await _single_flight.ado((cache_key, id(client)), fetch)
+        if coalesced:
+            _emit_coalesced(provider, model, "async", start)
+        return response_text
+    
+    except Exception as e:
+        print(f"Error querying LLM: {e}", file=sys.stderr)
+        return None
+
+# Hedge after this many seconds until enough latencies are recorded to use the p95
+HEDGE_DEFAULT_DELAY = 10.0
+HEDGE_PERCENTILE = 0.95
+
+def _parse_target(target: Union[str, tuple]) -> tuple:
+    """Turn "provider", "provider:model" or (provider, model) into a (provider, model) tuple."""
+    if isinstance(target, tuple):
+        return target
+    provider, _, model = target.partition(':')
+    return provider, model or None
+
+def _hedge_delay(provider: str, model: Optional[str], hedge_delay: Optional[float] = None) -> float:
+    """Return how long to wait for a target before hedging."""
+    if hedge_delay is not None:
+        return hedge_delay
+    p95 = latency_tracker.percentile(provider, model or _default_model(provider), HEDGE_PERCENTILE)
+    return p95 or HEDGE_DEFAULT_DELAY
+
+def _start_daemon_call(fn, *args) -> Future:
+    """
+    Run ``fn(*args)`` on a daemon thread and return a Future for its result.
+
+    Unlike ThreadPoolExecutor workers, which the interpreter joins at exit, a
+    daemon thread still waiting on a losing hedged request does not keep the
+    process alive after the winner has been returned.
+    """
+    future = Future()
+
+    def target():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=target, name="llm-failover", daemon=True).start()
+    return future
+
+def query_llm_with_failover(prompt: str, chain: List[Union[str, tuple]], image_path: Optional[str] = None,
+                            hedge: bool = False, hedge_delay: Optional[float] = None,
+                            system_prompt: Optional[str] = None, max_tokens: Optional[int] = None) -> Optional[str]:
+    """
+    Query an ordered chain of providers, failing over on errors and optionally hedging.
+    
+    Targets are tried in order; when one errors or returns nothing the next one is
+    queried. With ``hedge=True`` the next target is also started if the current one
+    has not answered within ``hedge_delay`` seconds (by default the p95 latency
+    recorded for that provider and model), and the first answer wins. A losing
+    request cannot be interrupted mid-flight in a thread; it runs on a daemon
+    thread, so its result is discarded and it does not delay interpreter exit.
+    
+    Args:
+        prompt (str): The text prompt to send
+        chain (list): Targets as "provider", "provider:model" or (provider, model)
+        image_path (str, optional): Path to an image file to attach
+        hedge (bool): Start a backup request when the current one is slow
+        hedge_delay (float, optional): Seconds to wait before hedging
+        system_prompt (str, optional): Static instructions sent before the prompt (see query_llm)
+        max_tokens (int, optional): Maximum response length
+        
+    Returns:
+        Optional[str]: The first successful response or None if every target failed
+    """
+    ensure_environment()
+    targets = [_parse_target(target) for target in chain]
+
+    def run(provider: str, model: Optional[str]) -> Optional[str]:
+        client = create_llm_client(provider, shared=True)
+        return _complete(prompt, client, model or _default_model(provider), provider, image_path, system_prompt,
+                         max_tokens)
+
+    pending = {}
+    next_target = 0
+
+    def launch():
+        nonlocal next_target
+        provider, model = targets[next_target]
+        next_target += 1
+        pending[_start_daemon_call(run, provider, model)] = (provider, model)
+
+    try:
+        if targets:
+            launch()
+        while pending:
+            timeout = None
+            if hedge and len(pending) == 1 and next_target < len(targets):
+                provider, model = next(iter(pending.values()))
+                timeout = _hedge_delay(provider, model, hedge_delay)
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                print(f"No response from {targets[next_target - 1][0]} after {timeout:.1f}s, "
+                      f"hedging with {targets[next_target][0]}", file=sys.stderr)
+                launch()
+                continue
+            for future in done:
+                provider, _ = pending.pop(future)
+                try:
+                    response = future.result()
+                except Exception as e:
+                    print(f"Error querying {provider}: {e}", file=sys.stderr)
+                    response = None
+                if response is not None:
+                    return response
+            if not pending and next_target < len(targets):
+                launch()
+        return None
+    finally:
+        for future in pending:
+            future.cancel()
+
+async def aquery_llm_with_failover(prompt: str, chain: List[Union[str, tuple]], image_path: Optional[str] = None,
+                                   hedge: bool = False, hedge_delay: Optional[float] = None,
+                                   clients: Optional[dict] = None, system_prompt: Optional[str] = None,
+                                   max_tokens: Optional[int] = None) -> Optional[str]:
+    """
+    Async counterpart of query_llm_with_failover; losing hedged requests are cancelled.
+    
+    Args:
+        clients (dict, optional): Async clients by provider; missing ones are created
+            with create_async_llm_client
+    """
+    ensure_environment()
+    targets = [_parse_target(target) for target in chain]
+    clients = dict(clients or {})
+
+    async def run(provider: str, model: Optional[str]) -> Optional[str]:
+        if provider not in clients:
+            clients[provider] = create_async_llm_client(provider, shared=True)
+        return await _acomplete(prompt, clients[provider], model or _default_model(provider), provider, image_path,
+                                system_prompt, max_tokens)
+
+    pending = {}
+    next_target = 0
+
+    def launch():
+        nonlocal next_target
+        provider, model = targets[next_target]
+        next_target += 1
+        pending[asyncio.ensure_future(run(provider, model))] = (provider, model)
+
+    try:
+        if targets:
+            launch()
+        while pending:
+            timeout = None
+            if hedge and len(pending) == 1 and next_target < len(targets):
+                provider, model = next(iter(pending.values()))
+                timeout = _hedge_delay(provider, model, hedge_delay)
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                print(f"No response from {targets[next_target - 1][0]} after {timeout:.1f}s, "
+                      f"hedging with {targets[next_target][0]}", file=sys.stderr)
+                launch()
+                continue
+            for task in done:
+                provider, _ = pending.pop(task)
+                try:
+                    response = task.result()
+                except Exception as e:
+                    print(f"Error querying {provider}: {e}", file=sys.stderr)
+                    response = None
+                if response is not None:
+                    return response
+            if not pending and next_target < len(targets):
+                launch()
+        return None
+    finally:
+        for task in pending:
+            task.cancel()
+
+def _finish_stream(record: dict, stats: Optional[dict], start: float, first_token_at: Optional[float], text: str):
+    """Complete the call record of a stream and fill ``stats`` with its timings and throughput."""
+    end = time.perf_counter()
+    record["wall_time"] = end - start
+    record["time_to_first_byte"] = (first_token_at - start) if first_token_at else None
+    _emit_call_record(record)
+    if stats is None:
+        return
+    completion_tokens = record["completion_tokens"] or _estimate_tokens(text)
+    generation_time = end - (first_token_at or start)
+    stats.update({
+        "time_to_first_token": record["time_to_first_byte"],
+        "total_time": record["wall_time"],
+        "completion_tokens": completion_tokens,
+        "tokens_per_second": completion_tokens / generation_time if generation_time > 0 else None,
+    })
+
+def stream_llm(prompt: str, client=None, model=None, provider="openai", image_path: Optional[str] = None,
+               cache: Optional[ResponseCache] = None, stats: Optional[dict] = None,
+               system_prompt: Optional[str] = None, max_tokens: Optional[int] = None) -> Iterator[str]:
+    """
+    Query an LLM and yield text deltas as they arrive.
+    
+    Args:
+        prompt (str): The text prompt to send
+        client: The LLM client instance
+        model (str, optional): The model to use
+        provider (str): The API provider to use
+        image_path (str, optional): Path to an image file to attach
+        cache (ResponseCache, optional): A hit, exact or approximate as in
+            query_llm, is yielded as a single delta; a completed stream is
+            stored in the cache
+        stats (dict, optional): Filled at the end of the stream with
+            time_to_first_token, total_time, completion_tokens and tokens_per_second
+            (plus "error" if the request failed)
+        system_prompt (str, optional): Static instructions sent before the prompt (see query_llm)
+        max_tokens (int, optional): Maximum response length
+        
+    Yields:
+        str: Text deltas of the response
+    """
+    ensure_environment()
+    if client is None:
+        client = create_llm_client(provider, shared=True)
+    client = _without_sdk_retries(client)
+    if model is None:
+        model = _default_model(provider)
+    
+    cache_key = None
+    scope = None
+    if cache is not None:
+        temperature = _request_temperature(provider, model)
+        cache_key = cache.make_key(provider, model, prompt, temperature, image_path, system_prompt, max_tokens)
+        if cache.similarity_threshold is not None:
+            scope = cache.make_scope(provider, model, temperature, image_path, system_prompt, max_tokens)
+        cached = _cache_lookup(cache, cache_key, prompt, scope)
+        if cached is not None:
+            record = _new_call_record(provider, model, "stream")
+            record["cache_hit"] = True
+            if cached.provenance["match"] == "approximate":
+                record["cache_similarity"] = cached.provenance["similarity"]
+            start = time.perf_counter()
+            yield cached
+            _finish_stream(record, stats, start, time.perf_counter(), cached)
+            return
+    
+    record = _new_call_record(provider, model, "stream")
+    start = time.perf_counter()
+    first_token_at = None
+    parts = []
+    tokens = _estimate_tokens(prompt) + _estimate_tokens(system_prompt or "")
+    try:
+        if provider in OPENAI_COMPATIBLE_PROVIDERS:
+            kwargs = _openai_request(prompt, model, provider, image_path, system_prompt, max_tokens)
+            kwargs["stream"] = True
+            if provider == "openai":
+                kwargs["stream_options"] = {"include_usage": True}
+            stream = _call_with_retry(provider, lambda: client.chat.completions.create(**kwargs),
+                                      tokens, record)
+            for chunk in stream:
+                if getattr(chunk, "usage", None) is not None:
+                    record["prompt_tokens"], record["completion_tokens"] = _usage_tokens(provider, chunk.usage)
+                    record["cached_prompt_tokens"] = _cached_prompt_tokens(provider, chunk.usage)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    first_token_at = first_token_at or time.perf_counter()
+                    parts.append(chunk.choices[0].delta.content)
+                    yield chunk.choices[0].delta.content
+        
         elif provider == "anthropic":
-            messages = [{"role": "user", "content": []}]
-            
-            # Add text content
-            messages[0]["content"].append({
-                "type": "text",
-                "text": prompt
-            })
-            
-            # Add image content if provided
-            if image_path:
-                encoded_image, mime_type = encode_image_file(image_path)
-                messages[0]["content"].append({
-                    "type": "image",
-                    "source": {
-                        "type": "base64",
-                        "media_type": mime_type,
-                        "data": encoded_image
-                    }
-                })
-            
-            response = client.messages.create(
-                model=model,
-                max_tokens=1000,
-                messages=messages
-            )
-            return response.content[0].text
-            
+            kwargs = _anthropic_request(prompt, model, image_path, system_prompt, max_tokens)
+            with ExitStack() as stack:
+                # Opening the stream sends the request, so throttling surfaces (and is retried) here
+                stream = _call_with_retry(provider, lambda: stack.enter_context(client.messages.stream(**kwargs)),
+                                          tokens, record)
+                for text in stream.text_stream:
+                    first_token_at = first_token_at or time.perf_counter()
+                    parts.append(text)
+                    yield text
+                usage = stream.get_final_message().usage
+                record["prompt_tokens"], record["completion_tokens"] = _usage_tokens(provider, usage)
+                record["cached_prompt_tokens"] = _cached_prompt_tokens(provider, usage)
+        
         elif provider == "gemini":
-            model = client.GenerativeModel(model)
-            response = model.generate_content(prompt)
-            return response.text
-            
+            gemini_model, kwargs = _gemini_request(client, model, system_prompt, max_tokens)
+            response = _call_with_retry(provider, lambda: gemini_model.generate_content(prompt, stream=True, **kwargs),
+                                        tokens, record)
+            for chunk in response:
+                if chunk.text:
+                    first_token_at = first_token_at or time.perf_counter()
+                    parts.append(chunk.text)
+                    yield chunk.text
+    
     except Exception as e:
         print(f"Error querying LLM: {e}", file=sys.stderr)
-        return None
+        record["error"] = str(e)
+        _finish_stream(record, None, start, first_token_at, "")
+        if stats is not None:
+            stats["error"] = str(e)
+        return
+    
+    text = "".join(parts)
+    if cache is not None and parts:
+        cache.set(cache_key, text, prompt, scope)
+    _finish_stream(record, stats, start, first_token_at, text)
+
+async def astream_llm(prompt: str, client=None, model=None, provider="openai", image_path: Optional[str] = None,
+                      cache: Optional[ResponseCache] = None, stats: Optional[dict] = None,
+                      system_prompt: Optional[str] = None, max_tokens: Optional[int] = None) -> AsyncIterator[str]:
+    """
+    Asynchronously query an LLM and yield text deltas as they arrive.
+    
+    Takes the same arguments as stream_llm, with an async client from
+    create_async_llm_client.
+    """
+    ensure_environment()
+    if client is None:
+        client = create_async_llm_client(provider, shared=True)
+    client = _without_sdk_retries(client)
+    if model is None:
+        model = _default_model(provider)
+    
+    cache_key = None
+    scope = None
+    if cache is not None:
+        temperature = _request_temperature(provider, model)
+        cache_key = cache.make_key(provider, model, prompt, temperature, image_path, system_prompt, max_tokens)
+        if cache.similarity_threshold is not None:
+            scope = cache.make_scope(provider, model, temperature, image_path, system_prompt, max_tokens)
+        cached = _cache_lookup(cache, cache_key, prompt, scope)
+        if cached is not None:
+            record = _new_call_record(provider, model, "stream")
+            record["cache_hit"] = True
+            if cached.provenance["match"] == "approximate":
+                record["cache_similarity"] = cached.provenance["similarity"]
+            start = time.perf_counter()
+            yield cached
+            _finish_stream(record, stats, start, time.perf_counter(), cached)
+            return
+    
+    record = _new_call_record(provider, model, "stream")
+    start = time.perf_counter()
+    first_token_at = None
+    parts = []
+    tokens = _estimate_tokens(prompt) + _estimate_tokens(system_prompt or "")
+    try:
+        if provider in OPENAI_COMPATIBLE_PROVIDERS:
+            kwargs = _openai_request(prompt, model, provider, image_path, system_prompt, max_tokens)
+            kwargs["stream"] = True
+            if provider == "openai":
+                kwargs["stream_options"] = {"include_usage": True}
+            stream = await _acall_with_retry(provider, lambda: client.chat.completions.create(**kwargs),
+                                             tokens, record)
+            async for chunk in stream:
+                if getattr(chunk, "usage", None) is not None:
+                    record["prompt_tokens"], record["completion_tokens"] = _usage_tokens(provider, chunk.usage)
+                    record["cached_prompt_tokens"] = _cached_prompt_tokens(provider, chunk.usage)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    first_token_at = first_token_at or time.perf_counter()
+                    parts.append(chunk.choices[0].delta.content)
+                    yield chunk.choices[0].delta.content
+        
+        elif provider == "anthropic":
+            kwargs = _anthropic_request(prompt, model, image_path, system_prompt, max_tokens)
+            async with AsyncExitStack() as stack:
+                stream = await _acall_with_retry(
+                    provider, lambda: stack.enter_async_context(client.messages.stream(**kwargs)), tokens, record)
+                async for text in stream.text_stream:
+                    first_token_at = first_token_at or time.perf_counter()
+                    parts.append(text)
+                    yield text
+                usage = (await stream.get_final_message()).usage
+                record["prompt_tokens"], record["completion_tokens"] = _usage_tokens(provider, usage)
+                record["cached_prompt_tokens"] = _cached_prompt_tokens(provider, usage)
+        
+        elif provider == "gemini":
+            gemini_model, kwargs = _gemini_request(client, model, system_prompt, max_tokens)
+            response = await _acall_with_retry(
+                provider, lambda: gemini_model.generate_content_async(prompt, stream=True, **kwargs), tokens, record)
+            async for chunk in response:
+                if chunk.text:
+                    first_token_at = first_token_at or time.perf_counter()
+                    parts.append(chunk.text)
+                    yield chunk.text
+    
+    except Exception as e:
+        print(f"Error querying LLM: {e}", file=sys.stderr)
+        record["error"] = str(e)
+        _finish_stream(record, None, start, first_token_at, "")
+        if stats is not None:
+            stats["error"] = str(e)
+        return
+    
+    text = "".join(parts)
+    if cache is not None and parts:
+        cache.set(cache_key, text, prompt, scope)
+    _finish_stream(record, stats, start, first_token_at, text)
+
+def load_call_records(stats_file: Union[str, Path]) -> List[dict]:
+    """Read the per-call records appended to a stats file."""
+    records = []
+    with open(stats_file, encoding='utf-8') as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue  # Skip a line cut short by a concurrent writer
+    return records
+
+def summarize_call_records(records: List[dict]) -> dict:
+    """
+    Aggregate call records per (provider, model).
+    
+    Latency percentiles cover successful calls that reached the provider;
+    throughput is completion tokens per second of wall time over calls that
+    reported token usage.
+    """
+    groups = {}
+    for record in records:
+        groups.setdefault((record["provider"], record["model"]), []).append(record)
+    summary = {}
+    for key, group in sorted(groups.items(), key=lambda item: tuple(str(part) for part in item[0])):
+        served = [r for r in group if not r["error"] and not r["cache_hit"] and not r.get("coalesced")
+                  and r["wall_time"] is not None]
+        latencies = sorted(r["wall_time"] for r in served)
+        with_tokens = [r for r in served if r["completion_tokens"]]
+        token_time = sum(r["wall_time"] for r in with_tokens)
+        summary[key] = {
+            "calls": len(group),
+            "errors": sum(1 for r in group if r["error"]),
+            "cache_hits": sum(1 for r in group if r["cache_hit"]),
+            "coalesced": sum(1 for r in group if r.get("coalesced")),
+            "retries": sum(r["retries"] for r in group),
+            "p50": _percentile(latencies, 0.50) if latencies else None,
+            "p95": _percentile(latencies, 0.95) if latencies else None,
+            "p99": _percentile(latencies, 0.99) if latencies else None,
+            "prompt_tokens": sum(r["prompt_tokens"] or 0 for r in group),
+            "cached_prompt_tokens": sum(r.get("cached_prompt_tokens") or 0 for r in group),
+            "completion_tokens": sum(r["completion_tokens"] or 0 for r in group),
+            "tokens_per_second": sum(r["completion_tokens"] for r in with_tokens) / token_time if token_time else None,
+        }
+    return summary
+
+def print_call_stats(stats_file: Union[str, Path]):
+    """Print latency percentiles and token throughput per provider and model."""
+    def seconds(value):
+        return f"{value:.2f}s" if value is not None else "-"
+
+    summary = summarize_call_records(load_call_records(stats_file))
+    if not summary:
+        print(f"No calls recorded in {stats_file}")
+        return
+    print(f"{'provider/model':<45} {'calls':>6} {'errors':>6} {'cached':>6} {'shared':>6} {'retries':>7} "
+          f"{'p50':>7} {'p95':>7} {'p99':>7} {'in tok':>8} {'out tok':>8} {'tok/s':>7}")
+    for (provider, model), row in summary.items():
+        rate = f"{row['tokens_per_second']:.1f}" if row['tokens_per_second'] else "-"
+        print(f"{f'{provider}/{model}':<45} {row['calls']:>6} {row['errors']:>6} {row['cache_hits']:>6} "
+              f"{row['coalesced']:>6} {row['retries']:>7} {seconds(row['p50']):>7} {seconds(row['p95']):>7} "
+              f"{seconds(row['p99']):>7} {row['prompt_tokens']:>8} {row['completion_tokens']:>8} {rate:>7}")
+
+def _load_batch_progress(output_path: Union[str, Path]) -> dict:
+    """
+    Read the records already written to a batch output file, keyed by index.
+
+    The file is an append log: a later record for the same index (a failed
+    prompt re-run on resume) replaces the earlier one. A trailing partial line
+    left by an interrupted run is truncated so that new records are appended on
+    a clean line boundary.
+    """
+    path = Path(output_path)
+    if not path.exists():
+        return {}
+    records = {}
+    valid_bytes = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            if not line.endswith(b'\n') or not isinstance(record, dict) or not isinstance(record.get("index"), int):
+                break
+            records[record["index"]] = record
+            valid_bytes += len(line)
+    if valid_bytes < path.stat().st_size:
+        with open(path, 'r+b') as f:
+            f.truncate(valid_bytes)
+    return records
+
+def query_llm_batch(prompts: List[Union[str, dict]], client=None, model=None, provider="openai",
+                    max_concurrent: int = 4, output_path: Optional[Union[str, Path]] = None,
+                    cache: Optional[ResponseCache] = None, output_stream=None, system_prompt: Optional[str] = None,
+                    max_tokens: Optional[int] = None, retry_failed: bool = True) -> List[Optional[str]]:
+    """
+    Query an LLM with many prompts using a bounded number of concurrent requests.
+    
+    Args:
+        prompts (list): Prompt strings, or dicts with a "prompt" key and optional
+            "image", "model" and "id" keys
+        client: The LLM client instance, shared by all requests
+        model (str, optional): The model to use (default depends on provider)
+        provider (str): The API provider to use
+        max_concurrent (int): Maximum number of requests in flight
+        output_path (str, optional): JSONL file receiving one record per prompt in
+            input order as soon as all earlier prompts are done. Prompts already
+            recorded in the file are skipped, so an interrupted batch resumes where
+            it stopped.
+        cache (ResponseCache, optional): Response cache to consult before querying the provider
+        output_stream (file, optional): Stream that also receives each JSONL record
+        system_prompt (str, optional): Static instructions shared by every prompt, cached by the provider
+        max_tokens (int, optional): Maximum response length
+        retry_failed (bool): On resume, run prompts recorded with a null response
+            again; their new records are appended and replace the old ones
+        
+    Returns:
+        List[Optional[str]]: Responses in input order, None for failed prompts
+    """
+    items = [item if isinstance(item, dict) else {"prompt": item} for item in prompts]
+    done = _load_batch_progress(output_path) if output_path else {}
+    results = [done[index].get("response") if index in done else None for index in range(len(items))]
+    todo = [index for index in range(len(items))
+            if index not in done or (retry_failed and results[index] is None)]
+    if not todo:
+        return results
+
+    if client is None:
+        client = create_llm_client(provider, shared=True)
+
+    def run(index: int) -> Optional[str]:
+        item = items[index]
+        return query_llm(item["prompt"], client, model=item.get("model", model), provider=provider,
+                         image_path=item.get("image"), cache=cache, system_prompt=system_prompt,
+                         max_tokens=max_tokens)
+
+    output_file = open(output_path, 'a', encoding='utf-8') if output_path else None
+    executor = ThreadPoolExecutor(max_workers=max_concurrent)
+    try:
+        pending = {}
+        emitted = 0
+        submitted = 0
+        running = {}
+        while emitted < len(todo):
+            # Keep at most max_concurrent prompts submitted, so an interrupt leaves nothing queued
+            while submitted < len(todo) and len(running) < max_concurrent:
+                index = todo[submitted]
+                running[executor.submit(run, index)] = index
+                submitted += 1
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                pending[running.pop(future)] = future.result()
+            # Emit the contiguous prefix of finished prompts to keep input order
+            while emitted < len(todo) and todo[emitted] in pending:
+                index = todo[emitted]
+                response = results[index] = pending.pop(index)
+                record = {"index": index, "id": items[index].get("id"), "response": response}
+                line = json.dumps(record, ensure_ascii=False) + "\n"
+                for stream in (output_file, output_stream):
+                    if stream is not None:
+                        stream.write(line)
+                        stream.flush()
+                emitted += 1
+    except BaseException:
+        # Ctrl-C or a failing writer: drop queued prompts instead of waiting for them
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    finally:
+        executor.shutdown(wait=True)
+        if output_file is not None:
+            output_file.close()
+    return results
+
+def _read_batch_file(batch_file: str) -> List[Union[str, dict]]:
+    """Read prompts from a JSONL file of strings or {"prompt": ...} objects."""
+    prompts = []
+    with open(batch_file, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                prompts.append(json.loads(line))
+    return prompts
+
+# Embedding models per provider; "hashing" needs no API at all
+EMBEDDING_PROVIDERS = ["openai", "azure", "local", "gemini", "hashing"]
+EMBED_BATCH_SIZE = 100
+HASH_EMBEDDING_DIM = 512
+# CJK characters are single tokens (their bigrams stand in for words); other scripts split on word runs
+_EMBED_TOKEN = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]|\w+')
+
+def _default_embedding_model(provider: str) -> Optional[str]:
+    """Return the default embedding model used by embed for a provider."""
+    if provider == "openai":
+        return "text-embedding-3-small"
+    elif provider == "azure":
+        return os.getenv('AZURE_OPENAI_EMBEDDING_DEPLOYMENT', 'text-embedding-3-small')
+    elif provider == "local":
+        return os.getenv('LOCAL_EMBEDDING_MODEL', 'BAAI/bge-m3')
+    elif provider == "gemini":
+        return "models/text-embedding-004"
+    return None
+
+@lru_cache(maxsize=1 << 16)
+def _hash_feature(feature: str, dim: int) -> tuple:
+    digest = int.from_bytes(hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest(), 'big')
+    return digest % dim, 1.0 if digest >> 63 else -1.0
+
+def _hash_embedding(text: str, dim: int = HASH_EMBEDDING_DIM) -> List[float]:
+    """Embed text locally by hashing its words and word pairs into ``dim`` signed buckets."""
+    tokens = _EMBED_TOKEN.findall(text.lower())
+    counts = {}
+    for feature in tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]:
+        counts[feature] = counts.get(feature, 0) + 1
+    vector = [0.0] * dim
+    for feature, count in counts.items():
+        slot, sign = _hash_feature(feature, dim)
+        vector[slot] += sign * (1 + math.log(count))
+    norm = math.sqrt(sum(value * value for value in vector))
+    return [value / norm for value in vector] if norm else vector
+
+def embed(texts: Union[str, List[str]], provider: str = "openai", model: Optional[str] = None, client=None,
+          batch_size: int = EMBED_BATCH_SIZE) -> List[List[float]]:
+    """
+    Embed texts with a provider's embedding model, in batches.
+    
+    ``provider="hashing"`` embeds locally with feature hashing: no network, no
+    key, and a fixed HASH_EMBEDDING_DIM, at lower retrieval quality. Vectors from
+    different providers or models are not comparable, so the caller picks one
+    explicitly rather than falling back silently.
+    
+    Args:
+        texts (str or list): Text or texts to embed
+        provider (str): One of EMBEDDING_PROVIDERS
+        model (str, optional): The embedding model (default depends on provider)
+        client: The LLM client instance (default: the shared client of the provider)
+        batch_size (int): Texts per embedding request
+        
+    Returns:
+        List[List[float]]: One vector per text, in input order
+    """
+    if isinstance(texts, str):
+        texts = [texts]
+    if provider not in EMBEDDING_PROVIDERS:
+        raise ValueError(f"Provider {provider} has no embedding support; use one of {EMBEDDING_PROVIDERS}")
+    if provider == "hashing":
+        return [_hash_embedding(text) for text in texts]
+    
+    ensure_environment()
+    if client is None:
+        client = create_llm_client(provider, shared=True)
+    client = _without_sdk_retries(client)
+    if model is None:
+        model = _default_embedding_model(provider)
+    
+    vectors = []
+    for offset in range(0, len(texts), batch_size):
+        batch = texts[offset:offset + batch_size]
+        record = _new_call_record(provider, model, "embed")
+        start = time.perf_counter()
+        try:
+            if provider == "gemini":
+                response = _call_with_retry(provider, lambda: client.embed_content(model=model, content=batch),
+                                            sum(_estimate_tokens(text) for text in batch), record)
+                vectors.extend(response['embedding'])
+            else:
+                response = _call_with_retry(provider, lambda: client.embeddings.create(model=model, input=batch),
+                                            sum(_estimate_tokens(text) for text in batch), record)
+                vectors.extend(item.embedding for item in sorted(response.data, key=lambda item: item.index))
+                record["prompt_tokens"] = _as_int(getattr(response.usage, 'prompt_tokens', None))
+        except Exception as e:
+            record["error"] = str(e)
+            raise
+        finally:
+            record["wall_time"] = time.perf_counter() - start
+            record["time_to_first_byte"] = record["wall_time"]
+            _emit_call_record(record)
+    return vectors
+
+# Chunk sizes for query_llm_chunked, in estimated tokens
+CHUNK_TOKENS = 3000
+CHUNK_OVERLAP_TOKENS = 200
+# Preferred split points, best first; the text is only cut mid-word as a last resort
+_CHUNK_SEPARATORS = ["\n\n", "\n", ". ", "。", " "]
+_CHUNK_JOINER = "\n\n---\n\n"
+
+def split_text(text: str, chunk_tokens: int = CHUNK_TOKENS, overlap_tokens: int = CHUNK_OVERLAP_TOKENS) -> List[str]:
+    """
+    Split text into chunks of about ``chunk_tokens`` estimated tokens.
+    
+    Chunks end at a paragraph, line, sentence or word boundary when one falls in
+    the second half of the chunk, and consecutive chunks share about
+    ``overlap_tokens`` of text so content at a boundary is seen in context.
+    
+    Args:
+        text (str): The text to split
+        chunk_tokens (int): Target chunk size in estimated tokens
+        overlap_tokens (int): Overlap between consecutive chunks in estimated tokens
+        
+    Returns:
+        List[str]: The chunks in order; a single chunk when the text already fits
+    """
+    if chunk_tokens <= 0 or not 0 <= overlap_tokens < chunk_tokens:
+        raise ValueError("chunk_tokens must be positive and overlap_tokens smaller than chunk_tokens")
+    # Inverse of _estimate_tokens
+    chunk_chars = chunk_tokens * 4
+    overlap_chars = overlap_tokens * 4
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(start + chunk_chars, len(text))
+        if end < len(text):
+            for separator in _CHUNK_SEPARATORS:
+                cut = text.rfind(separator, start + chunk_chars // 2, end)
+                if cut != -1:
+                    end = cut + len(separator)
+                    break
+        chunk = text[start:end].strip()
+        if chunk:
+            chunks.append(chunk)
+        if end >= len(text):
+            break
+        next_start = end - overlap_chars
+        if overlap_chars:
+            # Start the overlap on a word boundary
+            space = text.find(" ", next_start, end)
+            if space != -1:
+                next_start = space + 1
+        start = max(next_start, start + 1)
+    return chunks
+
+def _fill_template(template: str, text: str) -> str:
+    # str.format would trip over literal braces in prompts
+    return template.replace("{text}", text)
+
+def query_llm_chunked(text: str, map_prompt: str, reduce_prompt: Optional[str] = None, client=None, model=None,
+                      provider="openai", chunk_tokens: int = CHUNK_TOKENS,
+                      overlap_tokens: int = CHUNK_OVERLAP_TOKENS, max_concurrent: int = 4,
+                      cache: Optional[ResponseCache] = None, system_prompt: Optional[str] = None,
+                      max_tokens: Optional[int] = None) -> Optional[str]:
+    """
+    Process text longer than the context window with a map-reduce over chunks.
+    
+    The text is split with split_text and ``map_prompt`` is run on every chunk
+    concurrently. The partial results are then merged with ``reduce_prompt``,
+    in several rounds if they do not fit into one chunk together. Text that fits
+    into a single chunk takes one ``map_prompt`` call and no reduce step.
+    
+    Args:
+        text (str): The long input text
+        map_prompt (str): Prompt template for each chunk; ``{text}`` is replaced by the chunk
+        reduce_prompt (str, optional): Prompt template merging partial results, with the
+            results joined into ``{text}`` (default: map_prompt)
+        client: The LLM client instance
+        model (str, optional): The model to use
+        provider (str): The API provider to use
+        chunk_tokens (int): Chunk size in estimated tokens
+        overlap_tokens (int): Overlap between chunks in estimated tokens
+        max_concurrent (int): Maximum number of requests in flight
+        cache (ResponseCache, optional): Response cache to consult before querying the provider
+        system_prompt (str, optional): Instructions shared by every chunk request, cached by the provider
+        max_tokens (int, optional): Maximum length of each response
+        
+    Returns:
+        Optional[str]: The merged result or None if any request failed
+    """
+    if "{text}" not in map_prompt or (reduce_prompt is not None and "{text}" not in reduce_prompt):
+        raise ValueError("map_prompt and reduce_prompt must contain a {text} placeholder")
+    reduce_prompt = reduce_prompt or map_prompt
+    
+    def run(template: str, inputs: List[str]) -> Optional[List[str]]:
+        results = query_llm_batch([_fill_template(template, item) for item in inputs], client, model=model,
+                                  provider=provider, max_concurrent=max_concurrent, cache=cache,
+                                  system_prompt=system_prompt, max_tokens=max_tokens)
+        if any(result is None for result in results):
+            print(f"Error in chunked query: {results.count(None)} of {len(results)} requests failed",
+                  file=sys.stderr)
+            return None
+        return results
+    
+    partials = run(map_prompt, split_text(text, chunk_tokens, overlap_tokens) or [""])
+    while partials is not None and len(partials) > 1:
+        # Merge as many partial results per request as fit into one chunk, at least two
+        groups = [[]]
+        for partial in partials:
+            group = groups[-1]
+            if len(group) >= 2 and _estimate_tokens(_CHUNK_JOINER.join(group + [partial])) > chunk_tokens:
+                groups.append([partial])
+            else:
+                group.append(partial)
+        partials = run(reduce_prompt, [_CHUNK_JOINER.join(group) for group in groups])
+    return partials[0] if partials else None
+
+DAEMON_HOST = '127.0.0.1'
+DEFAULT_DAEMON_PORT = 8765
+# Connection attempts to the daemon fail fast; a running query may take minutes
+DAEMON_QUERY_TIMEOUT = 600
+
+# Host headers the daemon answers to; anything else is a DNS-rebinding attempt
+_DAEMON_HOST_NAMES = {'127.0.0.1', 'localhost', '[::1]'}
+
+def _daemon_port() -> int:
+    return int(os.getenv('LLM_API_DAEMON_PORT', DEFAULT_DAEMON_PORT))
+
+def _daemon_token_path(port: int) -> Path:
+    """Return the file holding the access token of the daemon on ``port``."""
+    return DEFAULT_CACHE_DIR / f'daemon-{port}.token'
+
+def write_daemon_token(server: ThreadingHTTPServer) -> Path:
+    """Save the server's access token where query_daemon finds it, readable only by this user."""
+    path = _daemon_token_path(server.server_address[1])
+    path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        f.write(server.token)
+    return path
+
+class _DaemonHandler(BaseHTTPRequestHandler):
+    """
+    HTTP handler of the llm_api daemon; the server carries the shared cache and token.
+
+    Queries can read local files (``image_path``) and spend API credit, so they
+    must come from a local process that can read the token file: requests need
+    a loopback Host header (defeating DNS rebinding), a JSON content type (which
+    a web page cannot send cross-origin without a preflight this server never
+    answers) and the bearer token.
+    """
+
+    def _authorized(self, need_token: bool = True) -> bool:
+        host = (self.headers.get('Host') or '').rsplit(':', 1)[0].lower()
+        if host not in _DAEMON_HOST_NAMES:
+            self._send_json(403, {"error": "forbidden host"})
+            return False
+        if need_token:
+            supplied = self.headers.get('Authorization', '')
+            if not hmac.compare_digest(supplied.encode('utf-8'), f"Bearer {self.server.token}".encode('utf-8')):
+                self._send_json(403, {"error": "missing or invalid token"})
+                return False
+        return True
+
+    def _send_json(self, status: int, payload: dict):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if not self._authorized(need_token=self.path != '/health'):
+            return
+        if self.path == '/health':
+            self._send_json(200, {"status": "ok", "pid": os.getpid()})
+        elif self.path == '/stats':
+            cache = self.server.cache
+            self._send_json(200, {
+                "cache": cache.stats() if cache is not None else None,
+                "rate_limits": {provider: limiter.stats() for provider, limiter in _rate_limiters.items()},
+            })
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path != '/query':
+            self._send_json(404, {"error": "not found"})
+            return
+        if not self._authorized():
+            return
+        if self.headers.get('Content-Type', '').split(';')[0].strip().lower() != 'application/json':
+            self._send_json(415, {"error": "expected application/json"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            provider = request.get("provider", "openai")
+            response = query_llm(request["prompt"], model=request.get("model"), provider=provider,
+                                 image_path=request.get("image_path"),
+                                 cache=self.server.cache if request.get("use_cache", True) else None,
+                                 system_prompt=request.get("system_prompt"), max_tokens=request.get("max_tokens"))
+            self._send_json(200, {"response": response,
+                                  "provenance": getattr(response, "provenance", None)})
+        except Exception as e:
+            self._send_json(400, {"error": str(e)})
+
+    def log_message(self, format, *args):
+        print(f"llm_api daemon: {format % args}", file=sys.stderr)
+
+def create_daemon_server(host: str = DAEMON_HOST, port: Optional[int] = None,
+                         cache: Optional[ResponseCache] = None, token: Optional[str] = None) -> ThreadingHTTPServer:
+    """
+    Create the HTTP server of the resident llm_api daemon.
+    
+    The daemon keeps shared clients, the response cache and rate limiters warm
+    across queries. It only binds to localhost by default, and queries must
+    carry ``token`` (random by default; publish it with write_daemon_token).
+    """
+    server = ThreadingHTTPServer((host, _daemon_port() if port is None else port), _DaemonHandler)
+    server.daemon_threads = True
+    server.cache = cache
+    server.token = token or secrets.token_urlsafe(32)
+    return server
+
+def query_daemon(prompt: str, model=None, provider="openai", image_path: Optional[str] = None,
+                 use_cache: bool = True, port: Optional[int] = None, system_prompt: Optional[str] = None,
+                 max_tokens: Optional[int] = None, token: Optional[str] = None) -> Optional[str]:
+    """
+    Forward a query to a running llm_api daemon.
+    
+    ``token`` defaults to the one the daemon saved with write_daemon_token.
+    
+    Raises:
+        OSError: If no daemon is listening or its token file is missing
+        ValueError: If the daemon returned something other than a query result
+    """
+    port = _daemon_port() if port is None else port
+    if token is None:
+        token = _daemon_token_path(port).read_text(encoding='utf-8').strip()
+    payload = json.dumps({
+        "prompt": prompt,
+        "model": model,
+        "provider": provider,
+        "image_path": os.path.abspath(image_path) if image_path else None,
+        "use_cache": use_cache,
+        "system_prompt": system_prompt,
+        "max_tokens": max_tokens,
+    }).encode('utf-8')
+    request = urllib.request.Request(
+        f"http://{DAEMON_HOST}:{port}/query", data=payload,
+        headers={'Content-Type': 'application/json', 'Authorization': f"Bearer {token}"}, method='POST'
+    )
+    with urllib.request.urlopen(request, timeout=DAEMON_QUERY_TIMEOUT) as response:
+        result = json.loads(response.read())
+    if "response" not in result:
+        raise ValueError(result.get("error", "unexpected daemon reply"))
+    if result["response"] is not None and result.get("provenance"):
+        return CachedResponse(result["response"], result["provenance"])
+    return result["response"]
+
+def _report_provenance(response: Optional[str]):
+    if isinstance(response, CachedResponse) and response.provenance["match"] == "approximate":
+        print(f"Cache: approximate match (similarity {response.provenance['similarity']:.2f}) "
+              f"of earlier prompt: {response.provenance['prompt'][:80]!r}", file=sys.stderr)
 
 def main():
     parser = argparse.ArgumentParser(description='Query an LLM with a prompt')
-    parser.add_argument('--prompt', type=str, help='The prompt to send to the LLM', required=True)
+    parser.add_argument('command', nargs='?', choices=['query', 'stats', 'serve'], default='query',
+                        help='query (default) sends a prompt; stats summarises the calls recorded in the stats file; '
+                             'serve runs a resident daemon that later queries are forwarded to')
+    parser.add_argument('--prompt', type=str, help='The prompt to send to the LLM')
+    parser.add_argument('--system', type=str,
+                        help='Static instructions sent before the prompt and cached by the provider where supported')
+    parser.add_argument('--system-file', type=str, help='Read the system prompt from a file (e.g. .cursorrules)')
+    parser.add_argument('--max-tokens', type=int, help='Maximum response length (Anthropic default: 1000)')
     parser.add_argument('--provider', choices=['openai','anthropic','gemini','local','deepseek','azure'], default='openai', help='The API provider to use')
     parser.add_argument('--model', type=str, help='The model to use (default depends on provider)')
     parser.add_argument('--image', type=str, help='Path to an image file to attach to the prompt')
+    parser.add_argument('--cache-dir', type=str,
+                        help='Directory of the on-disk response cache; enables caching (default: $LLM_CACHE_DIR)')
+    parser.add_argument('--approx-cache', type=float, metavar='THRESHOLD',
+                        help='Also serve cached responses of similar prompts with SimHash similarity >= THRESHOLD '
+                             '(0-1, e.g. 0.9)')
+    parser.add_argument('--process-lock', action='store_true',
+                        help='Coalesce identical concurrent queries across processes sharing the cache directory')
+    parser.add_argument('--no-cache', action='store_true', help='Disable the response cache')
+    parser.add_argument('--verbose', action='store_true', help='Report which .env files were loaded')
+    parser.add_argument('--port', type=int,
+                        help=f'Daemon port on {DAEMON_HOST} (default: $LLM_API_DAEMON_PORT or {DEFAULT_DAEMON_PORT})')
+    parser.add_argument('--no-daemon', action='store_true',
+                        help='Always run the query in this process (implied by --cache-dir, --approx-cache, '
+                             '--process-lock and --stats-file, which the daemon cannot honour)')
+    parser.add_argument('--stats-file', type=str,
+                        help='JSONL file receiving a record of every LLM call (default: $LLM_STATS_FILE)')
+    parser.add_argument('--fallback', action='append', default=[], metavar='PROVIDER[:MODEL]',
+                        help='Provider to fail over to when the previous one errors (repeatable, in order)')
+    parser.add_argument('--hedge', action='store_true',
+                        help='Also query the next fallback if the current provider is slower than its p95 latency')
+    parser.add_argument('--hedge-delay', type=float,
+                        help=f'Seconds to wait before hedging (default: recorded p95 latency, '
+                             f'{HEDGE_DEFAULT_DELAY:g}s without history)')
+    parser.add_argument('--stream', action='store_true',
+                        help='Print the response as it is generated and report time-to-first-token and tokens/sec')
+    parser.add_argument('--batch-file', type=str,
+                        help='JSONL file of prompts (strings or {"prompt", "image", "id"} objects) to run as a batch')
+    parser.add_argument('--output', type=str,
+                        help='Batch mode: JSONL file for results; an existing file is resumed, re-running '
+                             'failed prompts (default: stdout)')
+    parser.add_argument('--no-retry-failed', action='store_true',
+                        help='Batch mode: when resuming, keep prompts that failed earlier as failed')
+    parser.add_argument('--max-concurrent', type=int, default=4,
+                        help='Batch and chunked modes: maximum number of concurrent requests (default: 4)')
+    parser.add_argument('--input-file', type=str,
+                        help='Long text to process in chunks; --prompt is applied to each chunk with {text} '
+                             'replaced by the chunk (or appended after it when there is no placeholder)')
+    parser.add_argument('--reduce-prompt', type=str,
+                        help='Chunked mode: prompt merging the per-chunk results given as {text} (default: --prompt)')
+    parser.add_argument('--chunk-tokens', type=int, default=CHUNK_TOKENS,
+                        help=f'Chunked mode: chunk size in estimated tokens (default: {CHUNK_TOKENS})')
+    parser.add_argument('--chunk-overlap', type=int, default=CHUNK_OVERLAP_TOKENS,
+                        help=f'Chunked mode: overlap between chunks in estimated tokens (default: {CHUNK_OVERLAP_TOKENS})')
     args = parser.parse_args()
+    if args.command == 'query' and not args.prompt and not args.batch_file:
+        parser.error('one of --prompt or --batch-file is required')
+    if args.fallback and (args.batch_file or args.stream):
+        parser.error('--fallback cannot be combined with --batch-file or --stream')
+    if args.approx_cache is not None and not 0 < args.approx_cache <= 1:
+        parser.error('--approx-cache must be between 0 and 1')
+    if args.input_file and (not args.prompt or args.batch_file or args.stream or args.fallback):
+        parser.error('--input-file needs --prompt and cannot be combined with --batch-file, --stream or --fallback')
+
+    if args.system and args.system_file:
+        parser.error('--system and --system-file cannot be combined')
+    if args.system_file:
+        with open(args.system_file, encoding='utf-8') as f:
+            args.system = f.read()
+
+    ensure_environment(verbose=args.verbose)
+    cache_flags = args.cache_dir or args.approx_cache is not None or args.process_lock or args.stats_file
+    args.cache_dir = args.cache_dir or os.getenv('LLM_CACHE_DIR')
+    if args.stats_file:
+        os.environ['LLM_STATS_FILE'] = args.stats_file
+    stats_file = os.getenv('LLM_STATS_FILE')
+
+    if args.command == 'stats':
+        if not stats_file or not os.path.exists(stats_file):
+            parser.error('stats needs an existing --stats-file or $LLM_STATS_FILE')
+        print_call_stats(stats_file)
+        return
 
     if not args.model:
         if args.provider == 'openai':
@@ -234,8 +2500,96 @@ def main():
         elif args.provider == 'azure':
             args.model = os.getenv('AZURE_OPENAI_MODEL_DEPLOYMENT', 'gpt-4o-ms')  # Get from env with fallback
 
-    client = create_llm_client(args.provider)
-    response = query_llm(args.prompt, client, model=args.model, provider=args.provider, image_path=args.image)
+    cache = None
+    if args.cache_dir and not args.no_cache:
+        cache = ResponseCache(args.cache_dir, process_lock=args.process_lock,
+                              similarity_threshold=args.approx_cache)
+
+    if args.command == 'serve':
+        server = create_daemon_server(port=args.port, cache=cache)
+        token_path = write_daemon_token(server)
+        print(f"llm_api daemon listening on http://{DAEMON_HOST}:{server.server_address[1]}", file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            token_path.unlink(missing_ok=True)
+        return
+
+    # The daemon uses its own cache and stats file, so queries asking for different ones run here
+    local_only = args.batch_file or args.stream or args.fallback or args.input_file or cache_flags
+    if not args.no_daemon and not local_only:
+        try:
+            response = query_daemon(args.prompt, model=args.model, provider=args.provider, image_path=args.image,
+                                    use_cache=not args.no_cache, port=args.port, system_prompt=args.system,
+                                    max_tokens=args.max_tokens)
+            _report_provenance(response)
+            print(response if response else "Failed to get response from LLM")
+            return
+        except (OSError, ValueError):
+            pass  # No daemon running; query in this process
+
+    if args.fallback:
+        if args.hedge and stats_file and os.path.exists(stats_file):
+            # Seed the p95 hedging deadlines with latencies from earlier runs
+            for record in load_call_records(stats_file):
+                latency_tracker.observe(record)
+        chain = [(args.provider, args.model)] + args.fallback
+        response = query_llm_with_failover(args.prompt, chain, image_path=args.image, hedge=args.hedge,
+                                           hedge_delay=args.hedge_delay, system_prompt=args.system,
+                                           max_tokens=args.max_tokens)
+        print(response if response else "Failed to get response from LLM")
+        return
+
+    client = create_llm_client(args.provider, shared=True)
+    if args.batch_file:
+        results = query_llm_batch(_read_batch_file(args.batch_file), client, model=args.model, provider=args.provider,
+                                  max_concurrent=args.max_concurrent, output_path=args.output, cache=cache,
+                                  output_stream=None if args.output else sys.stdout, system_prompt=args.system,
+                                  max_tokens=args.max_tokens, retry_failed=not args.no_retry_failed)
+        failed = sum(1 for result in results if result is None)
+        print(f"Batch finished: {len(results) - failed} succeeded, {failed} failed", file=sys.stderr)
+        if cache is not None:
+            print(f"Cache: {cache.hits} hit(s), {cache.misses} miss(es)", file=sys.stderr)
+        return
+
+    if args.input_file:
+        with open(args.input_file, encoding='utf-8') as f:
+            text = f.read()
+        map_prompt = args.prompt if "{text}" in args.prompt else args.prompt + "\n\n{text}"
+        reduce_prompt = args.reduce_prompt
+        if reduce_prompt and "{text}" not in reduce_prompt:
+            reduce_prompt += "\n\n{text}"
+        response = query_llm_chunked(text, map_prompt, reduce_prompt, client, model=args.model,
+                                     provider=args.provider, chunk_tokens=args.chunk_tokens,
+                                     overlap_tokens=args.chunk_overlap, max_concurrent=args.max_concurrent,
+                                     cache=cache, system_prompt=args.system, max_tokens=args.max_tokens)
+        print(response if response else "Failed to get response from LLM")
+        return
+
+    if args.stream:
+        stats = {}
+        for delta in stream_llm(args.prompt, client, model=args.model, provider=args.provider,
+                                image_path=args.image, cache=cache, stats=stats, system_prompt=args.system,
+                                max_tokens=args.max_tokens):
+            print(delta, end='', flush=True)
+        print()
+        if "error" in stats:
+            print("Failed to get response from LLM")
+        elif stats.get("time_to_first_token") is not None:
+            rate = stats["tokens_per_second"]
+            print(f"Time to first token: {stats['time_to_first_token']:.2f}s, "
+                  f"{stats['completion_tokens']} tokens in {stats['total_time']:.2f}s"
+                  + (f" ({rate:.1f} tokens/s)" if rate else ""), file=sys.stderr)
+        return
+
+    response = query_llm(args.prompt, client, model=args.model, provider=args.provider, image_path=args.image,
+                         cache=cache, system_prompt=args.system, max_tokens=args.max_tokens)
+    if cache is not None:
+        print(f"Cache: {cache.hits} hit(s), {cache.misses} miss(es)", file=sys.stderr)
+    _report_provenance(response)
     if response:
         print(response)
     else:
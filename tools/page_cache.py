@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+
+"""
+On-disk page cache for web_scraper.
+
+Fetched HTML and the text extracted from it are stored as zlib-compressed,
+content-addressed blobs (named by the SHA-256 of their content, so identical
+pages share storage) under ``cache_dir``, with a SQLite index keyed by URL.
+Entries follow the server's caching headers: ``Cache-Control: no-store``
+pages are never stored, freshness comes from ``max-age``/``Expires`` (or a
+heuristic based on ``Last-Modified``), and stale entries are revalidated with
+``If-None-Match``/``If-Modified-Since`` so an unchanged page costs one 304
+response instead of a download and a render. Least recently used pages are
+evicted once the blobs exceed ``max_bytes``.
+"""
+
+import argparse
+import hashlib
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import zlib
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+from typing import Dict, Mapping, Optional, Union
+
+DEFAULT_CACHE_DIR = Path.home() / '.cache' / 'web_scraper'
+DEFAULT_MAX_BYTES = 500 * 1024 * 1024
+# Freshness of pages whose response says nothing about it (or that were only rendered)
+DEFAULT_TTL = 3600
+# Heuristic freshness from Last-Modified (RFC 9111 4.2.2): a tenth of the page's age, capped
+HEURISTIC_FRACTION = 0.1
+HEURISTIC_MAX_TTL = 24 * 3600
+
+
+def parse_cache_control(value: Optional[str]) -> Dict[str, Optional[str]]:
+    """Parse a Cache-Control header into {directive: argument or None}."""
+    directives: Dict[str, Optional[str]] = {}
+    for part in (value or '').split(','):
+        name, _, argument = part.strip().partition('=')
+        if name:
+            directives[name.lower()] = argument.strip().strip('"') or None
+    return directives
+
+
+def _http_date(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
+
+
+def freshness_lifetime(headers: Optional[Mapping[str, str]], default_ttl: float = DEFAULT_TTL) -> Optional[float]:
+    """
+    Return how many seconds a response stays fresh, or None if it must not be stored.
+
+    Args:
+        headers: Response headers (case-insensitive mapping), or None for a
+            page that was rendered without an HTTP response to go by.
+        default_ttl: Lifetime of responses without any freshness information.
+    """
+    if headers is None:
+        return default_ttl
+    directives = parse_cache_control(headers.get('cache-control'))
+    if 'no-store' in directives:
+        return None
+    if 'no-cache' in directives:
+        return 0.0
+    try:
+        age = max(0.0, float(headers.get('age') or 0))
+    except ValueError:
+        age = 0.0
+    if directives.get('max-age') is not None:
+        try:
+            return max(0.0, int(directives['max-age']) - age)
+        except ValueError:
+            return 0.0
+    date = _http_date(headers.get('date')) or time.time()
+    if headers.get('expires') is not None:
+        expires = _http_date(headers.get('expires'))
+        # An invalid Expires value means already expired
+        return max(0.0, expires - date - age) if expires is not None else 0.0
+    last_modified = _http_date(headers.get('last-modified'))
+    if last_modified is not None and last_modified < date:
+        return min(HEURISTIC_MAX_TTL, (date - last_modified) * HEURISTIC_FRACTION)
+    return default_ttl
+
+
+class PageCache:
+    """
+    Content-addressed store of fetched pages and their extracted text.
+
+    Args:
+        cache_dir (str or Path): Directory holding the index and blobs.
+            Defaults to ~/.cache/web_scraper.
+        ttl (float, optional): Treat entries as fresh for this many seconds
+            after they were fetched or revalidated, ignoring the server's
+            caching headers (0 revalidates every time). Defaults to None,
+            which follows the headers.
+        max_bytes (int): Evict least recently used pages once the stored
+            blobs exceed this size. Defaults to 500 MB.
+        default_ttl (float): Freshness of pages whose headers give none.
+        refresh (bool): Ignore stored pages (get() returns None) while still
+            storing new ones, to rebuild the cache.
+    """
+
+    def __init__(self, cache_dir: Union[str, Path] = DEFAULT_CACHE_DIR, ttl: Optional[float] = None,
+                 max_bytes: int = DEFAULT_MAX_BYTES, default_ttl: float = DEFAULT_TTL, refresh: bool = False):
+        self.cache_dir = Path(cache_dir).expanduser()
+        self.blob_dir = self.cache_dir / 'blobs'
+        self.blob_dir.mkdir(parents=True, exist_ok=True)
+        self.db_path = self.cache_dir / 'pages.sqlite3'
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.refresh = refresh
+        self.hits = 0
+        self.revalidated = 0
+        self.stored = 0
+        self.text_hits = 0
+        with self.get_connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS pages ("
+                "url TEXT PRIMARY KEY, html_hash TEXT NOT NULL, etag TEXT, last_modified TEXT, "
+                "rendered INTEGER NOT NULL, stored_at REAL NOT NULL, validated_at REAL NOT NULL, "
+                "lifetime REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_pages_accessed_at ON pages (accessed_at)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS texts ("
+                "html_hash TEXT NOT NULL, parser TEXT NOT NULL, text_hash TEXT NOT NULL, "
+                "PRIMARY KEY (html_hash, parser))"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS blobs (hash TEXT PRIMARY KEY, size INTEGER NOT NULL)")
+
+    @contextmanager
+    def get_connection(self):
+        """Open a connection to the cache index and commit on exit."""
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            yield conn
+            conn.commit()
+        finally:
+            conn.close()
+
+    @staticmethod
+    def content_hash(content: str) -> str:
+        return hashlib.sha256(content.encode('utf-8', 'surrogatepass')).hexdigest()
+
+    def _blob_path(self, digest: str) -> Path:
+        return self.blob_dir / digest[:2] / digest
+
+    def _write_blob(self, conn: sqlite3.Connection, digest: str, content: str) -> None:
+        path = self._blob_path(digest)
+        # The file may have been removed behind the cache's back; then write it again
+        if conn.execute("SELECT 1 FROM blobs WHERE hash = ?", (digest,)).fetchone() and path.exists():
+            return
+        path.parent.mkdir(exist_ok=True)
+        data = zlib.compress(content.encode('utf-8', 'surrogatepass'), 6)
+        # Write to a temporary file and rename so readers never see a partial blob
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except FileNotFoundError:
+                pass
+            raise
+        conn.execute("INSERT OR REPLACE INTO blobs (hash, size) VALUES (?, ?)", (digest, len(data)))
+
+    def _read_blob(self, digest: str) -> Optional[str]:
+        try:
+            return zlib.decompress(self._blob_path(digest).read_bytes()).decode('utf-8', 'surrogatepass')
+        except (OSError, zlib.error):
+            return None
+
+    def _is_fresh(self, row: Dict, now: float) -> bool:
+        lifetime = self.ttl if self.ttl is not None else row['lifetime']
+        return now - row['validated_at'] < lifetime
+
+    def get(self, url: str) -> Optional[Dict]:
+        """
+        Return the cached entry for ``url``, fresh or not, or None.
+
+        The entry is a dict with the page's ``html``, its ``etag`` and
+        ``last_modified`` validators, whether it was ``rendered`` in a
+        browser, and ``fresh`` (False means revalidate before use).
+        """
+        if self.refresh:
+            return None
+        with self.get_connection() as conn:
+            conn.row_factory = sqlite3.Row
+            row = conn.execute("SELECT * FROM pages WHERE url = ?", (url,)).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            conn.execute("UPDATE pages SET accessed_at = ? WHERE url = ?", (now, url))
+        html = self._read_blob(row['html_hash'])
+        if html is None:
+            self.delete(url)
+            return None
+        entry = dict(row)
+        entry.update(html=html, rendered=bool(row['rendered']), fresh=self._is_fresh(entry, now))
+        if entry['fresh']:
+            self.hits += 1
+        return entry
+
+    def conditional_headers(self, entry: Optional[Dict]) -> Dict[str, str]:
+        """Return the If-None-Match / If-Modified-Since headers for revalidating ``entry``."""
+        headers = {}
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def put(self, url: str, html: str, headers: Optional[Mapping[str, str]] = None,
+            rendered: bool = False) -> bool:
+        """
+        Store ``html`` for ``url`` unless its headers forbid it; return whether it was stored.
+
+        ``headers`` are the HTTP response headers of the page, or None when it
+        was rendered without a usable response.
+        """
+        lifetime = freshness_lifetime(headers, self.default_ttl)
+        if lifetime is None:
+            self.delete(url)
+            return False
+        digest = self.content_hash(html)
+        now = time.time()
+        headers = headers or {}
+        with self.get_connection() as conn:
+            previous = conn.execute("SELECT html_hash FROM pages WHERE url = ?", (url,)).fetchone()
+            self._write_blob(conn, digest, html)
+            conn.execute(
+                "INSERT OR REPLACE INTO pages (url, html_hash, etag, last_modified, rendered, stored_at, "
+                "validated_at, lifetime, accessed_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (url, digest, headers.get('etag'), headers.get('last-modified'), int(rendered),
+                 now, now, lifetime, now),
+            )
+            if previous is not None and previous[0] != digest:
+                self._collect_garbage(conn)
+            self._evict(conn)
+        self.stored += 1
+        return True
+
+    def mark_revalidated(self, url: str, headers: Mapping[str, str]) -> None:
+        """Record a 304 Not Modified for ``url``, refreshing its lifetime and validators."""
+        lifetime = freshness_lifetime(headers, self.default_ttl)
+        if lifetime is None:
+            self.delete(url)
+            return
+        with self.get_connection() as conn:
+            conn.execute(
+                "UPDATE pages SET validated_at = ?, lifetime = ?, etag = COALESCE(?, etag), "
+                "last_modified = COALESCE(?, last_modified) WHERE url = ?",
+                (time.time(), lifetime, headers.get('etag'), headers.get('last-modified'), url),
+            )
+        self.revalidated += 1
+
+    def delete(self, url: str) -> None:
+        with self.get_connection() as conn:
+            conn.execute("DELETE FROM pages WHERE url = ?", (url,))
+            self._collect_garbage(conn)
+
+    def get_text(self, html: str, parser: str) -> Optional[str]:
+        """Return text previously extracted from exactly this HTML with ``parser``."""
+        with self.get_connection() as conn:
+            row = conn.execute("SELECT text_hash FROM texts WHERE html_hash = ? AND parser = ?",
+                               (self.content_hash(html), parser)).fetchone()
+        text = self._read_blob(row[0]) if row else None
+        if text is not None:
+            self.text_hits += 1
+        return text
+
+    def put_text(self, html: str, parser: str, text: str) -> None:
+        """Store the text extracted from ``html`` with ``parser``, if the HTML itself is cached."""
+        html_hash = self.content_hash(html)
+        text_hash = self.content_hash(text)
+        with self.get_connection() as conn:
+            if not conn.execute("SELECT 1 FROM pages WHERE html_hash = ? LIMIT 1", (html_hash,)).fetchone():
+                return
+            self._write_blob(conn, text_hash, text)
+            conn.execute("INSERT OR REPLACE INTO texts (html_hash, parser, text_hash) VALUES (?, ?, ?)",
+                         (html_hash, parser, text_hash))
+
+    def _evict(self, conn: sqlite3.Connection) -> None:
+        """Drop least recently used pages until the blobs fit in max_bytes."""
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for (url,) in conn.execute("SELECT url FROM pages ORDER BY accessed_at").fetchall():
+            conn.execute("DELETE FROM pages WHERE url = ?", (url,))
+            self._collect_garbage(conn)
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+            if total <= self.max_bytes:
+                break
+
+    def _collect_garbage(self, conn: sqlite3.Connection) -> None:
+        """Delete texts of HTML no page refers to, then blobs nothing refers to."""
+        conn.execute("DELETE FROM texts WHERE html_hash NOT IN (SELECT html_hash FROM pages)")
+        orphans = conn.execute(
+            "SELECT hash FROM blobs WHERE hash NOT IN (SELECT html_hash FROM pages) "
+            "AND hash NOT IN (SELECT text_hash FROM texts)"
+        ).fetchall()
+        for (digest,) in orphans:
+            try:
+                self._blob_path(digest).unlink()
+            except FileNotFoundError:
+                pass
+            conn.execute("DELETE FROM blobs WHERE hash = ?", (digest,))
+
+    def clear(self) -> None:
+        """Remove every page, text and blob."""
+        with self.get_connection() as conn:
+            conn.execute("DELETE FROM pages")
+            self._collect_garbage(conn)
+
+    def stats(self) -> dict:
+        """Return hit counters, the number of stored pages and the blob size in bytes."""
+        with self.get_connection() as conn:
+            pages = conn.execute("SELECT COUNT(*) FROM pages").fetchone()[0]
+            size = conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+        return {"hits": self.hits, "revalidated": self.revalidated, "stored": self.stored,
+                "text_hits": self.text_hits, "pages": pages, "bytes": size}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or clear web_scraper's page cache.")
+    parser.add_argument('command', choices=['stats', 'clear'], help='stats: show cache size; clear: empty the cache')
+    parser.add_argument('--cache-dir', default=os.getenv('WEB_SCRAPER_CACHE_DIR') or str(DEFAULT_CACHE_DIR),
+                        help='Cache directory (default: $WEB_SCRAPER_CACHE_DIR or ~/.cache/web_scraper)')
+    args = parser.parse_args()
+
+    cache = PageCache(args.cache_dir)
+    if args.command == 'clear':
+        cache.clear()
+        print(f"Cleared {cache.cache_dir}", file=sys.stderr)
+    else:
+        stats = cache.stats()
+        print(f"{stats['pages']} pages, {stats['bytes'] / (1024 * 1024):.1f} MB in {cache.cache_dir}")
+
+
+if __name__ == '__main__':
+    main()
@@ -6,9 +6,20 @@ import os
 import tempfile
 from pathlib import Path
 
+try:
+    from tools.browser_pool import browser_pool_scope
+except ImportError:  # Run as a script from the tools directory
+    from browser_pool import browser_pool_scope
+
 async def take_screenshot(url: str, output_path: str = None, width: int = 1280, height: int = 720) -> str:
     """
     Take a screenshot of a webpage using Playwright.
+
+    The page comes from the event loop's shared browser pool, so repeated
+    screenshots reuse a warm browser instead of launching Chromium each time.
+    If the loop had no pool open yet, the one started here is closed again
+    before returning; open one first (e.g. with browser_pool_scope()) to keep
+    it warm across calls.
     
     Args:
         url (str): The URL to take a screenshot of
@@ -25,21 +36,19 @@ async def take_screenshot(url: str, output_path: str = None, width: int = 1280,
         output_path = temp_file.name
         temp_file.close()
 
-    async with async_playwright() as p:
-        browser = await p.chromium.launch(headless=True)
-        page = await browser.new_page(viewport={'width': width, 'height': height})
-        
-        try:
+    async with browser_pool_scope(playwright_factory=async_playwright) as pool:
+        async with pool.page(viewport={'width': width, 'height': height}) as page:
             await page.goto(url, wait_until='networkidle')
             await page.screenshot(path=output_path, full_page=True)
-        finally:
-            await browser.close()
     
     return output_path
 
 def take_screenshot_sync(url: str, output_path: str = None, width: int = 1280, height: int = 720) -> str:
     """
     Synchronous wrapper for take_screenshot.
+
+    Each call runs its own event loop, so the browser is closed afterwards;
+    set BROWSER_CDP_URL to reuse a browser started with 'browser_pool.py serve'.
     """
     return asyncio.run(take_screenshot(url, output_path, width, height))
 
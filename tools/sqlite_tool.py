@@ -5,11 +5,17 @@ import sqlite3
 import json
 import csv
 import argparse
+import os
 import sys
 from pathlib import Path
 from typing import Union, List, Dict, Any, Optional
 from contextlib import contextmanager
 
+try:
+    import numpy as np
+except ImportError:  # 仅向量索引需要 NumPy
+    np = None
+
 class SQLiteTools:
     def __init__(self, db_path: str):
         """初始化SQLite工具类
@@ -132,6 +138,166 @@ class SQLiteTools:
             writer.writeheader()
             writer.writerows(results)
 
+def _llm_api():
+    """延迟导入 llm_api，普通 SQL 操作不需要加载它"""
+    try:
+        from tools import llm_api
+    except ImportError:  # 以脚本方式运行 tools/sqlite_tool.py 时
+        import llm_api
+    return llm_api
+
+class VectorIndex:
+    """基于 NumPy 的向量索引，与 SQLiteTools 数据库存放在一起
+
+    向量以 float32 矩阵保存在数据库旁的 ``<数据库名>.<索引名>.npy`` 文件中，
+    文本和元数据保存在数据库的 vector_entries 表中，行号与矩阵行一一对应。
+    向量在写入前归一化，检索时用一次矩阵乘法计算余弦相似度。
+    """
+
+    def __init__(self, db_path: str, name: str = "default", provider: str = "hashing",
+                 model: Optional[str] = None):
+        """初始化向量索引
+
+        Args:
+            db_path: 数据库文件路径
+            name: 索引名，同一数据库可以有多个索引
+            provider: 向量化服务，见 llm_api.EMBEDDING_PROVIDERS（默认 hashing，完全本地）
+            model: 向量化模型（默认取决于 provider）
+        """
+        if np is None:
+            raise ImportError("向量索引需要 NumPy，请先安装: pip install numpy")
+        self.tools = SQLiteTools(db_path)
+        self.name = name
+        db_file = Path(db_path)
+        self.vectors_path = db_file.with_name(f"{db_file.stem}.{name}.npy")
+        with self.tools.get_connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS vector_indexes ("
+                "name TEXT PRIMARY KEY, provider TEXT NOT NULL, model TEXT, dim INTEGER)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS vector_entries ("
+                "index_name TEXT NOT NULL, row INTEGER NOT NULL, text TEXT NOT NULL, metadata TEXT, "
+                "PRIMARY KEY (index_name, row))"
+            )
+            row = conn.execute("SELECT provider, model FROM vector_indexes WHERE name = ?", (name,)).fetchone()
+            if row is None:
+                conn.execute("INSERT INTO vector_indexes (name, provider, model) VALUES (?, ?, ?)",
+                             (name, provider, model))
+                conn.commit()
+            elif (row[0], row[1]) != (provider, model):
+                # 不同模型的向量不可比较
+                raise ValueError(f"索引 {name} 使用 {row[0]}/{row[1]} 创建，不能用 {provider}/{model} 访问")
+        self.provider = provider
+        self.model = model
+        self._vectors = None
+
+    @property
+    def vectors(self):
+        """向量矩阵（只读内存映射，首次访问时加载）"""
+        if self._vectors is None:
+            if self.vectors_path.exists():
+                self._vectors = np.load(self.vectors_path, mmap_mode='r')
+            else:
+                self._vectors = np.zeros((0, 0), dtype=np.float32)
+        return self._vectors
+
+    def __len__(self) -> int:
+        return self.vectors.shape[0]
+
+    def _embed(self, texts: List[str], batch_size: int):
+        embed = _llm_api().embed
+        matrix = np.asarray(embed(texts, provider=self.provider, model=self.model, batch_size=batch_size),
+                            dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / np.where(norms == 0, 1, norms)
+
+    def add(self, texts: List[str], metadatas: Optional[List[Dict[str, Any]]] = None,
+            batch_size: int = 64) -> List[int]:
+        """批量向量化并添加文本
+
+        Args:
+            texts: 文本列表
+            metadatas: 与文本一一对应的元数据（如来源 URL）
+            batch_size: 每次向量化请求的文本数
+
+        Returns:
+            新条目的行号列表
+        """
+        if not texts:
+            return []
+        if metadatas is not None and len(metadatas) != len(texts):
+            raise ValueError("metadatas 的长度必须与 texts 一致")
+        new_vectors = self._embed(texts, batch_size)
+        current = self.vectors
+        if len(current) and current.shape[1] != new_vectors.shape[1]:
+            raise ValueError(f"向量维度不一致: 索引为 {current.shape[1]}，新向量为 {new_vectors.shape[1]}")
+        start = len(current)
+        combined = np.concatenate([current, new_vectors]) if len(current) else new_vectors
+        rows = list(range(start, start + len(texts)))
+        temp_path = self.vectors_path.with_suffix('.tmp.npy')
+        with self.tools.get_connection() as conn:
+            # 之前中断的写入可能留下矩阵之外的条目，这些行号将被新条目占用
+            conn.execute("DELETE FROM vector_entries WHERE index_name = ? AND row >= ?", (self.name, start))
+            conn.executemany(
+                "INSERT INTO vector_entries (index_name, row, text, metadata) VALUES (?, ?, ?, ?)",
+                [(self.name, row, text, json.dumps(metadatas[i], ensure_ascii=False) if metadatas else None)
+                 for i, (row, text) in enumerate(zip(rows, texts))]
+            )
+            conn.execute("UPDATE vector_indexes SET dim = ? WHERE name = ?", (combined.shape[1], self.name))
+            # 先写临时文件，条目提交后再替换矩阵：任何一步中断时，矩阵的每一行都仍有对应条目
+            np.save(temp_path, combined)
+            conn.commit()
+        os.replace(temp_path, self.vectors_path)
+        self._vectors = None
+        return rows
+
+    def add_document(self, text: str, metadata: Optional[Dict[str, Any]] = None, chunk_tokens: int = 200,
+                     overlap_tokens: int = 20, batch_size: int = 64) -> List[int]:
+        """将长文档（如抓取的网页、视频字幕）切分为段落后添加
+
+        Args:
+            text: 文档内容
+            metadata: 每个段落共用的元数据
+            chunk_tokens: 段落长度（估算的 token 数）
+            overlap_tokens: 相邻段落的重叠长度
+            batch_size: 每次向量化请求的段落数
+
+        Returns:
+            新条目的行号列表
+        """
+        chunks = _llm_api().split_text(text, chunk_tokens, overlap_tokens)
+        return self.add(chunks, [metadata or {}] * len(chunks), batch_size)
+
+    def search(self, query: str, k: int = 5) -> List[Dict[str, Any]]:
+        """检索与查询最相似的 k 个条目
+
+        Args:
+            query: 查询文本
+            k: 返回条目数
+
+        Returns:
+            按相似度降序排列的结果，包含 row、text、metadata 和 score
+        """
+        vectors = self.vectors
+        if not len(vectors) or k <= 0:
+            return []
+        scores = vectors @ self._embed([query], 1)[0]
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        rows = [int(row) for row in top]
+        with self.tools.get_connection() as conn:
+            entries = dict(
+                (row, (text, metadata)) for row, text, metadata in conn.execute(
+                    f"SELECT row, text, metadata FROM vector_entries WHERE index_name = ? "
+                    f"AND row IN ({','.join('?' * len(rows))})", (self.name, *rows)
+                )
+            )
+        return [{"row": row, "text": entries[row][0],
+                 "metadata": json.loads(entries[row][1]) if entries[row][1] else None,
+                 "score": float(scores[row])} for row in rows if row in entries]
+
 def main():
     parser = argparse.ArgumentParser(description='SQLite数据库操作工具')
     parser.add_argument('--db', required=True, help='数据库文件路径')
@@ -141,13 +307,29 @@ def main():
     parser.add_argument('--table', help='导入CSV时的目标表名')
     parser.add_argument('--export-csv', help='导出查询结果到CSV文件')
     parser.add_argument('--delimiter', default=',', help='CSV分隔符')
+    parser.add_argument('--index', default='default', help='向量索引名')
+    parser.add_argument('--index-file', help='将文本文件切分后添加到向量索引')
+    parser.add_argument('--search', help='在向量索引中检索相关段落')
+    parser.add_argument('--top-k', type=int, default=5, help='检索返回的段落数')
+    parser.add_argument('--embed-provider', default='hashing',
+                        help='向量化服务: openai, azure, local, gemini 或 hashing（本地，默认）')
+    parser.add_argument('--embed-model', help='向量化模型（默认取决于服务）')
 
     args = parser.parse_args()
     
     try:
         sqlite_tools = SQLiteTools(args.db)
         
-        if args.query and not args.export_csv:
+        if args.index_file or args.search:
+            index = VectorIndex(args.db, args.index, args.embed_provider, args.embed_model)
+            if args.index_file:
+                with open(args.index_file, 'r', encoding='utf-8') as f:
+                    rows = index.add_document(f.read(), {"source": args.index_file})
+                print(f"已添加 {len(rows)} 个段落到索引 {args.index}")
+            if args.search:
+                print(json.dumps(index.search(args.search, args.top_k), ensure_ascii=False, indent=2))
+        
+        elif args.query and not args.export_csv:
             # 只在不导出CSV时打印JSON结果
             results = sqlite_tools.execute_query(args.query)
             print(json.dumps(results, ensure_ascii=False, indent=2))
@@ -4,14 +4,36 @@ import asyncio
 import argparse
 import sys
 import os
-from typing import List, Optional
+import re
+import atexit
+import codecs
+import threading
+import weakref
+from collections import Counter
+from collections.abc import Sized
+from contextlib import asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Tuple
+import httpx
 from playwright.async_api import async_playwright
 import html5lib
-from multiprocessing import Pool
+try:
+    import lxml.html
+except ImportError:  # Optional; parse_html falls back to html5lib
+    lxml = None
 import time
 from urllib.parse import urlparse
 import logging
 
+try:
+    from tools.browser_pool import get_browser_pool, close_browser_pool, browser_pool_scope
+    from tools.page_cache import DEFAULT_CACHE_DIR, DEFAULT_MAX_BYTES, PageCache
+except ImportError:  # Run as a script from the tools directory
+    from browser_pool import get_browser_pool, close_browser_pool, browser_pool_scope
+    from page_cache import DEFAULT_CACHE_DIR, DEFAULT_MAX_BYTES, PageCache
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -20,11 +42,337 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-async def fetch_page(url: str, context) -> Optional[str]:
-    """Asynchronously fetch a webpage's content."""
-    page = await context.new_page()
+RENDER_MODES = ['auto', 'always', 'never']
+HTTP_TIMEOUT = 15.0
+HTTP_MAX_CONNECTIONS = 20
+# Pages with less visible text than this are treated as script-rendered shells
+MIN_STATIC_TEXT_CHARS = 200
+_HTTP_HEADERS = {
+    'User-Agent': ('Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 '
+                   '(KHTML, like Gecko) Chrome/120.0 Safari/537.36'),
+    'Accept': 'text/html,application/xhtml+xml,text/plain;q=0.9,*/*;q=0.8',
+}
+_STATIC_CONTENT_TYPES = ('text/html', 'application/xhtml+xml', 'text/plain')
+# Bytes searched for a <meta> charset declaration, as browsers do
+CHARSET_SNIFF_BYTES = 4096
+_META_CHARSET_RE = re.compile(rb'<meta\b[^>]*?charset\s*=\s*["\']?\s*([a-zA-Z0-9_.:-]+)', re.IGNORECASE)
+_BOMS = [(codecs.BOM_UTF8, 'utf-8'), (codecs.BOM_UTF16_LE, 'utf-16-le'), (codecs.BOM_UTF16_BE, 'utf-16-be')]
+# Labels browsers decode with a superset of the codec Python names that way
+_CHARSET_ALIASES = {
+    'gb2312': 'gb18030', 'gbk': 'gb18030', 'x-gbk': 'gb18030',
+    'shift_jis': 'cp932', 'shift-jis': 'cp932', 'sjis': 'cp932',
+    'euc-kr': 'cp949', 'iso-8859-1': 'cp1252', 'latin1': 'cp1252', 'us-ascii': 'cp1252',
+}
+_INVISIBLE_RE = re.compile(r'<(script|style|noscript|template)\b[^>]*>.*?</\1\s*>|<!--.*?-->',
+                           re.IGNORECASE | re.DOTALL)
+_TAG_RE = re.compile(r'<[^>]+>')
+_SCRIPT_RE = re.compile(r'<script\b', re.IGNORECASE)
+_NOSCRIPT_RE = re.compile(r'<noscript\b[^>]*>(.*?)</noscript\s*>', re.IGNORECASE | re.DOTALL)
+_JS_REQUIRED_RE = re.compile(r'(enable|requires?|turn on|need to enable)\s+javascript', re.IGNORECASE)
+# Empty mount points of React, Vue, Next.js, Nuxt, Angular and similar frameworks
+_SPA_SHELL_RE = re.compile(
+    r'<(div|main|app-root)\b[^>]*\bid=["\'](root|app|__next|__nuxt|svelte|main-app)["\'][^>]*>\s*</\1>'
+    r'|<app-root\b[^>]*>\s*</app-root>',
+    re.IGNORECASE)
+
+PARSER_BACKENDS = ['auto', 'lxml', 'html5lib']
+_XHTML = '{http://www.w3.org/1999/xhtml}'
+_HTML5LIB_SKIP_TAGS = frozenset([f'{_XHTML}script', f'{_XHTML}style'])
+_LXML_SKIP_TAGS = frozenset(['script', 'style'])
+# Lines containing any of these (case-insensitively) are dropped as script or style residue
+_NOISE_PATTERNS = ['var ', 'function()', '.js', '.css', 'google-analytics', 'disqus', '{', '}']
+_NOISE_RE = re.compile('|'.join(re.escape(pattern) for pattern in _NOISE_PATTERNS))
+# huge_tree lifts libxml2's nesting limit of 256, which silently truncates deep pages
+_LXML_PARSER = lxml.html.HTMLParser(huge_tree=True) if lxml is not None else None
+# Children a table part may hold without the HTML5 parser moving them out of the table
+_TABLE_CONTENT = {
+    'table': frozenset(['caption', 'colgroup', 'col', 'thead', 'tbody', 'tfoot', 'tr']),
+    'thead': frozenset(['tr']),
+    'tbody': frozenset(['tr']),
+    'tfoot': frozenset(['tr']),
+    'tr': frozenset(['td', 'th']),
+}
+_TABLE_ALWAYS_ALLOWED = frozenset(['script', 'style', 'template', 'form', 'input'])
+_HEADINGS = frozenset(['h1', 'h2', 'h3', 'h4', 'h5', 'h6'])
+# Elements the HTML5 parser ignores, or closes differently from libxml2, outside these parents
+_REQUIRED_PARENTS = {
+    'tr': frozenset(['table', 'tbody', 'thead', 'tfoot']),
+    'td': frozenset(['tr']),
+    'th': frozenset(['tr']),
+    'tbody': frozenset(['table']),
+    'thead': frozenset(['table']),
+    'tfoot': frozenset(['table']),
+    'caption': frozenset(['table']),
+    'colgroup': frozenset(['table']),
+    'col': frozenset(['table', 'colgroup']),
+    'li': frozenset(['ul', 'ol', 'menu', 'dir']),
+    'dt': frozenset(['dl']),
+    'dd': frozenset(['dl']),
+    'title': frozenset(['head']),
+}
+# Start tags that close an open <p> in the HTML5 parser but not always in libxml2
+_CLOSES_P = frozenset([
+    'address', 'article', 'aside', 'blockquote', 'center', 'details', 'dialog', 'dir', 'div', 'dl',
+    'fieldset', 'figcaption', 'figure', 'footer', 'form', 'header', 'hgroup', 'hr', 'main', 'menu', 'nav',
+    'ol', 'p', 'pre', 'section', 'summary', 'table', 'ul', 'li', 'dd', 'dt', *_HEADINGS,
+])
+# Elements libxml2 and the HTML5 parser build the same tree for when the markup
+# is well nested. Others (e.g. <image>, <select>, <textarea>, <frameset>, <svg>)
+# have special parsing rules in HTML5, so pages using them go to html5lib.
+_LXML_SAFE_TAGS = frozenset([
+    'html', 'head', 'body', 'meta', 'link', 'base', 'script', 'style', 'noscript',
+    'a', 'abbr', 'b', 'bdi', 'bdo', 'big', 'cite', 'code', 'data', 'del', 'dfn', 'em', 'font', 'i', 'ins',
+    'kbd', 'mark', 'q', 's', 'samp', 'small', 'span', 'strike', 'strong', 'sub', 'sup', 'time', 'tt', 'u',
+    'var', 'br', 'img', 'label', 'input', 'table', *_CLOSES_P, *_REQUIRED_PARENTS,
+])
+# libxml2 closes elements early at some block start tags where the HTML5 parser keeps
+# them open; that only shows as a parse error when the end tag is present, so every
+# element except these must have an explicit end tag
+_IMPLIED_END_TAGS = frozenset([
+    'html', 'head', 'body', 'p', 'li', 'dt', 'dd', 'tr', 'td', 'th', 'thead', 'tbody', 'tfoot', 'caption',
+    'colgroup', 'br', 'img', 'input', 'meta', 'link', 'base', 'hr', 'col', 'script', 'style',
+])
+_RAW_TEXT_RE = re.compile(r'<(script|style)\b[^>]*>.*?</\1\s*>|<!--.*?-->', re.IGNORECASE | re.DOTALL)
+_TAG_NAME_RE = re.compile(r'<(/?)([a-zA-Z][a-zA-Z0-9]*)')
+# libxml2 drops everything after the first </body> or </html>; the HTML5 parser keeps it
+_DOCUMENT_END_RE = re.compile(r'</(?:body|html)\b', re.IGNORECASE)
+_IGNORABLE_END_RE = re.compile(r'<!--.*?-->|</(?:body|html)\s*>', re.IGNORECASE | re.DOTALL)
+
+# Pages up to this many characters are parsed inline; shipping them to a worker costs
+# about as much as parsing them
+PARSE_INLINE_MAX_CHARS = 50_000
+# Runs with at most this many URLs parse everything inline and never start the pool
+PARSE_INLINE_MAX_PAGES = 2
+
+_parse_executor: Optional[ProcessPoolExecutor] = None
+_parse_executor_lock = threading.Lock()
+
+# Resource types parse_html never looks at; stylesheets and scripts are kept because
+# pages may need them to lay out or render their text
+DEFAULT_BLOCKED_RESOURCES = ['image', 'media', 'font']
+# Analytics, ad and session-recording hosts (subdomains are blocked too)
+TRACKER_DOMAINS = [
+    'google-analytics.com', 'googletagmanager.com', 'googlesyndication.com',
+    'doubleclick.net', 'googleadservices.com', 'adservice.google.com',
+    'connect.facebook.net', 'facebook.com/tr', 'analytics.twitter.com', 'ads-twitter.com',
+    'bat.bing.com', 'clarity.ms', 'hotjar.com', 'mixpanel.com', 'segment.com', 'segment.io',
+    'amplitude.com', 'fullstory.com', 'newrelic.com', 'nr-data.net', 'scorecardresearch.com',
+    'quantserve.com', 'taboola.com', 'outbrain.com', 'criteo.com', 'adnxs.com',
+    'amazon-adsystem.com', 'hubspot.com', 'intercom.io', 'optimizely.com', 'disqus.com',
+]
+
+_http_clients: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]' = weakref.WeakKeyDictionary()
+
+def needs_javascript(html_content: Optional[str]) -> bool:
+    """Guess whether a page fetched over plain HTTP only renders with JavaScript.
+
+    Looks for an empty body, framework mount points with no content, and
+    noscript notices asking the reader to enable JavaScript. Notices on pages
+    that already carry plenty of text (e.g. a comment widget under an
+    article) do not count.
+    """
+    if not html_content or not html_content.strip():
+        return True
+    if _SPA_SHELL_RE.search(html_content):
+        return True
+    text = _TAG_RE.sub(' ', _INVISIBLE_RE.sub(' ', html_content))
+    visible_chars = len(''.join(text.split()))
+    if visible_chars < MIN_STATIC_TEXT_CHARS and _SCRIPT_RE.search(html_content):
+        return True
+    if visible_chars < MIN_STATIC_TEXT_CHARS * 5:
+        return any(_JS_REQUIRED_RE.search(notice) for notice in _NOSCRIPT_RE.findall(html_content))
+    return False
+
+def _get_http_client() -> httpx.AsyncClient:
+    """Return the pooled HTTP client of the running event loop."""
+    loop = asyncio.get_running_loop()
+    client = _http_clients.get(loop)
+    if client is None or client.is_closed:
+        client = _http_clients[loop] = httpx.AsyncClient(
+            headers=_HTTP_HEADERS,
+            follow_redirects=True,
+            timeout=HTTP_TIMEOUT,
+            limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS,
+                                max_keepalive_connections=HTTP_MAX_CONNECTIONS),
+        )
+    return client
+
+async def close_http_client() -> None:
+    """Close the pooled HTTP client of the running event loop, if there is one."""
+    client = _http_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+@asynccontextmanager
+async def _http_client_scope():
+    """Close the pooled HTTP client on exit unless it was already open on entry."""
+    client = _http_clients.get(asyncio.get_running_loop())
+    owned = client is None or client.is_closed
+    try:
+        yield
+    finally:
+        if owned:
+            await close_http_client()
+
+async def _fetch_response(url: str, headers: Optional[Dict[str, str]] = None) -> Optional[httpx.Response]:
+    try:
+        return await _get_http_client().get(url, headers=headers)
+    except httpx.HTTPError as e:
+        logger.debug(f"HTTP fetch of {url} failed: {e}")
+        return None
+
+def _codec(label: Optional[str]) -> Optional[str]:
+    """Return the Python codec for a charset label, or None if it is unknown."""
+    if not label:
+        return None
+    label = label.strip().strip('"\'').lower()
+    label = _CHARSET_ALIASES.get(label, label)
+    try:
+        return codecs.lookup(label).name
+    except LookupError:
+        return None
+
+def _decode_html(response: httpx.Response) -> Optional[str]:
+    """Decode a page the way a browser would, or return None if its charset is unknown.
+
+    The charset comes from a byte order mark, the Content-Type header, or a
+    <meta> declaration in the first CHARSET_SNIFF_BYTES bytes, in that order.
+    Undeclared pages are accepted only if they are valid UTF-8 (which covers
+    plain ASCII); browsers guess anything else from the bytes.
+    """
+    content = response.content
+    for bom, encoding in _BOMS:
+        if content.startswith(bom):
+            return content[len(bom):].decode(encoding, errors='replace')
+    match = _META_CHARSET_RE.search(content[:CHARSET_SNIFF_BYTES])
+    encoding = _codec(response.charset_encoding) or _codec(match.group(1).decode('ascii') if match else None)
+    if encoding is not None:
+        if encoding.startswith('utf-16'):
+            # A document that could declare UTF-16 in ASCII is not UTF-16
+            encoding = 'utf-8'
+        return content.decode(encoding, errors='replace')
+    try:
+        return content.decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+
+def _static_content(url: str, response: httpx.Response, guess_charset: bool = False) -> Optional[str]:
+    content_type = response.headers.get('content-type', '').split(';')[0].strip().lower()
+    if not response.is_success or (content_type and content_type not in _STATIC_CONTENT_TYPES):
+        logger.debug(f"HTTP fetch of {url} returned {response.status_code} {content_type or 'no content type'}")
+        return None
+    text = _decode_html(response)
+    if text is None:
+        logger.debug(f"{url} does not declare its charset")
+        if guess_charset:
+            text = response.text
+    return text
+
+async def fetch_static(url: str) -> Optional[str]:
+    """Fetch a page over plain HTTP without rendering it.
+
+    Returns None for errors, non-2xx responses and content types that are not
+    HTML or plain text. Pages that do not declare their charset and are not
+    UTF-8 are decoded with httpx's best guess.
+    """
+    response = await _fetch_response(url)
+    return None if response is None else _static_content(url, response, guess_charset=True)
+
+class ResourceBlocker:
+    """Abort non-essential requests of rendered pages and count what was skipped.
+
+    Requests are aborted when their Playwright resource type is in
+    ``resource_types`` or their host belongs to one of ``tracker_domains``.
+    The top-level document is never blocked. Aborted requests never reach the
+    network, so their size is unknown; compare ``bytes_loaded`` with and
+    without blocking to measure the saving.
+
+    Args:
+        resource_types (iterable, optional): Resource types to abort.
+            Defaults to DEFAULT_BLOCKED_RESOURCES.
+        tracker_domains (iterable, optional): Domains to abort, optionally with
+            a path prefix. Defaults to TRACKER_DOMAINS.
+    """
+
+    def __init__(self, resource_types: Optional[Iterable[str]] = None,
+                 tracker_domains: Optional[Iterable[str]] = None):
+        self.resource_types = frozenset(DEFAULT_BLOCKED_RESOURCES if resource_types is None else resource_types)
+        self.tracker_domains = [d.lower() for d in (TRACKER_DOMAINS if tracker_domains is None else tracker_domains)]
+        self.blocked: Counter = Counter()
+        self.allowed = 0
+        self.bytes_loaded = 0
+        self.pages = 0
+
+    def _is_tracker(self, url: str) -> bool:
+        parsed = urlparse(url)
+        host = (parsed.hostname or '').lower()
+        for domain in self.tracker_domains:
+            domain_host, _, path = domain.partition('/')
+            if (host == domain_host or host.endswith('.' + domain_host)) and parsed.path.startswith('/' + path):
+                return True
+        return False
+
+    def reason(self, resource_type: str, url: str) -> Optional[str]:
+        """Return why a request should be aborted ('tracker' or its resource type), or None."""
+        if self.tracker_domains and self._is_tracker(url):
+            return 'tracker'
+        if resource_type in self.resource_types:
+            return resource_type
+        return None
+
+    async def handle(self, route) -> None:
+        """Playwright route handler."""
+        request = route.request
+        reason = None
+        if not (request.is_navigation_request() and request.frame.parent_frame is None):
+            reason = self.reason(request.resource_type, request.url)
+        if reason:
+            self.blocked[reason] += 1
+            await route.abort('blockedbyclient')
+        else:
+            self.allowed += 1
+            await route.continue_()
+
+    def on_response(self, response) -> None:
+        length = response.headers.get('content-length', '')
+        if length.isdigit():
+            self.bytes_loaded += int(length)
+
+    async def attach(self, page) -> None:
+        """Route all requests of ``page`` through this blocker."""
+        self.pages += 1
+        page.on('response', self.on_response)
+        if self.resource_types or self.tracker_domains:
+            await page.route('**/*', self.handle)
+
+    async def detach(self, page) -> None:
+        """Undo attach() so a reused page does not count or route twice."""
+        page.remove_listener('response', self.on_response)
+        if self.resource_types or self.tracker_domains:
+            await page.unroute('**/*', self.handle)
+
+    def stats(self) -> Dict[str, object]:
+        """Return page, request and byte counters for the run."""
+        return {
+            'pages': self.pages,
+            'requests_allowed': self.allowed,
+            'requests_blocked': sum(self.blocked.values()),
+            'blocked_by_reason': dict(self.blocked),
+            'bytes_loaded': self.bytes_loaded,
+        }
+
+    def summary(self) -> str:
+        stats = self.stats()
+        reasons = ', '.join(f"{reason}: {count}" for reason, count in self.blocked.most_common())
+        return (f"Rendered {stats['pages']} page(s): {stats['requests_allowed']} requests loaded "
+                f"({stats['bytes_loaded'] / 1024:.1f} KB), {stats['requests_blocked']} blocked"
+                + (f" ({reasons})" if reasons else ""))
+
+async def _load_page(page, url: str, blocker: Optional[ResourceBlocker] = None) -> Optional[str]:
     try:
-        logger.info(f"Fetching {url}")
+        if blocker is not None:
+            await blocker.attach(page)
+        logger.info(f"Rendering {url}")
         await page.goto(url)
         await page.wait_for_load_state('networkidle')
         content = await page.content()
@@ -34,125 +382,458 @@ async def fetch_page(url: str, context) -> Optional[str]:
         logger.error(f"Error fetching {url}: {str(e)}")
         return None
     finally:
-        await page.close()
+        if blocker is not None:
+            try:
+                await blocker.detach(page)
+            except Exception as e:
+                logger.debug(f"Error detaching request blocker: {e}")
 
-def parse_html(html_content: Optional[str]) -> str:
-    """Parse HTML content and extract text with hyperlinks in markdown format."""
-    if not html_content:
-        return ""
-    
+async def render_page(url: str, context=None, blocker: Optional[ResourceBlocker] = None) -> Optional[str]:
+    """Fetch a webpage's content with a headless browser.
+
+    Uses a page from ``context`` when given, otherwise a reused tab from the
+    event loop's shared browser pool. Requests are filtered through
+    ``blocker`` when given.
+    """
+    if context is None:
+        pool = get_browser_pool(playwright_factory=async_playwright)
+        try:
+            async with pool.page(reuse=True) as page:
+                return await _load_page(page, url, blocker)
+        except Exception as e:
+            logger.error(f"Error fetching {url}: {str(e)}")
+            return None
+    page = await context.new_page()
     try:
-        document = html5lib.parse(html_content)
-        result = []
-        seen_texts = set()  # To avoid duplicates
-        
-        def should_skip_element(elem) -> bool:
-            """Check if the element should be skipped."""
-            # Skip script and style tags
-            if elem.tag in ['{http://www.w3.org/1999/xhtml}script', 
-                          '{http://www.w3.org/1999/xhtml}style']:
-                return True
-            # Skip empty elements or elements with only whitespace
-            if not any(text.strip() for text in elem.itertext()):
-                return True
-            return False
-        
-        def process_element(elem, depth=0):
-            """Process an element and its children recursively."""
-            if should_skip_element(elem):
-                return
-            
-            # Handle text content
-            if hasattr(elem, 'text') and elem.text:
-                text = elem.text.strip()
-                if text and text not in seen_texts:
-                    # Check if this is an anchor tag
-                    if elem.tag == '{http://www.w3.org/1999/xhtml}a':
-                        href = None
-                        for attr, value in elem.items():
-                            if attr.endswith('href'):
-                                href = value
-                                break
-                        if href and not href.startswith(('#', 'javascript:')):
-                            # Format as markdown link
-                            link_text = f"[{text}]({href})"
-                            result.append("  " * depth + link_text)
-                            seen_texts.add(text)
-                    else:
-                        result.append("  " * depth + text)
-                        seen_texts.add(text)
-            
-            # Process children
+        return await _load_page(page, url, blocker)
+    finally:
+        await page.close()
+
+async def fetch_page(url: str, context=None, render: str = 'auto',
+                     blocker: Optional[ResourceBlocker] = None,
+                     cache: Optional[PageCache] = None) -> Optional[str]:
+    """Asynchronously fetch a webpage's content.
+
+    With render='auto' the page is first fetched over plain HTTP and only
+    rendered in the browser when needs_javascript() says so, the HTTP fetch
+    fails, or the page's charset cannot be told from its headers, byte order
+    mark or <meta> tags (see _decode_html). 'always' goes straight to the browser; 'never' never starts it.
+    Rendered pages have their requests filtered through ``blocker``.
+
+    With a ``cache``, fresh copies are returned without touching the network
+    and stale ones are revalidated with a conditional request; a 304 (or a
+    network error) serves the cached copy. 'always' only accepts copies that
+    were rendered, and still sends the HTTP request first, since its status and
+    validators decide whether the rendered page may be cached: pages whose HTTP
+    response failed are never cached.
+    """
+    if render not in RENDER_MODES:
+        raise ValueError(f"Unknown render mode: {render}")
+    entry = None
+    if cache is not None:
+        entry = cache.get(url)
+        if entry is not None and render == 'always' and not entry['rendered']:
+            entry = None
+        if entry is not None and entry['fresh']:
+            logger.info(f"Serving {url} from the cache")
+            return entry['html']
+    response = None
+    if render != 'always' or cache is not None:
+        response = await _fetch_response(url, cache.conditional_headers(entry) if cache is not None else None)
+    if entry is not None:
+        if response is None:
+            logger.warning(f"Could not revalidate {url}; serving the cached copy")
+            return entry['html']
+        if response.status_code == 304:
+            cache.mark_revalidated(url, response.headers)
+            logger.info(f"{url} is unchanged; serving it from the cache")
+            return entry['html']
+    content = None if response is None else _static_content(url, response, guess_charset=render == 'never')
+    if render == 'never' or (render == 'auto' and content is not None and not needs_javascript(content)):
+        if content is None:
+            logger.error(f"Error fetching {url} over HTTP")
+            return None
+        logger.info(f"Fetched {url} over HTTP")
+        if cache is not None:
+            cache.put(url, content, response.headers)
+        return content
+    if render != 'always':
+        logger.debug(f"Escalating {url} to the browser")
+    content = await render_page(url, context, blocker)
+    # A rendered 404 or 503 page must not be served from the cache later
+    if cache is not None and content is not None and response is not None and response.is_success:
+        # Keep the validators of the static response to revalidate the rendered copy
+        cache.put(url, content, response.headers, rendered=True)
+    return content
+
+def _has_text_map(elements: List) -> Dict[int, bool]:
+    """Map id(element) to whether its subtree holds non-whitespace text.
+
+    ``elements`` is ``list(root.iter())``; the caller must keep it alive while
+    using the map, since lxml recreates (and renumbers) element proxies that
+    nothing references. Equivalent to ``any(t.strip() for t in
+    elem.itertext())`` for every element, computed bottom-up in one pass
+    instead of once per element. Like html5lib's comment nodes under the C
+    ElementTree, comments count as elements whose text is their content.
+    """
+    has_text: Dict[int, bool] = {}
+    for elem in reversed(elements):
+        text = elem.text
+        found = bool(text and not text.isspace())
+        if not found:
             for child in elem:
-                process_element(child, depth + 1)
-            
+                tail = child.tail
+                if has_text[id(child)] or (tail and not tail.isspace()):
+                    found = True
+                    break
+        has_text[id(elem)] = found
+    return has_text
+
+def _extract_text(root, skip_tags: frozenset, anchor_tag: str) -> str:
+    """Walk the tree once and render text and links as indented markdown lines."""
+    elements = list(root.iter())
+    has_text = _has_text_map(elements)
+    result = []
+    seen_texts = set()  # To avoid duplicates
+
+    def emit(text: str, depth: int, line: Optional[str] = None) -> None:
+        seen_texts.add(text)
+        # Skip lines that are likely to be noise
+        line = "  " * depth + (line or text)
+        if not _NOISE_RE.search(line.lower()):
+            result.append(line)
+
+    # Explicit stack instead of recursion: (element, depth, children done)
+    stack = [(root, 0, False)]
+    while stack:
+        elem, depth, closing = stack.pop()
+        if closing:
             # Handle tail text
-            if hasattr(elem, 'tail') and elem.tail:
+            if elem.tail:
                 tail = elem.tail.strip()
                 if tail and tail not in seen_texts:
-                    result.append("  " * depth + tail)
-                    seen_texts.add(tail)
-        
-        # Start processing from the body tag
-        body = document.find('.//{http://www.w3.org/1999/xhtml}body')
-        if body is not None:
-            process_element(body)
-        else:
-            # Fallback to processing the entire document
-            process_element(document)
-        
-        # Filter out common unwanted patterns
-        filtered_result = []
-        for line in result:
-            # Skip lines that are likely to be noise
-            if any(pattern in line.lower() for pattern in [
-                'var ', 
-                'function()', 
-                '.js',
-                '.css',
-                'google-analytics',
-                'disqus',
-                '{',
-                '}'
-            ]):
-                continue
-            filtered_result.append(line)
-        
-        return '\n'.join(filtered_result)
+                    emit(tail, depth)
+            continue
+        # Skip script and style tags, and elements with only whitespace
+        if elem.tag in skip_tags or not has_text[id(elem)]:
+            continue
+        if elem.text:
+            text = elem.text.strip()
+            if text and text not in seen_texts:
+                if elem.tag == anchor_tag:
+                    href = None
+                    for attr, value in elem.items():
+                        if attr.endswith('href'):
+                            href = value
+                            break
+                    if href and not href.startswith(('#', 'javascript:')):
+                        # Format as markdown link
+                        emit(text, depth, f"[{text}]({href})")
+                else:
+                    emit(text, depth)
+        stack.append((elem, depth, True))
+        stack.extend((child, depth + 1, False) for child in reversed(elem))
+    return '\n'.join(result)
+
+def _parse_with_html5lib(html_content: str) -> str:
+    document = html5lib.parse(html_content)
+    # Start processing from the body tag, falling back to the entire document
+    body = document.find(f'.//{_XHTML}body')
+    return _extract_text(document if body is None else body, _HTML5LIB_SKIP_TAGS, f'{_XHTML}a')
+
+def _add_implied_tbody(document) -> None:
+    """Wrap rows placed directly in a table in a tbody, as html5lib and browsers do."""
+    for table in document.iter('table'):
+        tbody = None
+        for child in list(table):
+            if child.tag == 'tr':
+                if tbody is None:
+                    tbody = lxml.html.Element('tbody')
+                    child.addprevious(tbody)
+                tbody.append(child)
+            else:
+                tbody = None
+
+def _lxml_tree_differs(html_content: str, document) -> bool:
+    """Return whether lxml's tree may differ from the one the HTML5 parser builds.
+
+    Conservative: any parse error other than an unknown tag, any tag outside
+    _LXML_SAFE_TAGS, a missing end tag, content after </body> or </html>, an
+    element outside the parents it needs, a block inside a <p>, a heading
+    inside a heading, and text or elements browsers move out of a table all
+    count. The tree is only walked through lxml's tag filters, which keeps the
+    check much cheaper than parsing with html5lib.
+    """
+    if any(error.type != lxml.etree.ErrorTypes.HTML_UNKNOWN_TAG for error in _LXML_PARSER.error_log):
+        return True
+    end = _DOCUMENT_END_RE.search(html_content)
+    if end is not None and _IGNORABLE_END_RE.sub('', html_content[end.start():]).strip():
+        return True
+    start_tags, end_tags = Counter(), Counter()
+    for slash, tag in _TAG_NAME_RE.findall(_RAW_TEXT_RE.sub(' ', html_content)):
+        (end_tags if slash else start_tags)[tag.lower()] += 1
+    if not _LXML_SAFE_TAGS.issuperset(start_tags) or not _LXML_SAFE_TAGS.issuperset(end_tags):
+        return True
+    if any(end_tags[tag] < count for tag, count in start_tags.items() if tag not in _IMPLIED_END_TAGS):
+        return True
+    for elem in document.iter(*_REQUIRED_PARENTS):
+        parent = elem.getparent()
+        if parent is None or parent.tag not in _REQUIRED_PARENTS[elem.tag]:
+            return True
+    for paragraph in document.iter('p'):
+        if next(paragraph.iterdescendants(*_CLOSES_P), None) is not None:
+            return True
+    for heading in document.iter(*_HEADINGS):
+        if next(heading.iterdescendants(*_HEADINGS), None) is not None:
+            return True
+    for table_part in document.iter(*_TABLE_CONTENT):
+        if table_part.text and not table_part.text.isspace():
+            return True
+        allowed = _TABLE_CONTENT[table_part.tag]
+        for child in table_part:
+            if isinstance(child.tag, str) and child.tag not in allowed and child.tag not in _TABLE_ALWAYS_ALLOWED:
+                return True
+            if child.tail and not child.tail.isspace():
+                return True
+    return False
+
+def _parse_with_lxml(html_content: str, strict: bool = False) -> Optional[str]:
+    """Extract text with lxml.
+
+    libxml2 does not implement the HTML5 tree construction rules (misnested
+    tags, content misplaced in tables, nested headings, <image> and other
+    special elements) and keeps NUL characters. With ``strict``, None is
+    returned for any document whose tree might differ (see
+    _lxml_tree_differs) so that the caller can parse it with html5lib instead.
+    """
+    if strict and '\x00' in html_content:
+        return None
+    document = lxml.html.document_fromstring(html_content, parser=_LXML_PARSER)
+    if strict and _lxml_tree_differs(html_content, document):
+        return None
+    _add_implied_tbody(document)
+    body = document.find('.//body')
+    return _extract_text(document if body is None else body, _LXML_SKIP_TAGS, 'a')
+
+def _parser_backend(parser: Optional[str]) -> str:
+    """Return the key of the text parse_html extracts with ``parser``."""
+    parser = parser or os.getenv('WEB_SCRAPER_PARSER', 'auto')
+    return 'html5lib' if parser == 'html5lib' or lxml is None else parser
+
+def parse_html(html_content: Optional[str], parser: Optional[str] = None) -> str:
+    """Parse HTML content and extract text with hyperlinks in markdown format.
+
+    ``parser`` is one of PARSER_BACKENDS. html5lib follows the browser
+    parsing algorithm exactly; lxml is much faster but builds a different
+    tree for broken markup. 'auto' (the default, or the WEB_SCRAPER_PARSER
+    environment variable) uses lxml only for documents made of common
+    elements, properly closed and nested, for which both parsers agree, and
+    html5lib for everything else; tests fuzz it against html5lib. Documents
+    lxml rejects are retried with html5lib.
+    """
+    if not html_content:
+        return ""
+    
+    parser = parser or os.getenv('WEB_SCRAPER_PARSER', 'auto')
+    if parser not in PARSER_BACKENDS:
+        raise ValueError(f"Unknown parser backend: {parser}")
+    try:
+        if parser != 'html5lib' and lxml is not None:
+            try:
+                text = _parse_with_lxml(html_content, strict=parser == 'auto')
+                if text is not None:
+                    return text
+                logger.debug("Misnested markup; parsing with html5lib")
+            except (ValueError, lxml.etree.ParserError) as e:
+                logger.debug(f"lxml could not parse the document ({e}); falling back to html5lib")
+        elif parser == 'lxml':
+            logger.warning("lxml is not installed; falling back to html5lib")
+        return _parse_with_html5lib(html_content)
     except Exception as e:
         logger.error(f"Error parsing HTML: {str(e)}")
         return ""
 
-async def process_urls(urls: List[str], max_concurrent: int = 5) -> List[str]:
-    """Process multiple URLs concurrently."""
-    async with async_playwright() as p:
-        browser = await p.chromium.launch()
+def _get_parse_executor() -> ProcessPoolExecutor:
+    """Return the process-wide parse pool, starting it on first use."""
+    global _parse_executor
+    with _parse_executor_lock:
+        if _parse_executor is None:
+            _parse_executor = ProcessPoolExecutor(max_workers=os.cpu_count() or 1)
+        return _parse_executor
+
+def close_parse_pool() -> None:
+    """Shut down the parse pool; the next large page starts a new one."""
+    global _parse_executor
+    with _parse_executor_lock:
+        executor, _parse_executor = _parse_executor, None
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+atexit.register(close_parse_pool)
+
+def _parse_shared(name: str, size: int, parser: Optional[str]) -> str:
+    """Worker side of parse_html_async: decode the HTML straight from shared memory."""
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        view = shm.buf[:size]
+        try:
+            html_content = str(view, 'utf-8', 'surrogatepass')
+        finally:
+            view.release()
+    finally:
+        shm.close()
+    return parse_html(html_content, parser)
+
+async def parse_html_async(html_content: Optional[str], parser: Optional[str] = None,
+                           inline: bool = False) -> str:
+    """Run parse_html without holding up the event loop on large pages.
+
+    Pages up to PARSE_INLINE_MAX_CHARS (or any page when ``inline`` is set)
+    are parsed directly. Larger ones go to a persistent process pool started
+    on first use; the HTML is copied once into shared memory instead of being
+    pickled through the pool's pipe.
+    """
+    if not html_content:
+        return ""
+    if inline or len(html_content) <= PARSE_INLINE_MAX_CHARS:
+        return parse_html(html_content, parser)
+    data = html_content.encode('utf-8', 'surrogatepass')
+    size = len(data)
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    try:
+        shm.buf[:size] = data
+        del data
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_get_parse_executor(), _parse_shared, shm.name, size, parser)
+    except BrokenProcessPool:
+        logger.warning("Parse worker pool crashed; parsing inline and restarting it on the next page")
+        close_parse_pool()
+        return parse_html(html_content, parser)
+    finally:
+        shm.close()
+        shm.unlink()
+
+async def stream_urls(urls: Iterable[str], max_concurrent: int = 5, render: str = 'auto',
+                      blocker: Optional[ResourceBlocker] = None,
+                      parser: Optional[str] = None,
+                      cache: Optional[PageCache] = None) -> AsyncIterator[Tuple[int, str, str]]:
+    """Fetch and parse URLs, yielding (index, url, text) as each page completes.
+
+    A queue of ``max_concurrent`` workers fetches the pages, so at most that
+    many tabs are open at once, each reused for the worker's next URL; the
+    browser pool's memory ceiling (BROWSER_POOL_MAX_MEMORY_MB) can hold new
+    pages back further. Fetched pages the consumer has not taken yet never
+    exceed twice ``max_concurrent``; a slow consumer pauses fetching. If a
+    worker raises, the others are cancelled and the consumer gets the error
+    once it has taken the pages already parsed.
+    Raw HTML is dropped as soon as it is parsed, so memory stays flat however
+    many URLs are passed. ``urls`` is consumed lazily and may be a generator;
+    lists of up to PARSE_INLINE_MAX_PAGES URLs are parsed inline (see
+    parse_html_async). With a ``cache``, pages are fetched through it (see
+    fetch_page) and text already extracted from the same HTML is reused.
+    The HTTP client and the browser pool stay open afterwards, since the
+    consumer may stop at any time; close them with close_http_client() and
+    close_browser_pool() before the loop finishes.
+    See process_urls for ``render`` and ``blocker`` and parse_html for ``parser``.
+    """
+    max_concurrent = max(1, max_concurrent)
+    if blocker is None:
+        blocker = ResourceBlocker()
+    # Spread pages over up to max_concurrent warm contexts (applies when the pool is created)
+    get_browser_pool(playwright_factory=async_playwright, contexts=max_concurrent)
+    
+    pending = enumerate(urls)
+    results: asyncio.Queue = asyncio.Queue()
+    # Pages being fetched plus parsed pages the consumer has not taken yet
+    slots = asyncio.Semaphore(2 * max_concurrent)
+    inline = isinstance(urls, Sized) and len(urls) <= PARSE_INLINE_MAX_PAGES
+    backend = _parser_backend(parser)
+    
+    async def worker():
+        while True:
+            await slots.acquire()
+            try:
+                index, url = next(pending)
+            except StopIteration:
+                slots.release()
+                return
+            html_content = await fetch_page(url, render=render, blocker=blocker, cache=cache)
+            text = cache.get_text(html_content, backend) if cache is not None and html_content else None
+            if text is None:
+                text = await parse_html_async(html_content, parser, inline)
+                if cache is not None and text:
+                    cache.put_text(html_content, backend, text)
+            results.put_nowait((index, url, text))
+    
+    async def run_workers():
+        # asyncio.TaskGroup needs Python 3.11; keep the tasks so that a failing
+        # worker cancels its siblings instead of leaving them fetching unowned
+        tasks = [asyncio.create_task(worker()) for _ in range(max_concurrent)]
         try:
-            # Create browser contexts
-            n_contexts = min(len(urls), max_concurrent)
-            contexts = [await browser.new_context() for _ in range(n_contexts)]
-            
-            # Create tasks for each URL
-            tasks = []
-            for i, url in enumerate(urls):
-                context = contexts[i % len(contexts)]
-                task = fetch_page(url, context)
-                tasks.append(task)
-            
-            # Gather results
-            html_contents = await asyncio.gather(*tasks)
-            
-            # Parse HTML contents in parallel
-            with Pool() as pool:
-                results = pool.map(parse_html, html_contents)
-                
-            return results
-            
+            await asyncio.gather(*tasks)
         finally:
-            # Cleanup
-            for context in contexts:
-                await context.close()
-            await browser.close()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # Wake the consumer, which then re-raises the failure through the runner
+            results.put_nowait(None)
+    
+    runner = asyncio.create_task(run_workers())
+    try:
+        while (item := await results.get()) is not None:
+            yield item
+            slots.release()
+        await runner
+        if blocker.pages:
+            logger.info(blocker.summary())
+    finally:
+        if not runner.done():
+            # The consumer stopped early
+            runner.cancel()
+            try:
+                await runner
+            except asyncio.CancelledError:
+                pass
+
+async def process_urls(urls: List[str], max_concurrent: int = 5, render: str = 'auto',
+                       blocker: Optional[ResourceBlocker] = None, parser: Optional[str] = None,
+                       cache: Optional[PageCache] = None) -> List[str]:
+    """Process multiple URLs concurrently, returning texts in input order.
+
+    See fetch_page for the render modes. Rendered pages skip images, media,
+    fonts and trackers unless another ``blocker`` is given; its stats are
+    logged at the end of the run. The HTTP client and the browser pool are
+    closed afterwards unless the event loop already had them open, so keep
+    them warm across calls by opening them first (e.g. with
+    browser_pool_scope()) and closing them with close_http_client() and
+    close_browser_pool(). Use stream_urls to handle pages as they finish.
+    Pass a PageCache as ``cache`` to reuse pages across runs.
+    """
+    results = [""] * len(urls)
+    async with browser_pool_scope(playwright_factory=async_playwright, contexts=max(1, max_concurrent)), \
+            _http_client_scope():
+        async for index, _, text in stream_urls(urls, max_concurrent, render, blocker, parser, cache):
+            results[index] = text
+    return results
+
+async def _print_urls(urls: List[str], max_concurrent: int, render: str, blocker: ResourceBlocker,
+                      parser: str, max_memory_mb: Optional[float] = None,
+                      cache: Optional[PageCache] = None) -> None:
+    """Print each page to stdout as soon as it has been parsed."""
+    get_browser_pool(playwright_factory=async_playwright, contexts=max_concurrent, max_memory_mb=max_memory_mb)
+    try:
+        async for _, url, text in stream_urls(urls, max_concurrent, render, blocker, parser, cache):
+            print(f"\n=== Content from {url} ===")
+            print(text)
+            print("=" * 80, flush=True)
+        if cache is not None:
+            stats = cache.stats()
+            logger.info(f"Page cache: {stats['hits']} fresh, {stats['revalidated']} revalidated, "
+                        f"{stats['stored']} stored; {stats['pages']} pages "
+                        f"({stats['bytes'] / (1024 * 1024):.1f} MB) in {cache.cache_dir}")
+    finally:
+        await close_http_client()
+        await close_browser_pool()
 
 def validate_url(url: str) -> bool:
     """Validate if the given string is a valid URL."""
@@ -166,11 +847,41 @@ def main():
     parser = argparse.ArgumentParser(description='Fetch and extract text content from webpages.')
     parser.add_argument('urls', nargs='+', help='URLs to process')
     parser.add_argument('--max-concurrent', type=int, default=5,
-                       help='Maximum number of concurrent browser instances (default: 5)')
+                       help='Maximum number of pages fetched at once (default: 5)')
+    parser.add_argument('--max-memory-mb', type=float,
+                       help='Stop opening new pages while the browser uses more memory than this '
+                            '(default: BROWSER_POOL_MAX_MEMORY_MB, or no limit)')
+    parser.add_argument('--render', choices=RENDER_MODES, default='auto',
+                       help='auto: fetch over HTTP and use the browser only for pages that need '
+                            'JavaScript; always: render every page; never: HTTP only (default: auto)')
+    parser.add_argument('--block-resources', default=','.join(DEFAULT_BLOCKED_RESOURCES),
+                       help='Comma-separated Playwright resource types to skip when rendering, e.g. '
+                            f"image,media,font,stylesheet (default: {','.join(DEFAULT_BLOCKED_RESOURCES)})")
+    parser.add_argument('--allow-trackers', action='store_true',
+                       help='Do not block analytics and ad domains when rendering')
+    parser.add_argument('--no-block', action='store_true',
+                       help='Load every resource when rendering (request stats are still logged)')
+    parser.add_argument('--parser', choices=PARSER_BACKENDS, default=os.getenv('WEB_SCRAPER_PARSER', 'auto'),
+                       help='HTML parser: lxml is much faster, html5lib matches browsers exactly on broken '
+                            'markup; auto uses lxml when installed for cleanly nested pages (default: auto)')
+    parser.add_argument('--cache-dir', default=os.getenv('WEB_SCRAPER_CACHE_DIR'),
+                       help='Directory of the on-disk page cache; enables caching (default: $WEB_SCRAPER_CACHE_DIR, '
+                            f'e.g. {DEFAULT_CACHE_DIR})')
+    parser.add_argument('--cache-ttl', type=float,
+                       help="Seconds a cached page is served without revalidating it, overriding the "
+                            "server's Cache-Control/Expires headers (0: always revalidate)")
+    parser.add_argument('--cache-max-mb', type=float, default=DEFAULT_MAX_BYTES / (1024 * 1024),
+                       help='Evict least recently used pages beyond this size (default: %(default).0f)')
+    parser.add_argument('--refresh', action='store_true',
+                       help='Ignore cached pages and fetch everything again, updating the cache')
+    parser.add_argument('--no-cache', action='store_true',
+                       help='Disable the page cache even if $WEB_SCRAPER_CACHE_DIR is set')
     parser.add_argument('--debug', action='store_true',
                        help='Enable debug logging')
     
     args = parser.parse_args()
+    if (args.refresh or args.cache_ttl is not None) and not args.cache_dir:
+        parser.error('--refresh and --cache-ttl need --cache-dir or $WEB_SCRAPER_CACHE_DIR')
     
     if args.debug:
         logger.setLevel(logging.DEBUG)
@@ -187,15 +898,24 @@ def main():
         logger.error("No valid URLs provided")
         sys.exit(1)
     
+    if args.no_block:
+        blocker = ResourceBlocker(resource_types=[], tracker_domains=[])
+    else:
+        blocker = ResourceBlocker(
+            resource_types=[t.strip() for t in args.block_resources.split(',') if t.strip()],
+            tracker_domains=[] if args.allow_trackers else None,
+        )
+    
+    cache = None
+    if args.cache_dir and not args.no_cache:
+        cache = PageCache(args.cache_dir, ttl=args.cache_ttl, max_bytes=int(args.cache_max_mb * 1024 * 1024),
+                          refresh=args.refresh)
+    
     start_time = time.time()
     try:
-        results = asyncio.run(process_urls(valid_urls, args.max_concurrent))
-        
-        # Print results to stdout
-        for url, text in zip(valid_urls, results):
-            print(f"\n=== Content from {url} ===")
-            print(text)
-            print("=" * 80)
+        # Results are printed in completion order
+        asyncio.run(_print_urls(valid_urls, args.max_concurrent, args.render, blocker, args.parser,
+                                args.max_memory_mb, cache))
         
         logger.info(f"Total processing time: {time.time() - start_time:.2f}s")
         
@@ -4,7 +4,7 @@ import argparse
 from typing import Optional, Dict, List
 from youtube_transcript_api import YouTubeTranscriptApi
 from urllib.parse import urlparse, parse_qs
-from tools.llm_api import query_llm
+from tools.llm_api import query_llm_chunked
 
 logger = logging.getLogger(__name__)
 
@@ -49,12 +49,18 @@ def summarize_transcript(transcript_text: str) -> Optional[str]:
         return None
     
     try:
-        prompt = f"""请用中文总结以下视频内容的要点。即使原文是英文，也请用中文回答：
+        prompt = """请用中文总结以下视频内容的要点。即使原文是英文，也请用中文回答：
 
-{transcript_text}
+{text}
 
 请提供一个结构清晰的中文总结。"""
-        summary = query_llm(prompt)
+        # Long transcripts are summarized in parts and the partial summaries merged
+        reduce_prompt = """以下是同一个视频各部分内容的中文要点总结，请将它们合并为一个完整的总结，去除重复内容：
+
+{text}
+
+请提供一个结构清晰的中文总结。"""
+        summary = query_llm_chunked(transcript_text, prompt, reduce_prompt)
         return summary
     except Exception as e:
         logger.error(f"Error summarizing transcript: {str(e)}")